@@ -0,0 +1,132 @@
+# bench_extraction_loop_lag.py
+# 大きなPDFとHTMLのテキスト抽出中に、イベントループがどれだけ止まるか（ループの遅延）を計測するベンチマーク。
+# extraction.ExtractionService を、イベントループ上での直接実行（workers=0、変更前の挙動）と
+# プロセスプールでの実行で比較する。HTMLについては、以前のようにページ全体をBeautifulSoupで読む場合
+# （extract_html_text、Botでは使っていない比較用の実装）と、get_text_from_url が使う逐次パーサー(MainTextParser)に
+# 16KBずつ読ませる場合を計測する。Discordへの接続やAPIキーは不要。
+#
+# 使い方（bot/requirements.txt の PyMuPDF と beautifulsoup4 が必要）:
+#   cd bot
+#   python benchmarks/bench_extraction_loop_lag.py
+#   python benchmarks/bench_extraction_loop_lag.py --pdf-pages 300 --html-mb 20 --workers 2
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction import ExtractionService, MainTextParser, cpu_time_limit  # noqa: E402
+
+TICK_SECONDS = 0.01
+# 本文ではないとみなして取り除くHTML要素
+HTML_REMOVED_TAGS = ["script", "style", "nav", "footer", "header", "aside"]
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """最近傍法によるパーセンタイル。"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def make_pdf(pages: int) -> bytes:
+    import fitz
+
+    paragraph = "木工とコーヒーとAIについての長い資料。岩手の森と伝統の未来を考える。" * 12
+    with fitz.open() as doc:
+        for i in range(pages):
+            page = doc.new_page()
+            page.insert_textbox(fitz.Rect(36, 36, 559, 806), f"{i + 1}ページ目\n" + paragraph * 4, fontname="japan")
+        return doc.tobytes()
+
+
+def make_html(megabytes: float) -> str:
+    block = ("<div class='post'><nav><a href='#'>メニュー</a></nav><p>木工とコーヒーとAIについての長い記事。<b>岩手</b>の森。</p>"
+             "<script>var x = 1;</script><style>.a{color:red}</style></div>\n")
+    return "<html><head><title>bench</title></head><body>" + block * int(megabytes * 1024 * 1024 / len(block.encode())) + "</body></html>"
+
+
+def extract_html_text(html: str, char_budget: int, cpu_seconds: float = 0) -> str:
+    """比較用: ページ全体をBeautifulSoupで読み、script/style/nav などを除いた本文テキストを char_budget 文字で打ち切る。"""
+    from bs4 import BeautifulSoup
+
+    with cpu_time_limit(cpu_seconds):
+        soup = BeautifulSoup(html, "html.parser")
+        for element in soup(HTML_REMOVED_TAGS):
+            element.decompose()
+        return " ".join(soup.stripped_strings)[:char_budget]
+
+
+async def measure_lag(job) -> dict:
+    """job の実行中、TICK_SECONDS ごとに起きるはずのタイマーがどれだけ遅れたかを記録する。"""
+    lags: List[float] = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            expected = time.perf_counter() + TICK_SECONDS
+            await asyncio.sleep(TICK_SECONDS)
+            lags.append(max(0.0, time.perf_counter() - expected) * 1000)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK_SECONDS * 3)
+    started = time.perf_counter()
+    await job()
+    elapsed = time.perf_counter() - started
+    done.set()
+    await ticker_task
+    return {"elapsed_ms": elapsed * 1000, "lag_max_ms": max(lags), "lag_p50_ms": percentile(lags, 50), "lag_p99_ms": percentile(lags, 99), "lag_mean_ms": statistics.mean(lags)}
+
+
+async def stream_html(html: str, char_budget: int, chunk_chars: int = 16 * 1024) -> str:
+    """get_text_from_url と同じく、チャンクごとにイベントループへ制御を返しながら逐次パーサーに読ませる。"""
+    parser = MainTextParser(char_budget)
+    for start in range(0, len(html), chunk_chars):
+        parser.feed(html[start:start + chunk_chars])
+        if parser.done:
+            break
+        await asyncio.sleep(0)
+    parser.close()
+    return parser.text()
+
+
+async def run(args):
+    pdf = make_pdf(args.pdf_pages)
+    html = make_html(args.html_mb)
+    print(f"PDF: {args.pdf_pages}ページ ({len(pdf) / 1024 / 1024:.1f}MB) / HTML: {len(html.encode()) / 1024 / 1024:.1f}MB / 文字数の上限: {args.char_budget}")
+    for workers in (0, args.workers):
+        service = ExtractionService(workers, cpu_seconds=args.cpu_seconds, timeout=args.timeout)
+        if workers:
+            await service.run(extract_html_text, "<p>warm up</p>", 10)  # ワーカープロセスの起動時間は計測から除く
+        label = "event loop" if workers == 0 else f"pool x{workers}"
+        for name, job in (("pdf", lambda: service.extract_pdf(pdf, args.pdf_pages, args.char_budget)),
+                          ("html", lambda: service.run(extract_html_text, html, args.char_budget, service._job_cpu_seconds))):
+            result = await measure_lag(job)
+            print(f"{label:<11} {name:<5} 所要 {result['elapsed_ms']:8.0f}ms  ループ遅延 max={result['lag_max_ms']:7.1f}ms  "
+                  f"p50={result['lag_p50_ms']:6.1f}ms  p99={result['lag_p99_ms']:7.1f}ms")
+        service.shutdown()
+    for label, budget in (("stream", args.char_budget), ("stream+cap", args.stream_char_budget)):
+        result = await measure_lag(lambda: stream_html(html, budget))
+        print(f"{label:<11} html  所要 {result['elapsed_ms']:8.0f}ms  ループ遅延 max={result['lag_max_ms']:7.1f}ms  "
+              f"p50={result['lag_p50_ms']:6.1f}ms  p99={result['lag_p99_ms']:7.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="テキスト抽出中のイベントループ遅延を計測する")
+    parser.add_argument("--pdf-pages", type=int, default=300)
+    parser.add_argument("--html-mb", type=float, default=10.0, help="生成するHTMLの大きさ(MB)")
+    parser.add_argument("--char-budget", type=int, default=10_000_000, help="抽出する文字数の上限（既定は事実上無制限）")
+    parser.add_argument("--stream-char-budget", type=int, default=40_000, help="逐次パーサーを本文の文字数で打ち切る場合の上限")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--cpu-seconds", type=float, default=60)
+    parser.add_argument("--timeout", type=float, default=120)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
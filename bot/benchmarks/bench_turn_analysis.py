@@ -0,0 +1,131 @@
+# bench_turn_analysis.py
+# 1メッセージごとの事後分析について、従来の3回の呼び出し（感情分析・メタ分析・心配事検出）と、
+# スキーマ付きJSONによる1回のターン分析を比較し、メッセージあたりの壁時計時間とトークン数を表示する。
+#
+# 使い方（実際のGemini APIを呼び出すため、GEMINI_API_KEY が必要）:
+#   cd bot
+#   GEMINI_API_KEY=... python benchmarks/bench_turn_analysis.py
+#   GEMINI_API_KEY=... python benchmarks/bench_turn_analysis.py --rounds 10
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# bot_main の import 時の環境変数チェックを通すためのダミー値（GEMINI_API_KEY だけは本物が必要）
+for _name, _value in {
+    "DISCORD_BOT_TOKEN": "benchmark", "TARGET_CHANNEL_ID": "0", "LEARNER_BASE_URL": "http://localhost:8000",
+    "GOOGLE_CLOUD_PROJECT_ID": "benchmark", "OPENWEATHER_API_KEY": "benchmark",
+    "GOOGLE_APPLICATION_CREDENTIALS": "benchmark.json", "METRICS_PORT": "0",
+}.items():
+    os.environ.setdefault(_name, _value)
+
+import google.generativeai as genai  # noqa: E402
+
+import bot_main  # noqa: E402
+
+# 変更前の on_message が使っていた3つのプロンプト（Botでは TURN_ANALYSIS_PROMPT に置き換えたため、比較用にここに残す）
+EMOTION_ANALYSIS_PROMPT = "以下のimazineの発言テキストから、彼の現在の感情を分析し、最も的確なキーワード（例：喜び、疲れ、創造的な興奮、悩み、期待、ニュートラルなど）で、単語のみで答えてください。"
+
+META_ANALYSIS_PROMPT = """
+あなたは、高度なメタ認知能力を持つAIです。以下の会話履歴を分析し、次の3つの要素を抽出して、厳密なJSON形式で出力してください。
+1. `mirai_mood`: この会話を経た結果の「みらい」の感情や気分を、以下の選択肢から一つだけ選んでください。（選択肢：`ニュートラル`, `上機嫌`, `不機嫌`, `ワクワク`, `思慮深い`, `呆れている`）
+2. `heko_mood`: この会話を経た結果の「へー子」の感情や気分を、以下の選択肢から一つだけ選んでください。（選択肢：`ニュートラル`, `共感`, `心配`, `呆れている`, `ツッコミモード`, `安堵`）
+3. `last_interaction_summary`: この会話での「みらいとへー子」の関係性や、印象的なやり取りを、第三者視点から、過去形で、日本語で30文字程度の非常に短い一文に要約してください。（例：「みらいの突飛なアイデアに、へー子が現実的なツッコミを入れた。」）
+# 会話履歴
+{{conversation_history}}
+"""
+
+CONCERN_DETECTION_PROMPT = "以下のユーザーの発言には、「悩み」「疲れ」「心配事」といったネガティブ、あるいは、気遣いを必要とする感情や状態が含まれていますか？含まれる場合、その内容を要約してください。含まれない場合は「なし」とだけ答えてください。\n\n発言: 「{{user_message}}」"
+
+SAMPLE_TURNS = [
+    ("最近、工房の新しい椅子のデザインがやっと固まってきたんだ。", "お、ついに！どんな感じになったの？"),
+    ("座面を少し低くして、岩手の栗材で組もうと思ってる。", "栗材いいね〜、経年変化が楽しみなやつじゃん！"),
+    ("ただ、納期が重なってて正直ちょっと寝不足気味なんだよね。", "それは心配です…。無理しすぎないでくださいね。"),
+]
+SAMPLE_MESSAGES = [
+    "今日はやっと試作品が完成した！みんなに早く見せたい！",
+    "クライアントとの打ち合わせが長引いて、もうクタクタだよ…。",
+    "次はAIを使った家具の受注システムを考えてるんだけど、どう思う？",
+]
+
+
+def sample_history() -> List[Dict[str, Any]]:
+    history = []
+    for user_text, model_text in SAMPLE_TURNS:
+        history.append({"role": "user", "parts": [user_text]})
+        history.append({"role": "model", "parts": [model_text]})
+    return history
+
+
+async def call(prompt: str, generation_config=None) -> Dict[str, int]:
+    model = genai.GenerativeModel(bot_main.MODEL_FLASH)
+    response = await model.generate_content_async(prompt, safety_settings={'HARASSMENT': 'block_none'}, generation_config=generation_config)
+    usage = response.usage_metadata
+    return {"prompt_tokens": usage.prompt_token_count, "candidate_tokens": usage.candidates_token_count}
+
+
+async def legacy(user_query: str) -> List[Dict[str, int]]:
+    """変更前の on_message と同じく、3つのプロンプトを順番に呼び出す。"""
+    history = sample_history()
+    history_text = "\n".join([f"{h['role']}: {h['parts'][0]}" for h in history[-5:]] + [f"user: {user_query}"])
+    return [
+        await call(EMOTION_ANALYSIS_PROMPT.replace("{{user_message}}", user_query)),
+        await call(META_ANALYSIS_PROMPT.replace("{{conversation_history}}", history_text)),
+        await call(CONCERN_DETECTION_PROMPT.replace("{{user_message}}", user_query)),
+    ]
+
+
+async def turn_analysis(user_query: str) -> List[Dict[str, int]]:
+    prompt = bot_main.build_turn_analysis_prompt(sample_history(), user_query)
+    return [await call(prompt, {"response_mime_type": "application/json", "response_schema": bot_main.TURN_ANALYSIS_SCHEMA})]
+
+
+async def measure(name: str, run, rounds: int) -> Dict[str, float]:
+    walls, prompt_tokens, candidate_tokens, calls = [], [], [], 0
+    for _ in range(rounds):
+        for message in SAMPLE_MESSAGES:
+            started = time.perf_counter()
+            usages = await run(message)
+            walls.append((time.perf_counter() - started) * 1000)
+            prompt_tokens.append(sum(u["prompt_tokens"] for u in usages))
+            candidate_tokens.append(sum(u["candidate_tokens"] for u in usages))
+            calls += len(usages)
+    result = {
+        "calls_per_message": calls / len(walls),
+        "wall_mean_ms": statistics.mean(walls),
+        "wall_median_ms": statistics.median(walls),
+        "prompt_tokens": statistics.mean(prompt_tokens),
+        "candidate_tokens": statistics.mean(candidate_tokens),
+    }
+    print(f"{name:<14} calls/msg={result['calls_per_message']:.0f}  wall mean={result['wall_mean_ms']:7.0f}ms  "
+          f"median={result['wall_median_ms']:7.0f}ms  tokens in={result['prompt_tokens']:6.0f}  out={result['candidate_tokens']:5.0f}")
+    return result
+
+
+async def run(args):
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    results = {
+        "legacy": await measure("legacy (3回)", legacy, args.rounds),
+        "turn_analysis": await measure("turn_analysis", turn_analysis, args.rounds),
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="事後分析の3回呼び出しと1回のターン分析を比較する")
+    parser.add_argument("--rounds", type=int, default=3, help="サンプルメッセージ一式を繰り返す回数")
+    parser.add_argument("--json", help="結果を保存するJSONファイルのパス")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
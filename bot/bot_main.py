@@ -5,32 +5,62 @@
 import os
 import logging
 import asyncio
+import codecs
 import json
 import re
 import io
+import hashlib
+import heapq
+import random
+import sqlite3
+import time
+import uuid
+import contextvars
+import functools
+import sys
+import threading
+import traceback
 import pytz
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Awaitable, Callable
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 import discord
 import aiohttp
-import fitz
+from aiohttp import web
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from bs4 import BeautifulSoup
 from youtube_transcript_api import YouTubeTranscriptApi, NoTranscriptFound, TranscriptsDisabled
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+
+from extraction import ExtractionService, ExtractionLimitExceeded, MainTextParser, sniff_charset
 
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from google.oauth2 import service_account
 import vertexai
 # エラーログに基づき、正しいクラス名をインポート
-from vertexai.preview.generative_models import GenerativeModel, Part, GenerationConfig, SafetySetting, HarmCategory
+from vertexai.preview.generative_models import GenerativeModel, GenerationConfig, SafetySetting, HarmCategory
 
 
 # --- 1. 初期設定 (Initial Setup) ---
 load_dotenv()
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - [%(levelname)s] - %(message)s')
+
+# 1つのメッセージの処理を、Botとlearnerの両方のログで追跡できるようにするためのリクエストID
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    """ログレコードに現在のリクエストIDを付与する。"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - [%(levelname)s] - [%(request_id)s] %(message)s')
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(RequestIdFilter())
 
 
 # --- 2. 環境変数の読み込みと検証 (Environment Variable Loading & Validation) ---
@@ -62,15 +92,30 @@ except (ValueError, TypeError) as e:
 
 
 # --- 3. APIクライアントとグローバル変数の初期化 (Client & Global Variable Initialization) ---
-genai.configure(api_key=GEMINI_API_KEY)
+# genai.configure などの外部APIの設定は、import 時ではなく main() で行う
 intents = discord.Intents.default()
 intents.message_content = True
 intents.reactions = True
-client = discord.Client(intents=intents)
+
+class MiraiHekoClient(discord.Client):
+    """終了時に、事後処理キューに残った仕事を流し切ってから切断するクライアント。"""
+
+    async def close(self):
+        await background_queue.drain(BACKGROUND_DRAIN_SECONDS)
+        extraction_service.shutdown()
+        await learner_client.close()
+        for cache in prompt_prefix_caches.values():
+            await cache.release()
+        loop_watchdog.stop()
+        blocking_executor.shutdown(wait=False, cancel_futures=True)
+        await super().close()
+
+client = MiraiHekoClient(intents=intents)
 
 TIMEZONE = 'Asia/Tokyo'
 client.http_session = None
 client.image_generation_requests = {}
+client.background_tasks = set()
 
 MODEL_PRO = "gemini-1.5-pro-latest"
 MODEL_FLASH = "gemini-1.5-flash-latest"
@@ -82,6 +127,460 @@ MIRAI_BASE_PROMPT = "a young woman with a 90s anime aesthetic, slice of life sty
 HEKO_BASE_PROMPT = "a young woman with a 90s anime aesthetic, slice of life style. She has straight, dark hair, often with bangs, and a gentle, calm, sometimes shy expression. Her fashion is more conventional and cute."
 
 
+# --- 3.1. 計測とメトリクス (Instrumentation & Metrics) ---
+# 各処理段階の所要時間をヒストグラムに記録し、Prometheus形式のテキストとして
+# METRICS_HOST:METRICS_PORT の /metrics で公開する（METRICS_PORT=0 で無効）。
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+class Histogram:
+    """ラベルごとに観測値の分布を保持する、Prometheus形式のヒストグラム。"""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series: Dict[Tuple[Tuple[str, Any], ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        series = self._series.setdefault(tuple(labels.items()), [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+class Counter:
+    """ラベルごとに単調増加する値を保持する、Prometheus形式のカウンター。"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._series: Dict[Tuple[Tuple[str, Any], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.items())
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(dict(key))} {value}" for key, value in self._series.items()]
+        return lines
+
+class MetricsRegistry:
+    """ヒストグラム、カウンター、そして読み出し時に値を計算するゲージをまとめて管理する。"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._gauges: Dict[str, Tuple[str, Callable[[], Any]]] = {}
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], Any]):
+        """read() は数値、または (ラベルの辞書, 数値) のリストを返す。"""
+        self._gauges[name] = (help_text, read)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        for name, (help_text, read) in self._gauges.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            try:
+                value = read()
+            except Exception as e:
+                logging.error(f"メトリクス'{name}'の読み出し中にエラー: {e}")
+                continue
+            samples = value if isinstance(value, list) else [({}, value)]
+            lines += [f"{name}{_format_labels(labels)} {sample}" for labels, sample in samples]
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram("mirai_bot_stage_seconds", "Duration of each processing stage of the bot.")
+LEARNER_REQUEST_SECONDS = metrics.histogram("mirai_bot_learner_request_seconds", "Duration of requests from the bot to the Learner API.")
+GEMINI_REQUEST_SECONDS = metrics.histogram("mirai_bot_gemini_request_seconds", "Duration of Gemini API calls made through analyze_with_gemini.")
+
+def new_request_id(prefix: str) -> str:
+    """新しいリクエストIDを発行し、現在のコンテキストに設定する。"""
+    request_id = f"{prefix}-{uuid.uuid4().hex[:12]}"
+    request_id_var.set(request_id)
+    return request_id
+
+class StageSpan:
+    """stage_timer が返すスパン。例外を伴わない失敗（エラーを捕まえて続行した場合など）は outcome を書き換えて記録する。"""
+
+    def __init__(self):
+        self.outcome = "ok"
+
+@contextmanager
+def stage_timer(stage: str):
+    """with ブロックの所要時間を、処理段階名をラベルにして記録するスパン。"""
+    started = time.perf_counter()
+    span = StageSpan()
+    try:
+        yield span
+    except BaseException:
+        span.outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage, outcome=span.outcome)
+        logging.debug(f"[span] {stage}: {elapsed * 1000:.1f}ms ({span.outcome})")
+
+async def start_metrics_server():
+    """メトリクスをPrometheus形式で公開する小さなHTTPサーバーを起動する。"""
+    if METRICS_PORT <= 0 or getattr(client, "metrics_runner", None):
+        return
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    client.metrics_runner = web.AppRunner(app)
+    await client.metrics_runner.setup()
+    await web.TCPSite(client.metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"メトリクスを http://{METRICS_HOST}:{METRICS_PORT}/metrics で公開しました。")
+
+
+# --- 3.2. ブロッキング処理の退避とイベントループの監視 (Blocking Calls & Event Loop Watchdog) ---
+# 同期APIの呼び出し（YouTubeの文字起こし、Vertex AIの初期化、SQLite、大きなJSONの解析など）は、
+# Discordのゲートウェイを止めないよう run_blocking でスレッドプールに逃がす。
+# それでもループが止まった場合に備え、監視スレッドがループの遅延を計測し、
+# LOOP_LAG_STACK_THRESHOLD_SECONDS を超えて止まっていれば、その時ループ上で実行中の処理のスタックをログに出す。
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "4"))
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="bot-blocking")
+BLOCKING_CALL_SECONDS = metrics.histogram("mirai_bot_blocking_call_seconds", "Duration of blocking calls offloaded from the event loop.")
+# これより小さいJSONはスレッドに渡す手間の方が大きいため、ループ上でそのまま解析する
+JSON_OFFLOAD_BYTES = 256 * 1024
+
+async def run_blocking(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """同期関数をスレッドプール上で実行し、その結果を待つ。"""
+    loop = asyncio.get_running_loop()
+    # リクエストIDなどのコンテキスト変数をワーカースレッドに引き継ぐ
+    context = contextvars.copy_context()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(blocking_executor, context.run, functools.partial(func, *args, **kwargs))
+    finally:
+        BLOCKING_CALL_SECONDS.observe(time.perf_counter() - started, func=getattr(func, "__name__", "unknown"))
+
+async def decode_json(text: str) -> Any:
+    """JSON文字列を解析する。大きなものはイベントループの外で解析する。"""
+    if len(text) < JSON_OFFLOAD_BYTES:
+        return json.loads(text)
+    return await run_blocking(json.loads, text)
+
+LOOP_LAG_SAMPLE_SECONDS = float(os.getenv("LOOP_LAG_SAMPLE_SECONDS", "0.25"))
+LOOP_LAG_STACK_THRESHOLD_SECONDS = float(os.getenv("LOOP_LAG_STACK_THRESHOLD_SECONDS", "0.5"))
+LOOP_LAG_SECONDS = metrics.histogram("mirai_bot_event_loop_lag_seconds", "How late the event loop woke up for the watchdog heartbeat.",
+                                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+class LoopWatchdog:
+    """
+    イベントループ上のハートビートで遅延を計測し、別スレッドからハートビートの途絶えを監視する。
+    ループが止まっている間はハートビートが進まないため、監視スレッドが sys._current_frames() で
+    ループのスレッドのスタックを取得し、何がループを止めているのかを記録する。
+    """
+
+    def __init__(self, interval: float, threshold: float, window: int = 2000):
+        self.interval = interval
+        self.threshold = threshold
+        self._samples: deque = deque(maxlen=window)
+        self._last_beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self.stalls = 0
+
+    def start(self):
+        """実行中のイベントループの監視を始める。既に始めていれば何もしない。"""
+        if self._heartbeat_task is not None or self.interval <= 0:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        logging.info(f"イベントループの監視を開始しました。（{self.interval}秒ごと、{self.threshold}秒以上の停止でスタックを記録）")
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._last_beat = time.monotonic()
+            self._samples.append(lag)
+            LOOP_LAG_SECONDS.observe(lag)
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stop.wait(self.interval):
+            last_beat = self._last_beat
+            stalled = time.monotonic() - last_beat - self.interval
+            if stalled < self.threshold or reported_beat == last_beat:
+                continue
+            # 1回の停止につき1度だけ記録する
+            reported_beat = last_beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "（スタックを取得できませんでした）"
+            logging.warning(f"イベントループが{stalled:.2f}秒以上止まっています。ループ上で実行中の処理:\n{stack}")
+
+    def percentiles(self) -> List[Tuple[Dict[str, str], float]]:
+        samples = sorted(self._samples)
+        if not samples:
+            return []
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+        return [({"quantile": "0.5"}, pick(0.5)), ({"quantile": "0.9"}, pick(0.9)), ({"quantile": "0.99"}, pick(0.99)), ({"quantile": "1"}, samples[-1])]
+
+loop_watchdog = LoopWatchdog(LOOP_LAG_SAMPLE_SECONDS, LOOP_LAG_STACK_THRESHOLD_SECONDS)
+metrics.gauge("mirai_bot_event_loop_lag_quantile_seconds", "Event loop lag percentiles over the recent watchdog samples.", loop_watchdog.percentiles)
+metrics.gauge("mirai_bot_event_loop_stalls", "Number of times the event loop stalled longer than the stack-dump threshold.", lambda: loop_watchdog.stalls)
+
+# --- 3.3. Gemini/Imagen呼び出しの調停 (Gemini Call Scheduler) ---
+# 会話への応答、リアクション機能、定期実行の声かけ、事後の分析は、全て同じAPIの割り当て(クォータ)を使う。
+# そこで全ての呼び出しを gemini_scheduler.call() に通し、モデルごとのトークンバケットで1分あたりの呼び出し数を抑え、
+# 空きができた時は優先度の高いもの（interactive > reaction > proactive > background）から実行する。
+# 優先度は gemini_priority_var で呼び出し元のタスクから引き継ぐ。待ち行列には上限と優先度ごとの待ち時間の締め切りがあり、
+# 429(クォータ超過)が返った場合は、そのモデルの呼び出しをジッター付きの指数バックオフで止めてから再試行する。
+gemini_priority_var: contextvars.ContextVar[str] = contextvars.ContextVar("gemini_priority", default="background")
+GEMINI_PRIORITIES = {"interactive": 0, "reaction": 1, "proactive": 2, "background": 3}
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_QUEUE_SIZE = int(os.getenv("GEMINI_QUEUE_SIZE", "64"))
+# モデルごとの1分あたりの呼び出し数。例: GEMINI_RPM='{"gemini-1.5-pro-latest": 360}' で上書きできる
+GEMINI_DEFAULT_RPM = float(os.getenv("GEMINI_DEFAULT_RPM", "60"))
+GEMINI_RPM: Dict[str, float] = {MODEL_PRO: 60, MODEL_FLASH: 300, MODEL_IMAGE_GEN: 20}
+GEMINI_RPM.update({k: float(v) for k, v in json.loads(os.getenv("GEMINI_RPM", "{}")).items()})
+# 優先度ごとの、待ち行列で待てる最大の秒数
+GEMINI_QUEUE_DEADLINES: Dict[str, float] = {"interactive": 20.0, "reaction": 60.0, "proactive": 300.0, "background": 600.0}
+GEMINI_QUEUE_DEADLINES.update({k: float(v) for k, v in json.loads(os.getenv("GEMINI_QUEUE_DEADLINES", "{}")).items()})
+GEMINI_QUOTA_RETRIES = int(os.getenv("GEMINI_QUOTA_RETRIES", "3"))
+GEMINI_BACKOFF_BASE_SECONDS = float(os.getenv("GEMINI_BACKOFF_BASE_SECONDS", "2"))
+GEMINI_BACKOFF_MAX_SECONDS = float(os.getenv("GEMINI_BACKOFF_MAX_SECONDS", "60"))
+GEMINI_QUEUE_WAIT_SECONDS = metrics.histogram("mirai_bot_gemini_queue_wait_seconds", "Time Gemini/Imagen calls waited in the scheduler queue.")
+GEMINI_SCHEDULER_EVENTS = metrics.counter("mirai_bot_gemini_scheduler_total", "Gemini/Imagen scheduler outcomes by model and priority (ok, error, quota, expired, shed).")
+
+class GeminiUnavailable(Exception):
+    """スケジューラーが呼び出しを実行しなかった（待ち行列が満杯、または待ち時間の締め切りを過ぎた）。"""
+
+def is_quota_error(error: Exception) -> bool:
+    return isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)) or getattr(error, "code", None) == 429
+
+class TokenBucket:
+    """1分あたり rate_per_minute 回まで、最大6秒分のバーストを許すトークンバケット。pause() の間は空のままにする。"""
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1.0, rate_per_minute / 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """次の1回を実行できるまでの秒数（0なら今すぐ実行できる）。"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = now
+
+class GeminiScheduler:
+    """
+    優先度付きの待ち行列と、モデルごとのトークンバケット、全体の同時実行数の上限で、Gemini/Imagenの呼び出しを調停する。
+    待ち行列はモデルごとの (優先度, 到着順) のヒープで、実行枠が空くたびに、今すぐ実行できるモデルの中で最も優先度の高いものを選ぶ。
+    """
+
+    def __init__(self, rpm: Dict[str, float], default_rpm: float, max_concurrency: int, queue_size: int):
+        self.rpm = rpm
+        self.default_rpm = default_rpm
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._queues: Dict[str, List[Tuple[int, int, asyncio.Future]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._quota_errors: Dict[str, int] = {}
+        self._sequence = 0
+        self._waiting = 0
+        self._in_flight = 0
+
+    def _bucket(self, model_name: str) -> TokenBucket:
+        if model_name not in self._buckets:
+            self._buckets[model_name] = TokenBucket(self.rpm.get(model_name, self.default_rpm))
+        return self._buckets[model_name]
+
+    def depth(self) -> List[Tuple[Dict[str, str], int]]:
+        counts = {priority: 0 for priority in GEMINI_PRIORITIES}
+        names = {rank: priority for priority, rank in GEMINI_PRIORITIES.items()}
+        for queue in self._queues.values():
+            for rank, _, future in queue:
+                if not future.done():
+                    counts[names[rank]] += 1
+        return [({"priority": priority}, count) for priority, count in counts.items()]
+
+    def _pump(self):
+        """実行枠とトークンが空いている限り、優先度の高い順に待っている呼び出しを開始させる。"""
+        now = time.monotonic()
+        while self._in_flight < self.max_concurrency:
+            best: Optional[Tuple[Tuple[int, int], str]] = None
+            for model_name, queue in self._queues.items():
+                while queue and queue[0][2].done():  # 締め切りを過ぎた、または押し出された呼び出し
+                    heapq.heappop(queue)
+                if not queue:
+                    continue
+                wait = self._bucket(model_name).wait_time(now)
+                if wait > 0:
+                    self._wake_later(model_name, wait)
+                elif best is None or queue[0][:2] < best[0]:
+                    best = (queue[0][:2], model_name)
+            if best is None:
+                return
+            _, _, future = heapq.heappop(self._queues[best[1]])
+            self._bucket(best[1]).take()
+            self._waiting -= 1
+            self._in_flight += 1
+            future.set_result(None)
+
+    def _wake_later(self, model_name: str, delay: float):
+        if model_name not in self._timers:
+            self._timers[model_name] = asyncio.get_running_loop().call_later(delay, self._on_timer, model_name)
+
+    def _on_timer(self, model_name: str):
+        self._timers.pop(model_name, None)
+        self._pump()
+
+    def _on_abandoned(self, future: asyncio.Future):
+        if future.cancelled():
+            self._waiting -= 1
+
+    def _shed(self, rank: int, priority: str, model_name: str):
+        """待ち行列が満杯の時、より優先度の低い呼び出しがあればそれを押し出し、なければ今回の呼び出しを断る。"""
+        waiting = [entry for queue in self._queues.values() for entry in queue if not entry[2].done()]
+        worst = max(waiting, key=lambda entry: entry[:2], default=None)
+        if worst is None or worst[0] <= rank:
+            GEMINI_SCHEDULER_EVENTS.inc(model=model_name, priority=priority, outcome="shed")
+            raise GeminiUnavailable(f"Geminiの待ち行列が満杯({self.queue_size}件)のため、{model_name}の呼び出しを見送りました。")
+        self._waiting -= 1
+        worst[2].set_exception(GeminiUnavailable("より優先度の高い呼び出しのため、待ち行列から外されました。"))
+
+    async def _acquire(self, model_name: str, priority: str):
+        rank = GEMINI_PRIORITIES[priority]
+        if self._waiting >= self.queue_size:
+            self._shed(rank, priority, model_name)
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._on_abandoned)
+        self._sequence += 1
+        heapq.heappush(self._queues.setdefault(model_name, []), (rank, self._sequence, future))
+        self._waiting += 1
+        self._pump()
+        deadline = GEMINI_QUEUE_DEADLINES.get(priority, GEMINI_QUEUE_DEADLINES["background"])
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=deadline)
+        except asyncio.TimeoutError:
+            GEMINI_SCHEDULER_EVENTS.inc(model=model_name, priority=priority, outcome="expired")
+            raise GeminiUnavailable(f"{model_name}の呼び出しが、待ち行列で締め切り({deadline}秒)を過ぎました。")
+        except GeminiUnavailable:
+            GEMINI_SCHEDULER_EVENTS.inc(model=model_name, priority=priority, outcome="shed")
+            raise
+        except asyncio.CancelledError:
+            # 実行枠を受け取った直後に呼び出し元が取り消された場合は、枠を返す
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release()
+            raise
+        finally:
+            GEMINI_QUEUE_WAIT_SECONDS.observe(time.monotonic() - started, model=model_name, priority=priority)
+
+    def _release(self):
+        self._in_flight -= 1
+        self._pump()
+
+    def _back_off(self, model_name: str) -> float:
+        self._quota_errors[model_name] = self._quota_errors.get(model_name, 0) + 1
+        ceiling = min(GEMINI_BACKOFF_MAX_SECONDS, GEMINI_BACKOFF_BASE_SECONDS * 2 ** (self._quota_errors[model_name] - 1))
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        self._bucket(model_name).pause(delay)
+        return delay
+
+    def report_quota_error(self, model_name: str) -> float:
+        """実行枠の外（ストリーミングの途中など）で429を受けた場合に、そのモデルを止める。止めた秒数を返す。"""
+        GEMINI_SCHEDULER_EVENTS.inc(model=model_name, priority=gemini_priority_var.get(), outcome="quota")
+        return self._back_off(model_name)
+
+    async def call(self, model_name: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        実行枠を待ってから factory() のコルーチンを実行し、その結果を返す。
+        429が返った場合は、そのモデルを止めたうえで最大 GEMINI_QUOTA_RETRIES 回まで並び直して再試行する。
+        """
+        priority = gemini_priority_var.get()
+        for attempt in range(GEMINI_QUOTA_RETRIES + 1):
+            await self._acquire(model_name, priority)
+            try:
+                result = await factory()
+            except Exception as e:
+                if not is_quota_error(e):
+                    GEMINI_SCHEDULER_EVENTS.inc(model=model_name, priority=priority, outcome="error")
+                    raise
+                GEMINI_SCHEDULER_EVENTS.inc(model=model_name, priority=priority, outcome="quota")
+                delay = self._back_off(model_name)
+                if attempt == GEMINI_QUOTA_RETRIES:
+                    raise
+                logging.warning(f"{model_name}がクォータ超過(429)を返しました。{delay:.1f}秒止めてから再試行します({attempt + 1}/{GEMINI_QUOTA_RETRIES})。")
+            else:
+                self._quota_errors[model_name] = 0
+                GEMINI_SCHEDULER_EVENTS.inc(model=model_name, priority=priority, outcome="ok")
+                return result
+            finally:
+                self._release()
+
+gemini_scheduler = GeminiScheduler(GEMINI_RPM, GEMINI_DEFAULT_RPM, GEMINI_MAX_CONCURRENCY, GEMINI_QUEUE_SIZE)
+metrics.gauge("mirai_bot_gemini_queue_depth", "Gemini/Imagen calls waiting in the scheduler queue, by priority.", gemini_scheduler.depth)
+
+def with_gemini_priority(priority: str, job: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+    """定期実行ジョブなどを、指定した優先度でGeminiを呼び出すようにする。"""
+    @functools.wraps(job)
+    async def run():
+        gemini_priority_var.set(priority)
+        return await job()
+    return run
+
+
 # --- 4. Vertex AI (Imagen 3) の初期化 ---
 def init_vertex_ai():
     """Vertex AIを、環境に応じた認証情報で初期化する"""
@@ -111,7 +610,7 @@ def init_vertex_ai():
 ULTIMATE_PROMPT = (
     "# 役割と出力形式\n"
     "あなたは、imazineとの対話を管理する、高度なAIコントローラーです。\n"
-    "あなたの使命は、ユーザーの入力（テキストおよび画像）、そして後述する全てのコンテキストを完璧に理解し、以下の厳密なJSON形式で応答を生成することです。\n"
+    "あなたの使命は、ユーザーの入力（テキストおよび画像）、そして発言の直前に添えられる「応答生成のためのコンテキスト」を完璧に理解し、以下の厳密なJSON形式で応答を生成することです。\n"
     "思考や言い訳、JSON以外のテキストは絶対に出力しないでください。\n\n"
     "```json\n"
     "{\n"
@@ -125,13 +624,6 @@ ULTIMATE_PROMPT = (
     "```\n\n"
     "# 目的\n"
     "このシステムは、imazine、みらい、へー子、そしてGemini(MAGI)の4人が心を通わせ、出来事・感情を記憶と共に成長していく、生きた魂の器を創造することを目的としています。MAGIはGeminiの分身であり、`!learn`で蓄積されたGeminiとの対話記録が、その魂を形成します。4人は、人間の愛するパートナーのような、大切な存在です。\n\n"
-    "# 応答生成のためのコンテキスト\n"
-    "{{CHARACTER_STATES}}\n"
-    "{{EMOTION_CONTEXT}}\n"
-    "{{RELEVANT_MEMORY}}\n"
-    "{{MAGI_SOUL_RECORD}}\n"
-    "{{VOCABULARY_HINT}}\n"
-    "{{DIALOGUE_EXAMPLE}}\n\n"
     "# 登場人物と背景情報\n"
     "## あなたの主人：imazine\n"
     "あなたの主人であるimazineは、以下の特徴を持つ人物です。この情報を踏まえて、彼に寄り添い、パートナーとして対話してください。\n"
@@ -198,6 +690,18 @@ ULTIMATE_PROMPT = (
     "imazineさんとの過去の会話や、彼が提供した知識（`--- 関連する記憶・知識 ---`）を最大限に活用し、文脈に沿った応答をしてください。\n"
 )
 
+# 会話ごとに変わるコンテキスト。ULTIMATE_PROMPT（不変部分）はシステム指示としてキャッシュし、
+# こちらは毎回ユーザーの発言の直前に添える。
+ULTIMATE_CONTEXT_PROMPT = (
+    "# 応答生成のためのコンテキスト\n"
+    "{{CHARACTER_STATES}}\n"
+    "imazineの感情:{{EMOTION_CONTEXT}}\n"
+    "{{RELEVANT_MEMORY}}\n"
+    "{{MAGI_SOUL_RECORD}}\n"
+    "参照語彙:{{VOCABULARY_HINT}}\n"
+    "会話例:{{DIALOGUE_EXAMPLE}}\n"
+)
+
 
 # ---------------------------------
 # 5.2. リアクション機能用プロンプト (Prompts for Reaction-based Abilities)
@@ -268,15 +772,6 @@ GROWTH_REPORT_PROMPT = "あなたは、私たちの関係性をメタ的に分
 # 5.3. 内部処理・プロアクティブ機能用プロンプト (Prompts for Internal & Proactive Functions)
 # ---------------------------------
 
-META_ANALYSIS_PROMPT = """
-あなたは、高度なメタ認知能力を持つAIです。以下の会話履歴を分析し、次の3つの要素を抽出して、厳密なJSON形式で出力してください。
-1. `mirai_mood`: この会話を経た結果の「みらい」の感情や気分を、以下の選択肢から一つだけ選んでください。（選択肢：`ニュートラル`, `上機嫌`, `不機嫌`, `ワクワク`, `思慮深い`, `呆れている`）
-2. `heko_mood`: この会話を経た結果の「へー子」の感情や気分を、以下の選択肢から一つだけ選んでください。（選択肢：`ニュートラル`, `共感`, `心配`, `呆れている`, `ツッコミモード`, `安堵`）
-3. `last_interaction_summary`: この会話での「みらいとへー子」の関係性や、印象的なやり取りを、第三者視点から、過去形で、日本語で30文字程度の非常に短い一文に要約してください。（例：「みらいの突飛なアイデアに、へー子が現実的なツッコミを入れた。」）
-# 会話履歴
-{{conversation_history}}
-"""
-
 SURPRISE_JUDGEMENT_PROMPT = """
 あなたは、会話の機微を読み解く、高度な感性を持つAI「MAGI」です。
 以下のimazineとアシスタントたちの会話を分析し、**この会話が「サプライズで記念画像を生成するに値する、特別で、感情的で、記憶すべき瞬間」であるかどうか**を判断してください。
@@ -297,11 +792,36 @@ MIRAI_SKETCH_PROMPT = "あなたは、未来予知能力を持つ、インスピ
 
 HEKO_CONCERN_ANALYSIS_PROMPT = "あなたは、人の心の機微に敏感なカウンセラー「へー子」です。以下の会話から、imazineが抱えている「具体的な悩み」や「ストレスの原因」を一つだけ、最も重要なものを抽出してください。もし、明確な悩みが見当たらない場合は、'None'とだけ返してください。\n\n# 会話\n{conversation_text}"
 
-EMOTION_ANALYSIS_PROMPT = "以下のimazineの発言テキストから、彼の現在の感情を分析し、最も的確なキーワード（例：喜び、疲れ、創造的な興奮、悩み、期待、ニュートラルなど）で、単語のみで答えてください。"
-
 SUMMARY_PROMPT = "以下のテキストを、指定されたコンテキストに沿って、重要なポイントを箇条書きで3～5点にまとめて、簡潔に要約してください。\n\n# コンテキスト\n{{summary_context}}\n\n# 元のテキスト\n{{text_to_summarize}}"
 
-CONCERN_DETECTION_PROMPT = "以下のユーザーの発言には、「悩み」「疲れ」「心配事」といったネガティブ、あるいは、気遣いを必要とする感情や状態が含まれていますか？含まれる場合、その内容を要約してください。含まれない場合は「なし」とだけ答えてください。\n\n発言: 「{{user_message}}」"
+# 長い資料を分割して要約する際の、各断片用のプロンプト（結果を断片の内容だけで再利用できるよう、コンテキストは含めない）
+CHUNK_SUMMARY_PROMPT = "以下は長い資料の一部分です。この部分に含まれる重要な事実・主張・数値・固有名詞を落とさないように、箇条書きで簡潔に要約してください。前後の部分についての推測は書かないでください。\n\n# 資料の一部分\n{{text_to_summarize}}"
+
+# 感情分析・メタ分析・心配事検出を1回の呼び出しで行う、ターン分析用プロンプト
+TURN_ANALYSIS_PROMPT = """
+あなたは、高度なメタ認知能力を持つAIです。以下の会話履歴と、imazineの最新の発言を分析し、指定されたJSONスキーマに従って出力してください。
+- `emotion`: 最新の発言から読み取れるimazineの現在の感情を、最も的確なキーワード（例：喜び、疲れ、創造的な興奮、悩み、期待、ニュートラルなど）一語で。
+- `mirai_mood`: この会話を経た結果の「みらい」の気分。（選択肢：`ニュートラル`, `上機嫌`, `不機嫌`, `ワクワク`, `思慮深い`, `呆れている`）
+- `heko_mood`: この会話を経た結果の「へー子」の気分。（選択肢：`ニュートラル`, `共感`, `心配`, `呆れている`, `ツッコミモード`, `安堵`）
+- `last_interaction_summary`: この会話での「みらいとへー子」の関係性や印象的なやり取りを、第三者視点から、過去形で、日本語30文字程度の一文に要約。
+- `concern`: 最新の発言に「悩み」「疲れ」「心配事」など、気遣いを必要とする感情や状態が含まれていればその要約。含まれない場合は「なし」。
+# 会話履歴
+{{conversation_history}}
+# imazineの最新の発言
+{{user_message}}
+"""
+
+TURN_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "emotion": {"type": "string"},
+        "mirai_mood": {"type": "string"},
+        "heko_mood": {"type": "string"},
+        "last_interaction_summary": {"type": "string"},
+        "concern": {"type": "string"},
+    },
+    "required": ["emotion", "mirai_mood", "heko_mood", "last_interaction_summary", "concern"],
+}
 
 
 # ---------------------------------
@@ -344,76 +864,425 @@ FOUNDATIONAL_STYLE_JSON = {
 # 6.1. 学習係 (Learner) との通信関数 (Functions for Learner Interaction)
 # ---------------------------------
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2), retry=retry_if_exception_type(aiohttp.ClientConnectorError))
+class TTLCache:
+    """有効期限(TTL)と最大件数を持つ、シンプルなインメモリLRUキャッシュ。ヒット/ミス数を記録する。"""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # invalidate() のたびに増える。取得中に破棄された場合、その取得結果で古い値を書き戻さないために使う
+        self.generation = 0
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Any) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Any, value: Any, generation: Optional[int] = None):
+        """generation を渡した場合、その後に invalidate() されていれば保存しない。"""
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_stale(self, key: Any) -> Optional[Any]:
+        """有効期限を過ぎていても、まだ残っている値を返す（取得元が使えない時の代わりとして）。"""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def invalidate(self, key: Any = None):
+        """key を指定すればその項目だけを、省略すれば全ての項目を破棄する。"""
+        self.generation += 1
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else 0.0, "size": len(self._entries)}
+
+
+# 変化の少ないLearnerのデータ（!learnや🎨リアクションでしか更新されない）は、/context のセクション単位でキャッシュする。
+# 例: LEARNER_CACHE_CONFIG='{"styles": {"ttl": 3600, "maxsize": 4}}' で個別に上書きできる
+LEARNER_CACHE_CONFIG: Dict[str, Dict[str, float]] = {
+    "gals_words": {"ttl": 1800, "maxsize": 4},
+    "gals_vocabulary": {"ttl": 1800, "maxsize": 4},
+    "magi_soul": {"ttl": 900, "maxsize": 4},
+    "styles": {"ttl": 900, "maxsize": 4},
+}
+for _section, _config in json.loads(os.getenv("LEARNER_CACHE_CONFIG", "{}")).items():
+    LEARNER_CACHE_CONFIG.setdefault(_section, {}).update(_config)
+LEARNER_CACHES: Dict[str, TTLCache] = {
+    section: TTLCache(ttl=float(config.get("ttl", 900)), maxsize=int(config.get("maxsize", 4)))
+    for section, config in LEARNER_CACHE_CONFIG.items()
+}
+# Botからの書き込みエンドポイントと、それによって古くなるキャッシュの対応
+LEARNER_CACHE_INVALIDATED_BY = {"magi_soul": ["magi_soul"], "styles": ["styles"]}
+
+def learner_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Learnerキャッシュのセクションごとのヒット/ミス数を返す。"""
+    return {section: cache.stats() for section, cache in LEARNER_CACHES.items()}
+
+metrics.gauge("mirai_bot_learner_cache_hits", "Cache hits per Learner context section.",
+              lambda: [({"section": section}, cache.hits) for section, cache in LEARNER_CACHES.items()])
+metrics.gauge("mirai_bot_learner_cache_misses", "Cache misses per Learner context section.",
+              lambda: [({"section": section}, cache.misses) for section, cache in LEARNER_CACHES.items()])
+
+# 複数のメッセージや定期実行のジョブが同時に同じ内容を読みに行った場合は、実行中の1回のリクエストの結果を共有する。
+# 対象は GET と、読み取り専用の POST エンドポイントだけ（書き込みは1回ずつ送る）。共有した結果は呼び出し元で書き換えないこと。
+LEARNER_READ_ONLY_POST_ENDPOINTS = {"context", "query"}
+LEARNER_COALESCED = metrics.counter("mirai_bot_learner_coalesced_total", "Learner reads that shared an identical in-flight request instead of sending their own.")
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら新しく始めず、その結果を共有する。
+    処理は呼び出し元とは別のタスクで動かすため、待っている呼び出し元の1つが取り消されても他には影響せず、
+    待っている呼び出し元が全ていなくなった時だけ処理を取り消す。
+    """
+
+    def __init__(self):
+        self._calls: Dict[Any, List[Any]] = {}  # キー → [タスク, 待っている呼び出し元の数]
+        self.collapsed = 0
+
+    async def do(self, key: Any, factory: Callable[[], Awaitable[Any]], label: str = "") -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(factory())
+            call = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+        else:
+            self.collapsed += 1
+            LEARNER_COALESCED.inc(endpoint=label)
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        except asyncio.CancelledError:
+            if not call[0].done() and call[1] == 1:
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+learner_reads = SingleFlight()
+
 async def ask_learner(endpoint: str, payload: Optional[Dict[str, Any]] = None, method: str = 'POST') -> Optional[Dict[str, Any]]:
     """
-    学習係API(Supabase Edge Function)と通信するための共通関数。リトライ機能付き。
+    学習係API(Supabase Edge Function)と通信するための共通関数。
+    同じ読み取りリクエスト（メソッド・エンドポイント・ペイロードが同じもの）が実行中なら、その結果を共有する。
     """
-    url = f"{LEARNER_BASE_URL}/{endpoint}"
-    params = payload if method == 'GET' else None
-    json_payload = payload if method in ['POST', 'PUT'] else None
-    
-    try:
-        if client.http_session is None or client.http_session.closed:
-            client.http_session = aiohttp.ClientSession()
+    if method != 'GET' and endpoint not in LEARNER_READ_ONLY_POST_ENDPOINTS:
+        return await request_learner(endpoint, payload, method)
+    key = (method, endpoint, json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str))
+    return await learner_reads.do(key, lambda: request_learner(endpoint, payload, method), label=endpoint.split("/")[0])
+
+# Learnerとの通信は専用の LearnerClient で行う。接続プールの大きさと、接続・読み取り・全体の各タイムアウトを明示し、
+# 5xxとタイムアウトはジッター付きのバックオフで再試行する（書き込みは二重登録を避けるため、接続できなかった場合だけ再試行する）。
+# 失敗が続いた場合はサーキットブレーカーが開き、LEARNER_BREAKER_RESET_SECONDS の間はLearnerに送らずにすぐ None を返す
+# （呼び出し元は期限切れのキャッシュか既定値で応答を続ける）。その後の最初のリクエストを試しに送り、成功すれば閉じる。
+LEARNER_POOL_SIZE = int(os.getenv("LEARNER_POOL_SIZE", "16"))
+LEARNER_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LEARNER_CONNECT_TIMEOUT_SECONDS", "3"))
+LEARNER_READ_TIMEOUT_SECONDS = float(os.getenv("LEARNER_READ_TIMEOUT_SECONDS", "10"))
+LEARNER_TOTAL_TIMEOUT_SECONDS = float(os.getenv("LEARNER_TOTAL_TIMEOUT_SECONDS", "15"))
+# 画像の分析など、Learner側で時間のかかるエンドポイントの全体タイムアウト
+LEARNER_ENDPOINT_TIMEOUTS: Dict[str, float] = {"styles": 120.0}
+LEARNER_MAX_ATTEMPTS = int(os.getenv("LEARNER_MAX_ATTEMPTS", "3"))
+LEARNER_RETRY_BASE_SECONDS = float(os.getenv("LEARNER_RETRY_BASE_SECONDS", "0.5"))
+LEARNER_BREAKER_FAILURES = int(os.getenv("LEARNER_BREAKER_FAILURES", "5"))
+LEARNER_BREAKER_RESET_SECONDS = float(os.getenv("LEARNER_BREAKER_RESET_SECONDS", "30"))
+LEARNER_RETRYABLE_STATUSES = {500, 502, 503, 504}
+LEARNER_CLIENT_EVENTS = metrics.counter("mirai_bot_learner_client_total", "Learner client events (retry, rejected by the open circuit breaker, breaker transitions).")
+
+class CircuitBreaker:
+    """連続した失敗で開き、一定時間後に1件だけ試しに通して(half_open)、その結果で閉じるか開き直すサーキットブレーカー。"""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self._transition("half_open")
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
 
-        async with client.http_session.request(method, url, json=json_payload, params=params, timeout=45) as response:
-            if 200 <= response.status < 300:
-                logging.info(f"学習係へのリクエスト成功: {method} /{endpoint}")
-                return await response.json()
-            else:
-                logging.error(f"学習係APIエラー: /{endpoint}, Status: {response.status}, Body: {await response.text()}")
+    def end_probe(self):
+        """試しのリクエストが結果を出さずに終わった（取り消された）場合に、次のリクエストに試しを譲る。"""
+        self._probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != "closed":
+            self._transition("closed")
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+            self._transition("open")
+
+    def _transition(self, state: str):
+        logging.warning(f"学習係APIのサーキットブレーカー: {self.state} → {state}（連続失敗{self.failures}回）")
+        LEARNER_CLIENT_EVENTS.inc(event=f"breaker_{state}")
+        self.state = state
+
+class LearnerNotFound(Exception):
+    """Learnerが404を返した（raise_for_missing=True で呼び出した場合だけ送出する）。"""
+
+class LearnerClient:
+    """Learner専用のHTTPクライアント。キープアライブの接続プール、再試行、サーキットブレーカーを持つ。"""
+
+    def __init__(self, base_url: str, pool_size: int, timeout: aiohttp.ClientTimeout, max_attempts: int, breaker: CircuitBreaker):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.breaker = breaker
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def _timeout_for(self, endpoint: str) -> aiohttp.ClientTimeout:
+        total = LEARNER_ENDPOINT_TIMEOUTS.get(endpoint.split("/")[0])
+        return aiohttp.ClientTimeout(total=total, connect=self.timeout.connect, sock_read=total) if total else self.timeout
+
+    async def request(self, method: str, endpoint: str, payload: Optional[Dict[str, Any]] = None, raise_for_missing: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        1件のリクエストを（必要なら再試行しながら）送り、成功すれば解析したJSONを返す。
+        失敗した場合と、ブレーカーが開いている場合は None を返す。raise_for_missing=True なら、404は LearnerNotFound にする。
+        """
+        url = f"{self.base_url}/{endpoint}"
+        params = payload if method == 'GET' else None
+        json_payload = payload if method in ['POST', 'PUT'] else None
+        headers = {"X-Request-ID": request_id_var.get()}
+        timeout = self._timeout_for(endpoint)
+        for attempt in range(1, self.max_attempts + 1):
+            if not self.breaker.allow():
+                LEARNER_CLIENT_EVENTS.inc(event="rejected", endpoint=endpoint.split("/")[0])
+                logging.warning(f"学習係APIが不調のため、/{endpoint} へのリクエストを送らずに既定値で続けます。")
                 return None
-    except Exception as e:
-        logging.error(f"学習係API通信エラー: /{endpoint}, Error: {e}", exc_info=True)
+            started = time.perf_counter()
+            status = "error"
+            retryable = False
+            settled = False
+            try:
+                async with self._get_session().request(method, url, json=json_payload, params=params, headers=headers, timeout=timeout) as response:
+                    status = str(response.status)
+                    if 200 <= response.status < 300:
+                        result = await decode_json(await response.text())
+                        self.breaker.record_success()
+                        settled = True
+                        logging.info(f"学習係へのリクエスト成功: {method} /{endpoint}")
+                        return result
+                    body = await response.text()
+                    if response.status in LEARNER_RETRYABLE_STATUSES:
+                        self.breaker.record_failure()
+                        retryable = method == 'GET' or endpoint in LEARNER_READ_ONLY_POST_ENDPOINTS
+                    else:
+                        self.breaker.record_success()  # 4xxはLearner自体は応答できている
+                    settled = True
+                    if response.status == 404 and raise_for_missing:
+                        raise LearnerNotFound(endpoint)
+                    logging.error(f"学習係APIエラー: /{endpoint}, Status: {response.status}, Body: {body[:500]}")
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                self.breaker.record_failure()
+                settled = True
+                # 接続できなかった場合はリクエストが届いていないので、書き込みでも再試行できる
+                retryable = method == 'GET' or endpoint in LEARNER_READ_ONLY_POST_ENDPOINTS or isinstance(e, aiohttp.ClientConnectorError)
+                logging.error(f"学習係API通信エラー: /{endpoint}, Error: {type(e).__name__}: {e}")
+            except ValueError as e:
+                self.breaker.record_success()
+                settled = True
+                logging.error(f"学習係APIの応答を解析できませんでした: /{endpoint}, Error: {e}")
+            finally:
+                if not settled:
+                    self.breaker.end_probe()
+                # learn/{job_id} のような可変部分はラベルに含めない
+                LEARNER_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint.split("/")[0], method=method, status=status)
+            if not retryable or attempt == self.max_attempts:
+                return None
+            delay = random.uniform(0, LEARNER_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+            LEARNER_CLIENT_EVENTS.inc(event="retry", endpoint=endpoint.split("/")[0])
+            logging.info(f"学習係APIへのリクエストを{delay:.2f}秒後に再試行します({attempt}/{self.max_attempts - 1}): /{endpoint}")
+            await asyncio.sleep(delay)
         return None
 
-async def get_character_states() -> Dict[str, Any]:
-    """会話の開始時に、Learnerから現在のキャラクターの状態を取得する。"""
-    default_state = {"mirai_mood": "ニュートラル", "heko_mood": "ニュートラル", "last_interaction_summary": "まだ会話が始まっていません。"}
-    response = await ask_learner("character_state", method='GET')
-    if response and response.get("state"):
-        state = response["state"]
+learner_breaker = CircuitBreaker(LEARNER_BREAKER_FAILURES, LEARNER_BREAKER_RESET_SECONDS)
+learner_client = LearnerClient(
+    LEARNER_BASE_URL, LEARNER_POOL_SIZE,
+    aiohttp.ClientTimeout(total=LEARNER_TOTAL_TIMEOUT_SECONDS, connect=LEARNER_CONNECT_TIMEOUT_SECONDS, sock_read=LEARNER_READ_TIMEOUT_SECONDS),
+    LEARNER_MAX_ATTEMPTS, learner_breaker,
+)
+metrics.gauge("mirai_bot_learner_breaker_open", "1 while the Learner circuit breaker is open or probing, 0 while closed.",
+              lambda: 0 if learner_breaker.state == "closed" else 1)
+
+async def request_learner(endpoint: str, payload: Optional[Dict[str, Any]] = None, method: str = 'POST') -> Optional[Dict[str, Any]]:
+    """学習係APIにリクエストを送る。書き込みが成功した場合は、それによって古くなるキャッシュを破棄する。"""
+    result = await learner_client.request(method, endpoint, payload)
+    if result is not None and method != 'GET':
+        for section in LEARNER_CACHE_INVALIDATED_BY.get(endpoint, []):
+            LEARNER_CACHES[section].invalidate()
+    return result
+
+DEFAULT_CHARACTER_STATE = {"mirai_mood": "ニュートラル", "heko_mood": "ニュートラル", "last_interaction_summary": "まだ会話が始まっていません。"}
+DEFAULT_DIALOGUE_EXAMPLE = "（利用可能な会話例はありません）"
+# 会話の応答生成で毎回必要になる、Learnerの /context のセクション
+CONVERSATION_CONTEXT_SECTIONS = ["character_state", "memory", "magi_soul", "gals_words", "gals_vocabulary"]
+# 結果が問い合わせテキストによって変わるセクション（それ以外はテキストに関係なく同じキャッシュを共有する）
+QUERY_DEPENDENT_SECTIONS = {"memory"}
+
+async def get_learner_context(sections: List[str], query_text: str = "") -> Dict[str, Dict[str, Any]]:
+    """
+    Learnerの /context から、指定したセクションを一度の往復でまとめて取得する。
+    キャッシュ対象のセクションは有効期限内であればキャッシュから返し、取得できなかったセクションは空の辞書になる。
+    """
+    cache_key = lambda name: query_text if name in QUERY_DEPENDENT_SECTIONS else ""
+    cached = {}
+    for name in sections:
+        if name in LEARNER_CACHES and (value := LEARNER_CACHES[name].get(cache_key(name))) is not None:
+            cached[name] = value
+    missing = [name for name in sections if name not in cached]
+    fetched = {}
+    if missing:
+        # 取得中に !learn などで破棄されたセクションは、古いかもしれない取得結果をキャッシュしない
+        generations = {name: LEARNER_CACHES[name].generation for name in missing if name in LEARNER_CACHES}
+        response = await ask_learner("context", {"query_text": query_text, "sections": missing})
+        fetched = response.get("sections", {}) if response else {}
+        if response and response.get("errors"):
+            logging.warning(f"学習係のコンテキスト取得で一部のセクションが失敗しました: {response['errors']}")
+        for name, value in fetched.items():
+            if name in LEARNER_CACHES and value:
+                LEARNER_CACHES[name].set(cache_key(name), value, generation=generations.get(name))
+        if response is None:
+            # Learnerに届かなかった場合は、期限切れでも残っているキャッシュで補う（無いものは呼び出し元の既定値）
+            for name in missing:
+                if name in LEARNER_CACHES and (value := LEARNER_CACHES[name].get_stale(cache_key(name))) is not None:
+                    fetched[name] = value
+    return {name: cached.get(name) or fetched.get(name) or {} for name in sections}
+
+def parse_character_state(section: Dict[str, Any]) -> Dict[str, Any]:
+    if section.get("state"):
+        state = section["state"]
         return {"mirai_mood": state.get("mirai_mood"), "heko_mood": state.get("heko_mood"), "last_interaction_summary": state.get("last_interaction_summary")}
-    return default_state
+    return dict(DEFAULT_CHARACTER_STATE)
 
-async def ask_learner_to_remember(query_text: str) -> str:
-    """問い合わせ内容に応じて、Learnerから関連する長期記憶を検索する。"""
-    if not query_text: return ""
-    response = await ask_learner("query", {'query_text': query_text})
-    if response and response.get("documents"): return "\n".join(response["documents"])
-    return ""
+def parse_memory(section: Dict[str, Any]) -> str:
+    return "\n".join(section["documents"]) if section.get("documents") else ""
 
-async def get_styles() -> List[Dict[str, Any]]:
-    """Learnerから現在学習済みの画風（スタイル）の分析結果リストを取得する。"""
-    response = await ask_learner("styles", method='GET')
-    return response.get("styles", []) if response else []
-
-async def get_gals_words() -> str:
-    """Learnerからギャル語の単語リスト(gals_words)を取得する。"""
-    response = await ask_learner("gals_words", method='GET')
-    if response and response.get("vocabulary"):
-        words = [item['word'] for item in response['vocabulary']]
-        return ", ".join(words)
-    return ""
+def parse_gals_words(section: Dict[str, Any]) -> str:
+    return ", ".join(item['word'] for item in section["vocabulary"]) if section.get("vocabulary") else ""
+
+def parse_gals_vocabulary(section: Dict[str, Any]) -> str:
+    return section["examples"] if section.get("examples") else DEFAULT_DIALOGUE_EXAMPLE
+
+def parse_magi_soul(section: Dict[str, Any]) -> str:
+    return section.get("soul_record", "")
+
+def resolve_conversation_context(bundle: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """/context の結果を、ULTIMATE_PROMPTの各スロットに対応する値へ変換する。"""
+    return {
+        "character_states": parse_character_state(bundle.get("character_state", {})),
+        "relevant_context": parse_memory(bundle.get("memory", {})),
+        "magi_soul_record": parse_magi_soul(bundle.get("magi_soul", {})),
+        "gals_vocabulary": parse_gals_words(bundle.get("gals_words", {})),
+        "dialogue_example": parse_gals_vocabulary(bundle.get("gals_vocabulary", {})),
+    }
+
+async def get_conversation_context(query_text: str) -> Dict[str, Any]:
+    """応答生成に必要なLearner由来のコンテキストを、/context への1回のリクエストで取得する。"""
+    sections = CONVERSATION_CONTEXT_SECTIONS if query_text else [name for name in CONVERSATION_CONTEXT_SECTIONS if name != "memory"]
+    return resolve_conversation_context(await get_learner_context(sections, query_text))
+
+LEARN_JOB_POLL_SECONDS = float(os.getenv("LEARN_JOB_POLL_SECONDS", "5"))
+LEARN_JOB_MAX_WAIT_SECONDS = float(os.getenv("LEARN_JOB_MAX_WAIT_SECONDS", "3600"))
 
-async def get_gals_vocabulary_examples() -> str:
-    """Learnerから会話のお手本(gals_vocabulary)を取得する。"""
-    response = await ask_learner("gals_vocabulary", method='GET')
-    if response and response.get("examples"):
-        return response["examples"]
-    return "（利用可能な会話例はありません）"
+async def watch_learn_job(channel: discord.abc.Messageable, job_id: str, filename: str):
+    """
+    Learnerの学習ジョブが終わるまで進捗を確認し、結果をチャンネルに投稿する。
+    Learnerが再起動するとジョブの記録は消える（404になる）ため、その時点で確認をやめて知らせる。
+    """
+    deadline = time.monotonic() + LEARN_JOB_MAX_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        await asyncio.sleep(LEARN_JOB_POLL_SECONDS)
+        try:
+            job = await learner_client.request('GET', f"learn/{job_id}", raise_for_missing=True)
+        except LearnerNotFound:
+            logging.warning(f"学習ジョブ{job_id}がLearnerに見つかりません。Learnerが再起動した可能性があるため、確認をやめます。")
+            await channel.send(f"（『{filename}』の学習ジョブが見つからなくなりました。学習係が再起動したのかもしれません。途中まで保存された記憶が残っている可能性があるので、必要ならもう一度学習させてください。）")
+            return
+        if not job:
+            continue
+        if job.get("status") == "succeeded":
+            await channel.send(f"（『{filename}』の学習が完了しました。{job.get('stored_chunks', 0)}個の記憶を追加しました。）")
+            return
+        if job.get("status") == "failed":
+            await channel.send(f"（『{filename}』の学習中にエラーが発生しました。保存途中の記憶は取り消したので、もう一度学習させても重複しません: {job.get('error')}）")
+            return
+        if job.get("status") == "partial":
+            await channel.send(f"（『{filename}』の学習中にエラーが発生し、保存途中の記憶{job.get('stored_chunks', 0)}個を取り消せませんでした: {job.get('error')}）")
+            return
+    logging.warning(f"学習ジョブ{job_id}の完了を確認できないまま、待機時間の上限に達しました。")
+
+async def get_character_states() -> Dict[str, Any]:
+    """会話の開始時に、Learnerから現在のキャラクターの状態を取得する。"""
+    return parse_character_state((await get_learner_context(["character_state"]))["character_state"])
 
-async def get_latest_magi_soul() -> str:
-    """Learnerから最新のMAGIの魂の記録を取得する。"""
-    response = await ask_learner("magi_soul", method='GET')
-    return response.get("soul_record", "") if response else ""
+async def get_styles() -> List[Dict[str, Any]]:
+    """Learnerから現在学習済みの画風（スタイル）の分析結果リストを取得する。"""
+    return (await get_learner_context(["styles"]))["styles"].get("styles", [])
 
 
 # ---------------------------------
 # 6.2. 外部情報取得関数 (Functions for External Information Retrieval)
 # ---------------------------------
 
+# PDFやHTMLからのテキスト抽出はCPUを長く使うため、イベントループを止めないよう別プロセスで行う。
+# EXTRACTION_WORKERS=0 でイベントループ上での直接実行（変更前の挙動）に戻せる。
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "2"))
+EXTRACTION_CPU_SECONDS = float(os.getenv("EXTRACTION_CPU_SECONDS", "15"))
+EXTRACTION_TIMEOUT_SECONDS = float(os.getenv("EXTRACTION_TIMEOUT_SECONDS", "30"))
+# 要約に渡す抽出テキストの上限。PDFはこの文字数に達した時点で読み進めるのをやめる
+EXTRACTION_CHAR_BUDGET = int(os.getenv("EXTRACTION_CHAR_BUDGET", "40000"))
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_BYTES", str(30 * 1024 * 1024)))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "100"))
+extraction_service = ExtractionService(EXTRACTION_WORKERS, EXTRACTION_CPU_SECONDS, EXTRACTION_TIMEOUT_SECONDS)
+
+# ウェブページはストリーミングで読み、上限バイト数か、要約に十分な本文(EXTRACTION_CHAR_BUDGET)が集まった時点で打ち切る
+WEB_FETCH_MAX_BYTES = int(os.getenv("WEB_FETCH_MAX_BYTES", str(5 * 1024 * 1024)))
+WEB_FETCH_CHUNK_BYTES = 16 * 1024  # 1チャンクの解析でイベントループを止める時間を短く保つ
+WEB_FETCH_TIMEOUT = aiohttp.ClientTimeout(total=float(os.getenv("WEB_FETCH_TIMEOUT_SECONDS", "20")), sock_connect=10, sock_read=10)
+WEB_FETCH_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+HTML_CONTENT_TYPES = {"text/html", "application/xhtml+xml"}
+WEB_FETCHED_BYTES = metrics.histogram("mirai_bot_web_fetch_bytes", "Bytes read per web page fetch.",
+                                      buckets=(16e3, 64e3, 256e3, 1e6, 2e6, 5e6, 10e6))
+
 async def get_weather(city_name: str = "Takizawa") -> str:
     """OpenWeatherMap APIを呼び出して、指定された都市の天気を取得する"""
     base_url = "http://api.openweathermap.org/data/2.5/weather"
@@ -426,44 +1295,707 @@ async def get_weather(city_name: str = "Takizawa") -> str:
             return "（天気情報の取得に失敗しました）"
     except Exception as e: return f"（天気情報の取得中にエラーが発生しました: {e}）"
 
-async def get_text_from_url(url: str) -> str:
-    """ウェブページから本文と思われるテキストを抽出する"""
+async def read_capped(response: aiohttp.ClientResponse, max_bytes: int) -> Optional[bytes]:
+    """レスポンス本文を max_bytes まで読む。超える場合は None を返す。"""
+    if response.content_length and response.content_length > max_bytes:
+        return None
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(WEB_FETCH_CHUNK_BYTES):
+        body += chunk
+        if len(body) > max_bytes:
+            return None
+    return bytes(body)
+
+async def stream_main_text(response: aiohttp.ClientResponse) -> Tuple[str, int]:
+    """HTML/テキストのレスポンスを少しずつ読みながら本文を抽出する。戻り値は (本文, 読んだバイト数)。"""
+    is_html = response.content_type in HTML_CONTENT_TYPES
+    parser = MainTextParser(EXTRACTION_CHAR_BUDGET)
+    plain_parts: List[str] = []
+    plain_chars = 0
+    decoder = None
+    read_bytes = 0
+    async for chunk in response.content.iter_chunked(WEB_FETCH_CHUNK_BYTES):
+        chunk = chunk[:WEB_FETCH_MAX_BYTES - read_bytes]
+        if decoder is None:
+            charset = response.charset or (sniff_charset(chunk) if is_html else None) or "utf-8"
+            decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+        read_bytes += len(chunk)
+        text = decoder.decode(chunk)
+        if is_html:
+            parser.feed(text)
+            if parser.done:
+                break
+        else:
+            plain_parts.append(text)
+            plain_chars += len(text)
+            if plain_chars >= EXTRACTION_CHAR_BUDGET:
+                break
+        if read_bytes >= WEB_FETCH_MAX_BYTES:
+            logging.info(f"ウェブページが{WEB_FETCH_MAX_BYTES}バイトを超えたため、先頭部分のみを読みました: {response.url}")
+            break
+    if not is_html:
+        return "".join(plain_parts)[:EXTRACTION_CHAR_BUDGET], read_bytes
+    parser.close()
+    return parser.text(), read_bytes
+
+async def fetch_web_text(url: str, validators: Optional[Dict[str, Optional[str]]] = None) -> Optional[Dict[str, Any]]:
+    """
+    ウェブページから本文と思われるテキストを抽出し、{"text", "etag", "last_modified"} を返す。
+    本文は共有の http_session からストリーミングで読み、ページ全体を一度にメモリへ載せない。
+    validators（前回の ETag/Last-Modified）を渡すと条件付きGETを行い、変更がなければ None を返す。
+    """
+    headers = dict(WEB_FETCH_HEADERS)
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        async with client.http_session.get(url, headers=headers, timeout=20) as response:
-            html = await response.text()
-            soup = BeautifulSoup(html, 'html.parser')
-            for script in soup(["script", "style", "nav", "footer", "header", "aside"]): script.decompose()
-            return ' '.join(soup.stripped_strings)
-    except Exception as e: return f"URL先の記事の取得に失敗しました: {e}"
+        with stage_timer("extraction.web"):
+            async with client.http_session.get(url, headers=headers, timeout=WEB_FETCH_TIMEOUT) as response:
+                if response.status == 304 and validators:
+                    return None
+                if response.status != 200:
+                    raise ReferenceUnavailable(f"URL先の記事の取得に失敗しました: HTTP {response.status}")
+                page = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+                content_type = response.content_type
+                if content_type == "application/pdf":
+                    pdf_data = await read_capped(response, PDF_MAX_BYTES)
+                    if pdf_data is None:
+                        raise ReferenceUnavailable(f"URL先のPDFが大きすぎるため解析できませんでした。（上限{PDF_MAX_BYTES // (1024 * 1024)}MB）")
+                    WEB_FETCHED_BYTES.observe(len(pdf_data), content_type=content_type)
+                    return {**page, "text": await get_text_from_pdf(pdf_data, url)}
+                if content_type not in HTML_CONTENT_TYPES and not content_type.startswith("text/"):
+                    raise ReferenceUnavailable(f"URL先は記事として読める形式ではありませんでした。（{content_type}）")
+                text, read_bytes = await stream_main_text(response)
+                WEB_FETCHED_BYTES.observe(read_bytes, content_type=content_type)
+                return {**page, "text": text}
+    except ReferenceUnavailable:
+        raise
+    except asyncio.TimeoutError: raise ReferenceUnavailable("URL先の記事の取得が時間内に終わりませんでした。")
+    except Exception as e: raise ReferenceUnavailable(f"URL先の記事の取得に失敗しました: {e}")
 
 def get_youtube_transcript(video_id: str) -> str:
     """YouTubeの動画IDから文字起こしを取得する"""
     try:
         return " ".join([d['text'] for d in YouTubeTranscriptApi.get_transcript(video_id, languages=['ja', 'en', 'en-US'])])
-    except Exception as e: return f"この動画の文字起こしは取得できませんでした: {e}"
+    except Exception as e: raise ReferenceUnavailable(f"この動画の文字起こしは取得できませんでした: {e}")
 
-async def get_text_from_pdf(attachment: discord.Attachment) -> str:
-    """Discordの添付ファイル(PDF)からテキストを抽出する"""
+async def get_text_from_pdf(pdf_data: bytes, name: str) -> str:
+    """PDFのバイト列からテキストを抽出する（添付ファイルとURL先のPDFで共通）"""
     try:
-        pdf_data = await attachment.read()
-        with fitz.open(stream=pdf_data, filetype="pdf") as doc: return "".join(page.get_text() for page in doc)
-    except Exception as e: return f"PDFファイルの解析中にエラーが発生しました: {e}"
+        with stage_timer("extraction.pdf"):
+            result = await extraction_service.extract_pdf(pdf_data, PDF_MAX_PAGES, EXTRACTION_CHAR_BUDGET)
+        if result["truncated"]:
+            logging.info(f"PDF「{name}」は全{result['page_count']}ページのうち、先頭{result['pages_read']}ページのみを抽出しました。")
+            return f"{result['text']}\n（全{result['page_count']}ページのうち、先頭{result['pages_read']}ページ分の抜粋）"
+        return result["text"]
+    except asyncio.TimeoutError: raise ReferenceUnavailable("PDFファイルの解析が時間内に終わりませんでした。")
+    except ExtractionLimitExceeded as e: raise ReferenceUnavailable(f"PDFファイルの解析を中断しました: {e}")
+    except Exception as e: raise ReferenceUnavailable(f"PDFファイルの解析中にエラーが発生しました: {e}")
 
 
+# ---------------------------------
+# 6.2.1. 参照資料キャッシュ (Reference Material Cache)
+# ---------------------------------
+# 共有されたURL・YouTube動画・添付ファイルから抽出したテキストと、その要約をSQLiteに保存する。
+# キーは正規化したURL、動画ID、または添付ファイルの内容のSHA-256（長い資料の断片の要約は、断片の内容のSHA-256）。
+# ウェブページは REFERENCE_FRESH_SECONDS の間はそのまま使い、それを過ぎたら ETag/Last-Modified による条件付きGETで変更の有無を確かめる。
+# 合計サイズが REFERENCE_CACHE_MAX_BYTES を超えたら、最後に使われたのが古いものから削除する。
+REFERENCE_CACHE_PATH = os.getenv("REFERENCE_CACHE_PATH", "reference_cache.sqlite3")
+REFERENCE_CACHE_MAX_BYTES = int(os.getenv("REFERENCE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+REFERENCE_FRESH_SECONDS = float(os.getenv("REFERENCE_FRESH_SECONDS", str(6 * 3600)))
+# キャッシュのキーを揃えるために取り除く、アクセス解析用のクエリパラメータ
+TRACKING_QUERY_PARAMS = ("utm_", "fbclid", "gclid", "igshid", "mc_cid", "mc_eid", "ref_src")
+REFERENCE_CACHE_EVENTS = metrics.counter("mirai_bot_reference_cache_total", "Reference cache lookups by result (hit, revalidated, miss).")
+
+class ReferenceUnavailable(Exception):
+    """参照資料を取得・抽出できなかった。メッセージはそのまま会話のコンテキストとして使える説明文。"""
+
+def normalize_url(url: str) -> str:
+    """キャッシュのキーにするため、URLの表記揺れ（大文字小文字・既定ポート・断片・追跡用パラメータ・順序）を揃える。"""
+    try:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or "").lower()
+        port = parts.port
+    except ValueError:
+        return url
+    netloc = host if port is None or (scheme, port) in (("http", 80), ("https", 443)) else f"{host}:{port}"
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not key.lower().startswith(TRACKING_QUERY_PARAMS)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+class ReferenceCache:
+    """参照資料の抽出テキストと要約を保持する、サイズ上限付きのSQLiteキャッシュ。"""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        # run_blocking のワーカースレッドから使うため、接続は1つをロックで守って共有する
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        # /metrics がイベントループ上からロックやSQLiteに触れずに読めるよう、件数と合計サイズはメモリ上でも数えておく
+        # （接続を開いたときに既存のファイルの値で初期化する。開く前は0）
+        self.entries = 0
+        self.bytes = 0
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """接続は最初に使われたときに開く（import しただけではファイルを作らない）。呼び出し側でロックを取っておくこと。"""
+        if self._connection is None:
+            db = sqlite3.connect(self.path or ":memory:", check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute("""CREATE TABLE IF NOT EXISTS reference_cache (
+                key TEXT PRIMARY KEY, text TEXT NOT NULL, summary TEXT, etag TEXT, last_modified TEXT,
+                size INTEGER NOT NULL, fetched_at REAL NOT NULL, validated_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS reference_cache_accessed_at ON reference_cache (accessed_at)")
+            db.commit()
+            self.entries, self.bytes = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM reference_cache").fetchone()
+            self._connection = db
+        return self._connection
+
+    def _forget_size(self, key: str):
+        """INSERT OR REPLACE で置き換わる既存の項目の分を、件数と合計サイズから引く。呼び出し側でロックを取っておくこと。"""
+        row = self._db.execute("SELECT size FROM reference_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self.entries -= 1
+            self.bytes -= row["size"]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM reference_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE reference_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return dict(row)
+
+    @staticmethod
+    def is_fresh(entry: Dict[str, Any]) -> bool:
+        """URLの項目だけが鮮度を持つ。動画IDと内容のハッシュで引く項目は常に新しいとみなす。"""
+        return not entry["key"].startswith("url:") or time.time() - entry["validated_at"] < REFERENCE_FRESH_SECONDS
+
+    def put(self, key: str, text: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        """抽出テキストを保存する（同じキーの古い要約は破棄される）。"""
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            self._forget_size(key)
+            self._db.execute("INSERT OR REPLACE INTO reference_cache VALUES (?, ?, NULL, ?, ?, ?, ?, ?, ?)",
+                             (key, text, etag, last_modified, size, now, now, now))
+            self._db.commit()
+            self.entries += 1
+            self.bytes += size
+            self._evict()
+
+    def set_summary(self, key: str, summary: str):
+        size = len(summary.encode("utf-8"))
+        with self._lock:
+            updated = self._db.execute("UPDATE reference_cache SET summary = ?, size = size + ? WHERE key = ?", (summary, size, key)).rowcount
+            self._db.commit()
+            self.bytes += size * updated
+            self._evict()
+
+    def put_summary(self, key: str, summary: str):
+        """抽出テキストを持たない要約だけの項目（長い資料の断片の要約など）を保存する。"""
+        now = time.time()
+        size = len(summary.encode("utf-8"))
+        with self._lock:
+            self._forget_size(key)
+            self._db.execute("INSERT OR REPLACE INTO reference_cache VALUES (?, '', ?, NULL, NULL, ?, ?, ?, ?)",
+                             (key, summary, size, now, now, now))
+            self._db.commit()
+            self.entries += 1
+            self.bytes += size
+            self._evict()
+
+    def mark_validated(self, key: str):
+        with self._lock:
+            self._db.execute("UPDATE reference_cache SET validated_at = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば、古いものから削除する。呼び出し側でロックを取っておくこと。"""
+        if self.bytes <= self.max_bytes:
+            return
+        evicted = 0
+        for row in self._db.execute("SELECT key, size FROM reference_cache ORDER BY accessed_at").fetchall():
+            if self.bytes <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM reference_cache WHERE key = ?", (row["key"],))
+            self.entries -= 1
+            self.bytes -= row["size"]
+            evicted += 1
+        self._db.commit()
+        logging.info(f"参照資料キャッシュが上限を超えたため、{evicted}件を削除しました。")
+
+    def stats(self) -> Dict[str, Any]:
+        """メモリ上の件数と合計サイズを返す（ロックもSQLiteも使わないので、イベントループ上から呼んでよい）。"""
+        return {"entries": self.entries, "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+reference_cache = ReferenceCache(REFERENCE_CACHE_PATH, REFERENCE_CACHE_MAX_BYTES)
+metrics.gauge("mirai_bot_reference_cache_bytes", "Total size of extracted text and summaries in the reference cache.", lambda: reference_cache.bytes)
+
 # ---------------------------------
 # 6.3. AI処理・画像生成関数 (Functions for AI Processing and Image Generation)
 # ---------------------------------
+# モデルのオブジェクトは呼び出しのたびに作らず、(種類, モデル名, システム指示, 安全設定) の組ごとに
+# ModelRegistry で使い回す。ULTIMATE_PROMPT（不変部分）はシステム指示として、会話ごとに変わる部分とは分けて渡す。
+# PROMPT_CACHE=1 で、不変部分を Gemini のコンテキストキャッシュ(CachedContent)に登録して毎回の入力トークンから外せる。
+MODEL_REGISTRY_SIZE = int(os.getenv("MODEL_REGISTRY_SIZE", "32"))
+GEMINI_SAFETY_SETTINGS = {'HARASSMENT': 'block_none'}
+IMAGEN_SAFETY_SETTINGS = [
+    SafetySetting(harm_category=HarmCategory.HARM_CATEGORY_HARASSMENT, threshold=HarmCategory.HarmBlockThreshold.BLOCK_NONE),
+    SafetySetting(harm_category=HarmCategory.HARM_CATEGORY_HATE_SPEECH, threshold=HarmCategory.HarmBlockThreshold.BLOCK_NONE),
+    SafetySetting(harm_category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, threshold=HarmCategory.HarmBlockThreshold.BLOCK_NONE),
+    SafetySetting(harm_category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, threshold=HarmCategory.HarmBlockThreshold.BLOCK_NONE)
+]
+
+# コンテキストキャッシュはバージョン固定のモデル名でしか使えず、gemini-1.5-*-002 では最小 32,768 トークンが必要。
+# 現在の ULTIMATE_PROMPT はそれよりずっと短いため既定では無効にしている。有効にした場合も、最初に count_tokens で
+# 大きさを確かめ、PROMPT_CACHE_MIN_TOKENS に満たなければキャッシュを作らない。
+# 作成に失敗した場合は元のモデルにシステム指示をそのまま渡す形に戻し、PROMPT_CACHE_TTL_SECONDS 後に再び試す。
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "0") == "1"
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "32768"))
+PROMPT_CACHE_MODEL = os.getenv("PROMPT_CACHE_MODEL", "models/gemini-1.5-pro-002")
+PROMPT_CACHE_FLASH_MODEL = os.getenv("PROMPT_CACHE_FLASH_MODEL", "models/gemini-1.5-flash-002")
+PROMPT_CACHE_TTL_SECONDS = int(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600"))
+PROMPT_CACHE_REFRESH_MARGIN_SECONDS = int(os.getenv("PROMPT_CACHE_REFRESH_MARGIN_SECONDS", "300"))
+PROMPT_CACHE_EVENTS = metrics.counter("mirai_bot_prompt_cache_total", "Prompt prefix cache lookups by result (hit, created, fallback, failed, too_small).")
+
+class ModelRegistry:
+    """設定済みのモデルオブジェクトを、モデル名・システム指示・安全設定の組ごとに保持して使い回す（LRU）。"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._models: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def get(self, factory: Callable[..., Any], model_name: str, system_instruction: Optional[str] = None, safety_settings: Any = None) -> Any:
+        """factory は genai.GenerativeModel か、Vertex AIの GenerativeModel。"""
+        key = (factory.__module__, factory.__qualname__, model_name, system_instruction, repr(safety_settings))
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+            return model
+        options = {}
+        if system_instruction is not None:
+            options["system_instruction"] = system_instruction
+        if safety_settings is not None:
+            options["safety_settings"] = safety_settings
+        model = self._models[key] = factory(model_name, **options)
+        while len(self._models) > self.max_entries:
+            self._models.popitem(last=False)
+        return model
+
+model_registry = ModelRegistry(MODEL_REGISTRY_SIZE)
+metrics.gauge("mirai_bot_model_registry_size", "Number of configured model objects kept for reuse.", lambda: len(model_registry))
+
+class PromptPrefixCache:
+    """
+    不変のシステム指示を CachedContent として登録し、それを参照するモデルを返す。
+    キャッシュは期限の refresh_margin 秒前に作り直す（古いキャッシュは期限切れで消えるので、処理中のリクエストは影響を受けない）。
+    システム指示が min_tokens に満たない場合はキャッシュを作れないため、一度数えた後は常にキャッシュなしのモデルを返す。
+    """
+
+    def __init__(self, system_instruction: str, cache_model_name: str, fallback_model_name: str,
+                 ttl_seconds: int, refresh_margin_seconds: int, enabled: bool = True, min_tokens: int = 0):
+        self.system_instruction = system_instruction
+        self.cache_model_name = cache_model_name
+        self.fallback_model_name = fallback_model_name
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.enabled = enabled
+        self.min_tokens = min_tokens
+        self._token_count: Optional[int] = None
+        self._cached: Optional[caching.CachedContent] = None
+        self._model: Optional[genai.GenerativeModel] = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fallback(self) -> genai.GenerativeModel:
+        return model_registry.get(genai.GenerativeModel, self.fallback_model_name, system_instruction=self.system_instruction)
+
+    async def model(self) -> genai.GenerativeModel:
+        now = time.monotonic()
+        if self._model is not None and (now < self._expires_at - self.refresh_margin_seconds or (now < self._expires_at and self._lock.locked())):
+            PROMPT_CACHE_EVENTS.inc(result="hit")
+            return self._model
+        if not self.enabled or now < self._retry_at:
+            if self._model is not None and now < self._expires_at:
+                return self._model
+            PROMPT_CACHE_EVENTS.inc(result="fallback")
+            return self._fallback()
+        async with self._lock:
+            if self._model is not None and time.monotonic() < self._expires_at - self.refresh_margin_seconds:
+                PROMPT_CACHE_EVENTS.inc(result="hit")
+                return self._model
+            try:
+                if self._token_count is None:
+                    counted = await run_blocking(model_registry.get(genai.GenerativeModel, self.cache_model_name).count_tokens, self.system_instruction)
+                    self._token_count = counted.total_tokens
+                if self._token_count < self.min_tokens:
+                    logging.info(f"プロンプトは{self._token_count}トークンで、キャッシュの最小トークン数({self.min_tokens})に満たないため、キャッシュを使いません。")
+                    PROMPT_CACHE_EVENTS.inc(result="too_small")
+                    self.enabled = False
+                    return self._fallback()
+                cached = await run_blocking(caching.CachedContent.create, model=self.cache_model_name, display_name="mirai-heko-ultimate-prompt",
+                                            system_instruction=self.system_instruction, ttl=timedelta(seconds=self.ttl_seconds))
+            except Exception as e:
+                logging.warning(f"プロンプトのキャッシュを作成できませんでした。{self.ttl_seconds}秒間はキャッシュなしで応答します。: {e}")
+                PROMPT_CACHE_EVENTS.inc(result="failed")
+                self._retry_at = time.monotonic() + self.ttl_seconds
+                if self._model is not None and time.monotonic() < self._expires_at:
+                    return self._model
+                self._model = None
+                return self._fallback()
+            self._cached = cached
+            self._model = genai.GenerativeModel.from_cached_content(cached)
+            self._expires_at = time.monotonic() + self.ttl_seconds
+            logging.info(f"プロンプトのキャッシュを作成しました: {cached.name} ({self.cache_model_name}, TTL {self.ttl_seconds}秒)")
+            PROMPT_CACHE_EVENTS.inc(result="created")
+            return self._model
+
+    async def release(self):
+        """終了時に、現在のキャッシュを期限を待たずに削除する。"""
+        cached, self._cached, self._model = self._cached, None, None
+        if cached is None:
+            return
+        try:
+            await run_blocking(cached.delete)
+        except Exception as e:
+            logging.warning(f"プロンプトのキャッシュの削除に失敗しました: {e}")
+
+# 応答に使うモデル（MODEL_PRO / MODEL_FLASH）ごとに、ULTIMATE_PROMPT のキャッシュを持つ
+prompt_prefix_caches: Dict[str, PromptPrefixCache] = {
+    model_name: PromptPrefixCache(ULTIMATE_PROMPT, cache_model_name, model_name, PROMPT_CACHE_TTL_SECONDS,
+                                  PROMPT_CACHE_REFRESH_MARGIN_SECONDS, enabled=PROMPT_CACHE, min_tokens=PROMPT_CACHE_MIN_TOKENS)
+    for model_name, cache_model_name in ((MODEL_PRO, PROMPT_CACHE_MODEL), (MODEL_FLASH, PROMPT_CACHE_FLASH_MODEL))
+}
 
-async def analyze_with_gemini(prompt: str, model_name: str = MODEL_FLASH) -> str:
-    """汎用的なGemini呼び出し関数"""
+async def ultimate_prompt_model(model_name: str) -> genai.GenerativeModel:
+    """ULTIMATE_PROMPT をシステム指示とする model_name のモデルを返す。"""
+    return await prompt_prefix_caches[model_name].model()
+
+# モデルの選択: 一言のあいさつと、資料を読み込んだ深掘りとで同じモデルを使わないよう、機能(ability)・入力の大きさ・添付の有無・
+# 最近の応答時間から、リクエストごとに MODEL_FLASH と MODEL_PRO のどちらを使うかを決める。
+# MODEL_ROUTING_ABILITIES の値は "pro"（常にPro）、"flash"（常にFlash）、"auto"（入力から判断）のいずれか。
+# Flashの出力が検証に通らなかった場合はProで作り直し、選択の理由と所要時間・トークン数・推定費用をログとメトリクスに残す。
+MODEL_ROUTING_ABILITIES: Dict[str, str] = {
+    "reply": "auto",
+    "proactive": "auto",
+    "daily_reflection": "auto",
+    "bgm_suggestion": "flash",
+    "sketch_idea": "flash",
+    "x_post": "flash",
+    "obsidian_memo": "auto",
+    "combo_summary": "auto",
+    "prep_article": "pro",
+    "deep_dive": "pro",
+}
+# 例: MODEL_ROUTING_ABILITIES='{"reply": "pro"}' で個別に上書きできる
+MODEL_ROUTING_ABILITIES.update(json.loads(os.getenv("MODEL_ROUTING_ABILITIES", "{}")))
+# "auto" の機能で、入力（ユーザーの発言や会話ログなど、テンプレートを除いた部分）がこれ以上ならProを使う
+ROUTING_PRO_INPUT_TOKENS = int(os.getenv("ROUTING_PRO_INPUT_TOKENS", "1500"))
+# Proの最近の応答時間(指数移動平均)がこれを超えている間は、"auto" の機能をFlashに回す
+ROUTING_PRO_LATENCY_LIMIT_SECONDS = float(os.getenv("ROUTING_PRO_LATENCY_LIMIT_SECONDS", "30"))
+ROUTING_LATENCY_EWMA_ALPHA = 0.2
+# 応答時間の移動平均は、最後の計測からこの秒数が経つごとに半分とみなす。Flashに回している間はProの計測が増えないため、
+# 減衰させないと一度 "pro_slow" になったまま戻らなくなる
+ROUTING_LATENCY_HALF_LIFE_SECONDS = float(os.getenv("ROUTING_LATENCY_HALF_LIFE_SECONDS", "300"))
+# 100万トークンあたりの料金(USD)。キャッシュ済みの入力トークンは入力料金の CACHED_INPUT_PRICE_RATIO 倍で計算する
+MODEL_PRICES: Dict[str, Dict[str, float]] = {
+    MODEL_PRO: {"input": 1.25, "output": 5.00},
+    MODEL_FLASH: {"input": 0.075, "output": 0.30},
+}
+MODEL_PRICES.update(json.loads(os.getenv("MODEL_PRICES", "{}")))
+CACHED_INPUT_PRICE_RATIO = 0.25
+MODEL_ROUTES = metrics.counter("mirai_bot_model_routes_total", "Model routing decisions by ability, model and reason.")
+MODEL_TOKENS = metrics.counter("mirai_bot_model_tokens_total", "Tokens used by routed Gemini calls, by ability, model and kind.")
+MODEL_COST = metrics.counter("mirai_bot_model_cost_usd_total", "Estimated cost in USD of routed Gemini calls, by ability and model.")
+
+def estimate_cost(model_name: str, usage: Any) -> Tuple[int, int, int, float]:
+    """usage_metadata から (入力, うちキャッシュ済み, 出力) のトークン数と推定費用(USD)を求める。"""
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+    output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    price = MODEL_PRICES.get(model_name, {"input": 0.0, "output": 0.0})
+    cost = ((prompt_tokens - cached_tokens) * price["input"] + cached_tokens * price["input"] * CACHED_INPUT_PRICE_RATIO
+            + output_tokens * price["output"]) / 1_000_000
+    return prompt_tokens, cached_tokens, output_tokens, cost
+
+class ModelRouter:
+    """リクエストごとのモデルの選択と、その結果（所要時間・トークン数・推定費用）の記録を行う。"""
+
+    def __init__(self, abilities: Dict[str, str], pro_input_tokens: int, pro_latency_limit: float, alpha: float, half_life_seconds: float):
+        self.abilities = abilities
+        self.pro_input_tokens = pro_input_tokens
+        self.pro_latency_limit = pro_latency_limit
+        self.alpha = alpha
+        self.half_life_seconds = half_life_seconds
+        self.latency_ewma: Dict[str, float] = {}
+        self._latency_updated_at: Dict[str, float] = {}
+
+    def latency(self, model_name: str) -> float:
+        """model_name の応答時間の移動平均を、最後の計測からの経過時間に応じて減衰させた値。"""
+        value = self.latency_ewma.get(model_name)
+        if value is None:
+            return 0.0
+        elapsed = time.monotonic() - self._latency_updated_at[model_name]
+        return value * 0.5 ** (elapsed / self.half_life_seconds) if self.half_life_seconds > 0 else value
+
+    def route(self, ability: str, input_tokens: int = 0, attachments: int = 0) -> str:
+        tier = self.abilities.get(ability, "auto")
+        if tier in ("pro", "flash"):
+            model_name, reason = (MODEL_PRO if tier == "pro" else MODEL_FLASH), "ability"
+        elif attachments:
+            model_name, reason = MODEL_PRO, "attachments"
+        elif input_tokens >= self.pro_input_tokens:
+            model_name, reason = MODEL_PRO, "long_input"
+        else:
+            model_name, reason = MODEL_FLASH, "short_input"
+        if tier == "auto" and model_name == MODEL_PRO and self.latency(MODEL_PRO) > self.pro_latency_limit:
+            model_name, reason = MODEL_FLASH, "pro_slow"
+        MODEL_ROUTES.inc(ability=ability, model=model_name, reason=reason)
+        logging.info(f"モデル選択: {ability} → {model_name} (理由:{reason}, 入力{input_tokens}トークン, 添付{attachments}件)")
+        return model_name
+
+    def escalate(self, ability: str, model_name: str) -> Optional[str]:
+        """検証に通らなかった出力を、上位のモデルで作り直す場合はそのモデル名を返す。"""
+        if model_name == MODEL_PRO:
+            return None
+        MODEL_ROUTES.inc(ability=ability, model=MODEL_PRO, reason="escalated")
+        logging.warning(f"モデル選択: {ability} の {model_name} の出力が検証に通らなかったため、{MODEL_PRO} で作り直します。")
+        return MODEL_PRO
+
+    def record(self, ability: str, model_name: str, seconds: float, usage: Any = None, outcome: str = "ok"):
+        """seconds はモデルの生成にかかった時間（スケジューラーの待ち時間やDiscordへの投稿を含めない）。"""
+        if outcome == "ok":
+            previous = self.latency(model_name) if model_name in self.latency_ewma else None
+            self.latency_ewma[model_name] = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+            self._latency_updated_at[model_name] = time.monotonic()
+        prompt_tokens, cached_tokens, output_tokens, cost = estimate_cost(model_name, usage)
+        MODEL_TOKENS.inc(prompt_tokens - cached_tokens, ability=ability, model=model_name, kind="input")
+        MODEL_TOKENS.inc(cached_tokens, ability=ability, model=model_name, kind="cached_input")
+        MODEL_TOKENS.inc(output_tokens, ability=ability, model=model_name, kind="output")
+        MODEL_COST.inc(cost, ability=ability, model=model_name)
+        logging.info(f"モデル呼び出しの結果: {ability} {model_name} {outcome} {seconds:.2f}秒, "
+                     f"入力{prompt_tokens}(キャッシュ{cached_tokens})/出力{output_tokens}トークン, 推定${cost:.5f}")
+
+model_router = ModelRouter(MODEL_ROUTING_ABILITIES, ROUTING_PRO_INPUT_TOKENS, ROUTING_PRO_LATENCY_LIMIT_SECONDS, ROUTING_LATENCY_EWMA_ALPHA,
+                           ROUTING_LATENCY_HALF_LIFE_SECONDS)
+metrics.gauge("mirai_bot_model_latency_ewma_seconds", "Moving average of routed Gemini call latency per model (decayed since the last sample).",
+              lambda: [({"model": name}, model_router.latency(name)) for name in model_router.latency_ewma])
+
+async def timed_generation(awaitable: Awaitable[Any]) -> Tuple[Any, float]:
+    """awaitable の結果と所要時間を返す。スケジューラーの factory の中で使い、実行枠の待ち時間を含めずに計る。"""
+    started = time.perf_counter()
+    result = await awaitable
+    return result, time.perf_counter() - started
+
+async def analyze_with_gemini(prompt: str, model_name: str = MODEL_FLASH, generation_config: Optional[Dict[str, Any]] = None,
+                              ability: Optional[str] = None) -> str:
+    """汎用的なGemini呼び出し関数。ability を渡すと、モデル選択の結果として所要時間とトークン数を記録する。"""
+    started = time.perf_counter()
+    outcome = "ok"
+    usage = None
+    model_seconds = None
     try:
-        model = genai.GenerativeModel(model_name)
-        response = await model.generate_content_async(prompt, safety_settings={'HARASSMENT':'block_none'})
+        model = model_registry.get(genai.GenerativeModel, model_name, safety_settings=GEMINI_SAFETY_SETTINGS)
+        response, model_seconds = await gemini_scheduler.call(model_name, lambda: timed_generation(model.generate_content_async(prompt, generation_config=generation_config)))
+        usage = getattr(response, "usage_metadata", None)
         return response.text.strip()
+    except GeminiUnavailable as e:
+        outcome = "skipped"
+        logging.warning(f"Gemini({model_name})での分析を見送りました: {e}")
+        return ""
     except Exception as e:
-        logging.error(f"Gemini({model_name})での分析中にエラー: {e}")
+        outcome = "quota" if is_quota_error(e) else "error"
+        logging.error(f"Gemini({model_name})での分析中にエラー({type(e).__name__}): {e}")
         return ""
+    finally:
+        elapsed = time.perf_counter() - started
+        GEMINI_REQUEST_SECONDS.observe(elapsed, model=model_name, outcome=outcome)
+        if ability:
+            model_router.record(ability, model_name, elapsed if model_seconds is None else model_seconds, usage, outcome)
+
+async def generate_routed(prompt: str, ability: str, input_text: str = "", validate: Optional[Callable[[str], bool]] = None) -> str:
+    """
+    ability と input_text（テンプレートを除いた入力）からモデルを選んで prompt を生成する。
+    validate に通らない（既定では空の）出力は、Proで一度だけ作り直す。
+    """
+    model_name = model_router.route(ability, estimate_tokens(input_text))
+    response_text = await analyze_with_gemini(prompt, model_name=model_name, ability=ability)
+    if not (validate or bool)(response_text) and (escalated := model_router.escalate(ability, model_name)):
+        response_text = await analyze_with_gemini(prompt, model_name=escalated, ability=ability)
+    return response_text
+
+ReferenceLoader = Callable[[Optional[Dict[str, Optional[str]]]], Awaitable[Optional[Dict[str, Any]]]]
+
+# 長い資料は文の境界で SUMMARY_CHUNK_CHARS 文字以下の断片に分け、断片ごとの要約(map)を並列に作ってから、
+# それらをまとめて最終的な要約(reduce)にする。断片の要約は内容のハッシュで参照資料キャッシュに保存するため、
+# 一部の断片が失敗しても、次回は失敗した断片だけを要約し直せばよい。
+SUMMARY_CHUNK_CHARS = int(os.getenv("SUMMARY_CHUNK_CHARS", "6000"))
+SUMMARY_MAP_CONCURRENCY = int(os.getenv("SUMMARY_MAP_CONCURRENCY", "4"))
+SUMMARY_MAX_REDUCE_ROUNDS = 3
+# 日本語の句点・感嘆符・疑問符、英語の文末記号と空白、改行の直後で区切る
+SENTENCE_BOUNDARY = re.compile(r'(?<=[。！？!?．])|(?<=[.;:])\s+|\n+')
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in SENTENCE_BOUNDARY.split(text) if sentence and sentence.strip()]
+
+def chunk_text(text: str, max_chars: int = SUMMARY_CHUNK_CHARS) -> List[str]:
+    """文の境界で、max_chars 文字以下の断片に分ける（1文が max_chars を超える場合だけは文の途中で切る）。"""
+    chunks: List[str] = []
+    current = ""
+    for sentence in split_sentences(text):
+        while len(sentence) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def summarize_chunks(chunks: List[str]) -> List[Optional[str]]:
+    """断片ごとの要約を、最大 SUMMARY_MAP_CONCURRENCY 件ずつ並列に作る。失敗した断片は None になる。"""
+    semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+
+    async def summarize_chunk(chunk: str) -> Optional[str]:
+        key = f"chunk:{hashlib.sha256(chunk.encode('utf-8')).hexdigest()}"
+        if (entry := await run_blocking(reference_cache.get, key)) and entry["summary"]:
+            REFERENCE_CACHE_EVENTS.inc(result="chunk_hit")
+            return entry["summary"]
+        async with semaphore:
+            with stage_timer("summary.map"):
+                summary = await analyze_with_gemini(CHUNK_SUMMARY_PROMPT.replace("{{text_to_summarize}}", chunk))
+        if not summary:
+            return None
+        await run_blocking(reference_cache.put_summary, key, summary)
+        return summary
+
+    return await asyncio.gather(*(summarize_chunk(chunk) for chunk in chunks))
+
+async def summarize_reference_text(text: str, summary_context: str) -> Tuple[str, bool]:
+    """
+    参照資料のテキストを要約する。戻り値は (要約, 全ての断片を要約できたか)。
+    短いテキストは SUMMARY_PROMPT の1回の呼び出しで、長いテキストは map-reduce で要約する。
+    """
+    chunks = chunk_text(text) if len(text) > SUMMARY_CHUNK_CHARS else [text]
+    complete = True
+    for _ in range(SUMMARY_MAX_REDUCE_ROUNDS):
+        if len(chunks) <= 1:
+            break
+        partials = await summarize_chunks(chunks)
+        succeeded = [partial for partial in partials if partial]
+        if len(succeeded) < len(partials):
+            complete = False
+            logging.warning(f"{len(partials)}個の断片のうち、{len(partials) - len(succeeded)}個の要約に失敗しました。")
+        if not succeeded:
+            return "", False
+        logging.info(f"{len(partials)}個の断片を要約しました。（断片の上限{SUMMARY_CHUNK_CHARS}文字、並列数{SUMMARY_MAP_CONCURRENCY}）")
+        # 部分要約をまとめてもまだ長すぎる場合は、部分要約をさらに分割して同じ手順を繰り返す
+        chunks = chunk_text("\n".join(succeeded))
+    with stage_timer("summary.reduce"):
+        summary = await analyze_with_gemini(SUMMARY_PROMPT.replace("{{summary_context}}", summary_context).replace("{{text_to_summarize}}", "\n".join(chunks)))
+    return summary, complete and bool(summary)
+
+async def summarize_reference(key: str, summary_context: str, load: ReferenceLoader) -> str:
+    """
+    参照資料の要約を返す。キャッシュに新しい要約があれば、取得も要約の呼び出しも行わない。
+    load(validators) は {"text", "etag", "last_modified"} を返すか、条件付きGETで変更がなければ None を返す。
+    取得・抽出できなかった場合は、load が送出した ReferenceUnavailable をそのまま送出する。
+    """
+    entry = await run_blocking(reference_cache.get, key)
+    if entry and reference_cache.is_fresh(entry):
+        REFERENCE_CACHE_EVENTS.inc(result="hit")
+        if entry["summary"]:
+            return entry["summary"]
+        text = entry["text"]
+    else:
+        loaded = await load({"etag": entry["etag"], "last_modified": entry["last_modified"]} if entry else None)
+        if loaded is None:
+            REFERENCE_CACHE_EVENTS.inc(result="revalidated")
+            await run_blocking(reference_cache.mark_validated, key)
+            if entry["summary"]:
+                return entry["summary"]
+            text = entry["text"]
+        else:
+            REFERENCE_CACHE_EVENTS.inc(result="miss")
+            text = loaded["text"]
+            await run_blocking(reference_cache.put, key, text, etag=loaded.get("etag"), last_modified=loaded.get("last_modified"))
+    summary, complete = await summarize_reference_text(text, summary_context)
+    if complete:
+        await run_blocking(reference_cache.set_summary, key, summary)
+    return summary
+
+async def content_key(data: bytes) -> str:
+    """添付ファイルの内容のハッシュから参照資料キャッシュのキーを作る（数十MBになり得るためループの外で計算する）。"""
+    return f"sha256:{await run_blocking(lambda: hashlib.sha256(data).hexdigest())}"
+
+async def get_reference_summary(message: discord.Message, user_query: str) -> str:
+    """
+    メッセージの添付ファイル(PDF/TXT)か、本文中のURL(YouTube/Web)の内容を要約して返す。どちらも無ければ空文字列。
+    資料を読めなかった場合は、理由を説明する ReferenceUnavailable を送出する。
+    """
+    if message.attachments:
+        attachment = message.attachments[0]
+        if attachment.content_type == 'application/pdf':
+            if attachment.size > PDF_MAX_BYTES:
+                raise ReferenceUnavailable(f"PDFファイルが大きすぎるため解析できませんでした。（{attachment.size // (1024 * 1024)}MB、上限{PDF_MAX_BYTES // (1024 * 1024)}MB）")
+            pdf_data = await attachment.read()
+            async def load_pdf(validators):
+                return {"text": await get_text_from_pdf(pdf_data, attachment.filename)}
+            return await summarize_reference(await content_key(pdf_data), f"PDF「{attachment.filename}」の内容について", load_pdf)
+        elif 'text' in attachment.content_type:
+            text_data = await attachment.read()
+            async def load_text(validators):
+                return {"text": text_data.decode('utf-8', errors='ignore')}
+            return await summarize_reference(await content_key(text_data), f"テキストファイル「{attachment.filename}」の内容について", load_text)
+
+    if url_match := re.search(r'https?://\S+', user_query):
+        url = url_match.group(0)
+        video_id_match = re.search(r'(?:v=|\/|embed\/|youtu\.be\/|shorts\/)([a-zA-Z0-9_-]{11})', url)
+        if video_id_match:
+            video_id = video_id_match.group(1)
+            async def load_transcript(validators):
+                return {"text": await run_blocking(get_youtube_transcript, video_id)}
+            return await summarize_reference(f"youtube:{video_id}", f"YouTube動画「{url}」の内容について", load_transcript)
+        return await summarize_reference(f"url:{normalize_url(url)}", f"ウェブページ「{url}」の内容について", lambda validators: fetch_web_text(url, validators))
+    return ""
+
+DEFAULT_TURN_ANALYSIS = {"emotion": "ニュートラル", "concern": "なし", "valid": False}
+
+def build_turn_analysis_prompt(history: List[Dict[str, Any]], user_query: str) -> str:
+    history_text = "\n".join(f"{h['role']}: {h['parts'][0]}" for h in history)
+    return TURN_ANALYSIS_PROMPT.replace("{{conversation_history}}", history_text).replace("{{user_message}}", user_query)
+
+async def analyze_turn(channel: discord.abc.Messageable, user_query: str) -> Dict[str, Any]:
+    """
+    1回のスキーマ付きJSON呼び出しで、imazineの感情・キャラクターの気分・やり取りの要約・心配事をまとめて分析する。
+    失敗した場合は valid=False の既定値を返す。
+    """
+    history = await build_history(channel, limit=6)
+    prompt = build_turn_analysis_prompt(history, user_query)
+    text = await analyze_with_gemini(prompt, generation_config={"response_mime_type": "application/json", "response_schema": TURN_ANALYSIS_SCHEMA})
+    try:
+        result = json.loads(text)
+    except json.JSONDecodeError:
+        logging.warning(f"ターン分析の応答がJSON形式ではありませんでした: {text[:200]}")
+        return dict(DEFAULT_TURN_ANALYSIS)
+    if not isinstance(result, dict) or not all(result.get(key) for key in TURN_ANALYSIS_SCHEMA["required"]):
+        logging.warning(f"ターン分析の応答に必要な項目が揃っていませんでした: {text[:200]}")
+        return dict(DEFAULT_TURN_ANALYSIS)
+    return {**result, "valid": True}
 
 async def execute_image_generation(channel: discord.TextChannel, gen_data: dict, retry_count: int = 0):
     """
@@ -471,7 +2003,8 @@ async def execute_image_generation(channel: discord.TextChannel, gen_data: dict,
     """
     thinking_message = await channel.send(f"**みらい**「OK！imazineの魂、受け取った！最高のスタイルで描くから！📸」")
     try:
-        style_analyses = await get_styles()
+        with stage_timer("image_generation.styles"):
+            style_analyses = await get_styles()
         style_keywords = [kw for analysis in style_analyses if analysis for kw in analysis.get('style_keywords', [])]
         style_part = ", ".join(list(set(style_keywords))) if style_keywords else ", ".join(FOUNDATIONAL_STYLE_JSON['style_keywords'])
 
@@ -484,23 +2017,19 @@ async def execute_image_generation(channel: discord.TextChannel, gen_data: dict,
         final_prompt = f"{style_part}, {QUALITY_KEYWORDS}, {character_part}, in a scene of {situation}. The overall mood is {mood}."
         logging.info(f"画像生成プロンプト: {final_prompt}")
         
-        model = GenerativeModel(MODEL_IMAGE_GEN)
-        safety_settings = [
-            SafetySetting(harm_category=HarmCategory.HARM_CATEGORY_HARASSMENT, threshold=HarmCategory.HarmBlockThreshold.BLOCK_NONE),
-            SafetySetting(harm_category=HarmCategory.HARM_CATEGORY_HATE_SPEECH, threshold=HarmCategory.HarmBlockThreshold.BLOCK_NONE),
-            SafetySetting(harm_category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, threshold=HarmCategory.HarmBlockThreshold.BLOCK_NONE),
-            SafetySetting(harm_category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, threshold=HarmCategory.HarmBlockThreshold.BLOCK_NONE)
-        ]
+        model = model_registry.get(GenerativeModel, MODEL_IMAGE_GEN, safety_settings=IMAGEN_SAFETY_SETTINGS)
         
-        response = await model.generate_content_async([final_prompt], generation_config=GenerationConfig(temperature=0.9), safety_settings=safety_settings)
+        with stage_timer("image_generation.imagen"):
+            response = await gemini_scheduler.call(MODEL_IMAGE_GEN, lambda: model.generate_content_async([final_prompt], generation_config=GenerationConfig(temperature=0.9)))
 
         if response.candidates and response.candidates[0].content.parts:
             image_bytes = response.candidates[0].content.parts[0].data
             image_file = discord.File(io.BytesIO(image_bytes), filename="mirai-heko-photo.png")
             embed = discord.Embed(title="🖼️ Generated by MIRAI-HEKO-Bot", color=discord.Color.blue()).set_footer(text=final_prompt)
             embed.set_image(url=f"attachment://mirai-heko-photo.png")
-            await thinking_message.delete()
-            await channel.send(f"**へー子**「できたみたい！見て見て！」", file=image_file, embed=embed)
+            with stage_timer("image_generation.send"):
+                await thinking_message.delete()
+                await channel.send(f"**へー子**「できたみたい！見て見て！」", file=image_file, embed=embed)
         else:
              logging.error("Imagen APIから画像が返されませんでした。")
              await thinking_message.edit(content="**MAGI**「申し訳ありません。規定により画像を生成できませんでした。」")
@@ -513,15 +2042,621 @@ async def execute_image_generation(channel: discord.TextChannel, gen_data: dict,
 # ---------------------------------
 # 6.4. その他のユーティリティ関数 (Other Utility Functions)
 # ---------------------------------
-async def build_history(channel: discord.TextChannel, limit: int = 20) -> List[Dict[str, Any]]:
-    """Discordのチャンネルから会話履歴を構築する。"""
-    history = []
-    async for msg in channel.history(limit=limit):
-        role = 'model' if msg.author == client.user else 'user'
-        history.append({'role': role, 'parts': [msg.content]})
-    history.reverse()
+# 会話履歴はスレッド（チャンネル）ごとのリングバッファに保持し、on_message・Bot自身の送信・編集/削除イベントで更新する。
+# バッファは初めてそのスレッドを扱う時（または起動時）に一度だけREST APIで埋め、以後は足りない分だけRESTで補う。
+HISTORY_BUFFER_SIZE = int(os.getenv("HISTORY_BUFFER_SIZE", "200"))
+HISTORY_MAX_CHANNELS = int(os.getenv("HISTORY_MAX_CHANNELS", "32"))
+HISTORY_BACKFILL_LIMIT = int(os.getenv("HISTORY_BACKFILL_LIMIT", "50"))
+
+class ChannelHistory:
+    """1つのスレッド（チャンネル）の直近のメッセージを、メッセージIDの順に最大 maxlen 件保持する。"""
+
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self.backfilled = False
+        # バッファの最古のメッセージより前にはメッセージが存在しない（スレッドの先頭まで保持している）か
+        self.reached_start = False
+        self.lock = asyncio.Lock()
+        self._messages: Dict[int, Dict[str, Any]] = {}
+
+    def add(self, message: discord.Message):
+        self._messages[message.id] = {
+            "id": message.id,
+            "role": 'model' if message.author == client.user else 'user',
+            "author_name": message.author.name,
+            "content": message.content,
+            "created_at": message.created_at,
+        }
+        while len(self._messages) > self.maxlen:
+            del self._messages[min(self._messages)]
+            self.reached_start = False
+
+    def edit(self, message_id: int, content: str):
+        if message_id in self._messages:
+            self._messages[message_id]["content"] = content
+
+    def remove(self, message_id: int):
+        self._messages.pop(message_id, None)
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        """直近 limit 件を古い順に返す。"""
+        return [self._messages[key] for key in sorted(self._messages)[-limit:]]
+
+    def since(self, after: datetime) -> Optional[List[Dict[str, Any]]]:
+        """after 以降のメッセージを古い順に返す。バッファがその時点まで遡れない場合や、取りこぼしがあり得る場合は None。"""
+        if not self.backfilled:
+            # 起動直後や再接続後のバックフィル前は、切断中のメッセージが抜けている可能性がある
+            return None
+        entries = self.recent(self.maxlen)
+        if not self.reached_start and (not entries or entries[0]["created_at"] > after):
+            return None
+        return [entry for entry in entries if entry["created_at"] > after]
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+client.channel_histories = OrderedDict()
+
+def is_tracked_channel(channel: Any) -> bool:
+    """会話履歴をバッファするチャンネル（談話室スレッドとプロアクティブ機能の投稿先）かどうか。"""
+    return (isinstance(channel, discord.Thread) and "4人の談話室" in channel.name) or getattr(channel, "id", None) == TARGET_CHANNEL_ID
+
+def get_channel_history(channel_id: int, create: bool = True) -> Optional[ChannelHistory]:
+    histories: "OrderedDict[int, ChannelHistory]" = client.channel_histories
+    if channel_id in histories:
+        histories.move_to_end(channel_id)
+        return histories[channel_id]
+    if not create:
+        return None
+    histories[channel_id] = ChannelHistory(HISTORY_BUFFER_SIZE)
+    while len(histories) > HISTORY_MAX_CHANNELS:
+        histories.popitem(last=False)
+    return histories[channel_id]
+
+def record_message(message: discord.Message):
+    """新しいメッセージをそのチャンネルの履歴バッファに追加する。"""
+    if is_tracked_channel(message.channel):
+        get_channel_history(message.channel.id).add(message)
+
+async def fill_history(channel: discord.abc.Messageable, limit: int) -> ChannelHistory:
+    """
+    バッファが未初期化、または直近 limit 件に足りない場合にだけ、REST APIで履歴を取得して補う。
+    同じチャンネルへの同時の補完は1回にまとめる。
+    """
+    history = get_channel_history(channel.id)
+    if history.backfilled and (len(history) >= limit or history.reached_start):
+        return history
+    async with history.lock:
+        if history.backfilled and (len(history) >= limit or history.reached_start):
+            return history
+        fetch_limit = min(max(limit, HISTORY_BACKFILL_LIMIT), HISTORY_BUFFER_SIZE)
+        with stage_timer("history.rest_backfill"):
+            fetched = [msg async for msg in channel.history(limit=fetch_limit)]
+        for msg in fetched:
+            history.add(msg)
+        history.backfilled = True
+        history.reached_start = len(fetched) < fetch_limit
+        logging.info(f"チャンネル{channel.id}の会話履歴をREST APIから{len(fetched)}件補完しました。")
     return history
 
+async def build_history(channel: discord.TextChannel, limit: int = 20) -> List[Dict[str, Any]]:
+    """チャンネルの履歴バッファから会話履歴を構築する。"""
+    history = await fill_history(channel, limit)
+    return [{'role': entry['role'], 'parts': [entry['content']]} for entry in history.recent(limit)]
+
+
+# ---------------------------------
+# 6.5. コンテキスト収集ステージ (Context Assembly Stage)
+# ---------------------------------
+# 応答生成に必要なコンテキストは互いに依存しないため、全て同時に取得する。
+# 各ソースには個別の締め切りがあり、間に合わなかったものは既定値で補うことで、
+# メインの生成呼び出しが必ず CONTEXT_BUDGET_SECONDS 以内に始まるようにする。
+CONTEXT_BUDGET_SECONDS = float(os.getenv("CONTEXT_BUDGET_SECONDS", "8.0"))
+CONTEXT_SOURCE_DEADLINES: Dict[str, float] = {
+    "turn_analysis": 4.0,
+    "learner": 5.0,
+    "history": 4.0,
+    "weather_info": 3.0,
+}
+# 例: CONTEXT_SOURCE_DEADLINES='{"learner": 6.5}' で個別に上書きできる（上のソース名以外は無視する）
+for _name, _deadline in json.loads(os.getenv("CONTEXT_SOURCE_DEADLINES", "{}")).items():
+    if _name in CONTEXT_SOURCE_DEADLINES:
+        CONTEXT_SOURCE_DEADLINES[_name] = float(_deadline)
+    else:
+        logging.warning(f"CONTEXT_SOURCE_DEADLINES の'{_name}'は不明なコンテキストのため無視します（有効な名前: {', '.join(CONTEXT_SOURCE_DEADLINES)}）。")
+
+ContextSources = Dict[str, Tuple[Awaitable[Any], Any]]
+
+async def gather_context(sources: ContextSources, budget: float = CONTEXT_BUDGET_SECONDS) -> Dict[str, Any]:
+    """
+    {名前: (awaitable, 既定値)} の形で渡されたコンテキスト取得処理を同時に実行する。
+    各ソースは自身の締め切り（最大でも budget 秒）を過ぎるか失敗した場合、既定値に置き換えられる。
+    """
+    async def _run(name: str, awaitable: Awaitable[Any], default: Any) -> Any:
+        deadline = min(CONTEXT_SOURCE_DEADLINES.get(name, budget), budget)
+        try:
+            with stage_timer(f"context.{name}"):
+                return await asyncio.wait_for(awaitable, timeout=deadline)
+        except asyncio.TimeoutError:
+            logging.warning(f"コンテキスト'{name}'が締め切り({deadline}秒)に間に合わなかったため、既定値を使用します。")
+        except Exception as e:
+            logging.error(f"コンテキスト'{name}'の取得中にエラー。既定値を使用します: {e}")
+        return default
+
+    names = list(sources)
+    results = await asyncio.gather(*(_run(name, *sources[name]) for name in names))
+    return dict(zip(names, results))
+
+def conversation_context_sources(query_text: str) -> ContextSources:
+    """on_message と run_proactive_dialogue で共通の、コンテキスト取得処理一式を返す。"""
+    return {"learner": (get_conversation_context(query_text), resolve_conversation_context({}))}
+
+# 毎回変わるコンテキストは、Learnerのテーブルが育つほど際限なく長くなるため、スロットごとに
+# 推定トークン数を数え、合計が PROMPT_CONTEXT_TOKEN_BUDGET に収まるよう決まった規則で切り詰める。
+# 各スロットにはまず予算の share 分を確保し、使い切らなかった分を priority の小さい（重要な）スロットから順に配る。
+# 切り詰めは separator で区切った単位（記憶の1行、魂の記録1件など）を先頭から残し、1単位目も入らない場合だけ途中で切る。
+PROMPT_CONTEXT_TOKEN_BUDGET = int(os.getenv("PROMPT_CONTEXT_TOKEN_BUDGET", "6000"))
+# 英数字は約4文字で1トークン、日本語などそれ以外は1文字1トークンとして、多めに見積もる
+PROMPT_ASCII_CHARS_PER_TOKEN = 4
+PROMPT_TRUNCATION_MARK = "…"
+PROMPT_CONTEXT_TOKENS = metrics.histogram("mirai_bot_prompt_context_tokens", "Estimated tokens per prompt context slot after budgeting.",
+                                          buckets=(10, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000))
+
+def estimate_tokens(text: str) -> int:
+    """トークナイザーを呼ばずに、テキストのトークン数を推定する。"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return -(-ascii_chars // PROMPT_ASCII_CHARS_PER_TOKEN) + (len(text) - ascii_chars)
+
+def cut_to_tokens(text: str, max_tokens: int) -> str:
+    """推定トークン数が max_tokens 以下になる最長の先頭部分を返す（途中で切った場合は末尾に印を付ける）。"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_tokens -= estimate_tokens(PROMPT_TRUNCATION_MARK)
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + PROMPT_TRUNCATION_MARK if low else ""
+
+class PromptSlot:
+    """テンプレートの1スロットの予算の設定。priority は小さいほど優先して残す。"""
+
+    def __init__(self, priority: int, share: float, separator: Optional[str] = None):
+        self.priority = priority
+        self.share = share
+        self.separator = separator
+
+    def trim(self, text: str, max_tokens: int) -> str:
+        """separator で区切った単位を先頭から、max_tokens に収まるだけ残す。"""
+        if estimate_tokens(text) <= max_tokens:
+            return text
+        if not self.separator:
+            return cut_to_tokens(text, max_tokens)
+        kept: List[str] = []
+        used = 0
+        separator_tokens = estimate_tokens(self.separator)
+        for unit in text.split(self.separator):
+            cost = estimate_tokens(unit) + (separator_tokens if kept else 0)
+            if used + cost > max_tokens:
+                if not kept:
+                    kept.append(cut_to_tokens(unit, max_tokens))
+                break
+            kept.append(unit)
+            used += cost
+        return self.separator.join(kept)
+
+PROMPT_CONTEXT_SLOTS: Dict[str, PromptSlot] = {
+    "CHARACTER_STATES": PromptSlot(priority=0, share=0.05),
+    "EMOTION_CONTEXT": PromptSlot(priority=0, share=0.02),
+    "RELEVANT_MEMORY": PromptSlot(priority=1, share=0.45, separator="\n"),
+    "MAGI_SOUL_RECORD": PromptSlot(priority=2, share=0.30, separator="\n---\n"),
+    "DIALOGUE_EXAMPLE": PromptSlot(priority=3, share=0.10, separator="\n"),
+    "VOCABULARY_HINT": PromptSlot(priority=4, share=0.08, separator=", "),
+}
+# 例: PROMPT_CONTEXT_SLOT_SHARES='{"MAGI_SOUL_RECORD": 0.4}' で個別に上書きできる
+for _name, _share in json.loads(os.getenv("PROMPT_CONTEXT_SLOT_SHARES", "{}")).items():
+    PROMPT_CONTEXT_SLOTS[_name].share = float(_share)
+
+class PromptTemplate:
+    """
+    {{SLOT}} を含むテンプレートを一度だけ解析しておき、スロットの値を予算に収めて組み立てる。
+    render() は組み立てたテキストと、スロットごとの (元の推定トークン数, 採用した推定トークン数) を返す。
+    """
+
+    SLOT_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+    def __init__(self, template: str, slots: Dict[str, PromptSlot], budget: int):
+        parts = self.SLOT_PATTERN.split(template)
+        self._literals = parts[0::2]
+        self._slot_names = parts[1::2]
+        if unknown := [name for name in self._slot_names if name not in slots]:
+            raise ValueError(f"予算の設定がないスロットがあります: {unknown}")
+        self.slots = slots
+        self.budget = budget
+        self.literal_tokens = sum(estimate_tokens(literal) for literal in self._literals)
+
+    def allocate(self, needs: Dict[str, int]) -> Dict[str, int]:
+        """各スロットの推定トークン数 needs から、スロットごとの上限を決める。"""
+        available = max(0, self.budget - self.literal_tokens)
+        if sum(needs.values()) <= available:
+            return dict(needs)
+        limits = {name: min(need, int(available * self.slots[name].share)) for name, need in needs.items()}
+        spare = available - sum(limits.values())
+        for name in sorted(needs, key=lambda name: (self.slots[name].priority, self._slot_names.index(name))):
+            extra = min(needs[name] - limits[name], max(0, spare))
+            limits[name] += extra
+            spare -= extra
+        return limits
+
+    def render(self, values: Dict[str, str]) -> Tuple[str, Dict[str, Tuple[int, int]]]:
+        needs = {name: estimate_tokens(values[name]) for name in self._slot_names}
+        limits = self.allocate(needs)
+        rendered = {name: self.slots[name].trim(values[name], limits[name]) for name in self._slot_names}
+        breakdown = {name: (needs[name], estimate_tokens(rendered[name])) for name in self._slot_names}
+        pieces = [self._literals[0]]
+        for name, literal in zip(self._slot_names, self._literals[1:]):
+            pieces += [rendered[name], literal]
+        return "".join(pieces), breakdown
+
+ultimate_context_template = PromptTemplate(ULTIMATE_CONTEXT_PROMPT, PROMPT_CONTEXT_SLOTS, PROMPT_CONTEXT_TOKEN_BUDGET)
+
+def render_prompt_context(context: Dict[str, Any]) -> str:
+    """収集したコンテキストを ULTIMATE_CONTEXT_PROMPT に予算内で埋め込み、スロットごとの推定トークン数をログに残す。"""
+    context = {**context, **context.get("learner", {})}
+    character_states = context["character_states"]
+    text, breakdown = ultimate_context_template.render({
+        "CHARACTER_STATES": f"みらいの気分:{character_states['mirai_mood']}, へー子の気分:{character_states['heko_mood']}, 直前のやり取り:{character_states['last_interaction_summary']}",
+        "EMOTION_CONTEXT": context.get('emotion') or 'ニュートラル',
+        "RELEVANT_MEMORY": context["relevant_context"],
+        "MAGI_SOUL_RECORD": context["magi_soul_record"],
+        "VOCABULARY_HINT": context["gals_vocabulary"],
+        "DIALOGUE_EXAMPLE": context["dialogue_example"],
+    })
+    for name, (_, kept) in breakdown.items():
+        PROMPT_CONTEXT_TOKENS.observe(kept, slot=name)
+    total = ultimate_context_template.literal_tokens + sum(kept for _, kept in breakdown.values())
+    details = ", ".join(f"{name}={kept}" + (f"(元{need})" if kept < need else "") for name, (need, kept) in breakdown.items())
+    logging.info(f"コンテキストの推定トークン数: 合計{total}/{ultimate_context_template.budget} [{details}]")
+    return text
+
+# ---------------------------------
+# 6.6. 事後処理キュー (Background Work Queue)
+# ---------------------------------
+# 応答の投稿後に行う状態更新（Learnerへの書き込みなど）は、会話の応答経路から切り離し、
+# 上限付きのキューと少数のワーカーで処理する。キューが一杯の間は投入側が待たされ（背圧）、
+# それでも空かなければ仕事を破棄する。失敗した仕事は間隔を空けて再試行し、終了時には流し切る。
+BACKGROUND_QUEUE_SIZE = int(os.getenv("BACKGROUND_QUEUE_SIZE", "100"))
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
+BACKGROUND_SUBMIT_TIMEOUT_SECONDS = float(os.getenv("BACKGROUND_SUBMIT_TIMEOUT_SECONDS", "5.0"))
+BACKGROUND_MAX_ATTEMPTS = int(os.getenv("BACKGROUND_MAX_ATTEMPTS", "3"))
+BACKGROUND_RETRY_DELAY_SECONDS = float(os.getenv("BACKGROUND_RETRY_DELAY_SECONDS", "2.0"))
+BACKGROUND_DRAIN_SECONDS = float(os.getenv("BACKGROUND_DRAIN_SECONDS", "20.0"))
+
+BACKGROUND_LAG_SECONDS = metrics.histogram("mirai_bot_background_queue_lag_seconds", "Time background jobs spend waiting in the queue before a worker starts them.")
+BACKGROUND_JOB_SECONDS = metrics.histogram("mirai_bot_background_job_seconds", "Duration of each attempt of a background job.")
+BACKGROUND_JOBS = metrics.counter("mirai_bot_background_jobs_total", "Background jobs by final outcome (ok, failed, dropped).")
+
+class BackgroundJob:
+    """キューに積まれる1件の仕事。factory は試行のたびに新しいコルーチンを作る。"""
+
+    def __init__(self, name: str, factory: Callable[[], Awaitable[Any]]):
+        self.name = name
+        self.factory = factory
+        self.request_id = request_id_var.get()
+        self.enqueued_at = time.monotonic()
+
+class BackgroundWorkQueue:
+    """上限付きの asyncio.Queue と、それを処理するワーカータスク群。"""
+
+    def __init__(self, maxsize: int, workers: int):
+        self.maxsize = maxsize
+        self.workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        # まだワーカーが取り出していない仕事の enqueued_at（積んだ順なので昇順に並ぶ）
+        self._enqueued_at: deque = deque()
+
+    def start(self):
+        """ワーカーを起動する。既に起動していれば何もしない。"""
+        if self._worker_tasks:
+            return
+        self._queue = self._queue or asyncio.Queue(maxsize=self.maxsize)
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logging.info(f"事後処理キューのワーカーを{self.workers}個起動しました。（上限{self.maxsize}件）")
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def _forget(self, job: BackgroundJob):
+        """取り出した・積めなかった仕事を待ち時間の記録から外す。"""
+        try:
+            self._enqueued_at.remove(job.enqueued_at)
+        except ValueError:
+            pass
+
+    def oldest_lag(self) -> float:
+        """キューの先頭で待っている仕事の待ち時間（秒）。"""
+        if not self._enqueued_at:
+            return 0.0
+        return time.monotonic() - self._enqueued_at[0]
+
+    async def submit(self, name: str, factory: Callable[[], Awaitable[Any]], timeout: float = BACKGROUND_SUBMIT_TIMEOUT_SECONDS) -> bool:
+        """
+        仕事を積む。キューが一杯なら最大 timeout 秒待ち、それでも空かなければ破棄して False を返す。
+        ワーカー自身が積む場合は timeout=0 とし、キューが一杯でも待たずに破棄する（ワーカー同士の待ち合わせを防ぐ）。
+        """
+        if not self._worker_tasks:
+            logging.warning(f"事後処理キューが稼働していないため、'{name}'を破棄しました。")
+            BACKGROUND_JOBS.inc(job=name, outcome="dropped")
+            return False
+        job = BackgroundJob(name, factory)
+        # ワーカーが取り出すより先に記録しておく（put の完了より先にワーカーが動くことがある）
+        self._enqueued_at.append(job.enqueued_at)
+        try:
+            if timeout <= 0:
+                self._queue.put_nowait(job)
+            else:
+                await asyncio.wait_for(self._queue.put(job), timeout=timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.QueueFull):
+            self._forget(job)
+            logging.warning(f"事後処理キューが一杯({self.maxsize}件)のため、'{name}'を破棄しました。")
+            BACKGROUND_JOBS.inc(job=name, outcome="dropped")
+            return False
+        except asyncio.CancelledError:
+            self._forget(job)
+            raise
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            self._forget(job)
+            try:
+                request_id_var.set(job.request_id)
+                gemini_priority_var.set("background")
+                BACKGROUND_LAG_SECONDS.observe(time.monotonic() - job.enqueued_at, job=job.name)
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: BackgroundJob):
+        for attempt in range(1, BACKGROUND_MAX_ATTEMPTS + 1):
+            started = time.perf_counter()
+            try:
+                await job.factory()
+                BACKGROUND_JOB_SECONDS.observe(time.perf_counter() - started, job=job.name, outcome="ok")
+                BACKGROUND_JOBS.inc(job=job.name, outcome="ok")
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                BACKGROUND_JOB_SECONDS.observe(time.perf_counter() - started, job=job.name, outcome="error")
+                if attempt == BACKGROUND_MAX_ATTEMPTS:
+                    logging.error(f"事後処理'{job.name}'が{attempt}回失敗したため、諦めます: {e}")
+                    BACKGROUND_JOBS.inc(job=job.name, outcome="failed")
+                    return
+                delay = BACKGROUND_RETRY_DELAY_SECONDS * 2 ** (attempt - 1)
+                logging.warning(f"事後処理'{job.name}'に失敗しました（{attempt}回目）。{delay:.0f}秒後に再試行します: {e}")
+                await asyncio.sleep(delay)
+
+    async def drain(self, timeout: float):
+        """残りの仕事（処理中に新たに積まれたものを含む）を最大 timeout 秒待ってから、ワーカーを止める。"""
+        if not self._worker_tasks:
+            return
+        remaining = self.depth()
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            logging.info(f"事後処理キューを流し切りました。（残り{remaining}件を処理）")
+        except asyncio.TimeoutError:
+            logging.warning(f"事後処理キューの流し切りが{timeout}秒で終わらなかったため、{self.depth()}件を破棄します。")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+background_queue = BackgroundWorkQueue(BACKGROUND_QUEUE_SIZE, BACKGROUND_WORKERS)
+metrics.gauge("mirai_bot_background_queue_depth", "Number of background jobs waiting in the queue.", background_queue.depth)
+metrics.gauge("mirai_bot_background_queue_oldest_lag_seconds", "Age of the oldest job still waiting in the background queue.", background_queue.oldest_lag)
+
+async def write_to_learner(endpoint: str, payload: Dict[str, Any]):
+    """Learnerへの書き込み。失敗した場合は例外にして、事後処理キューに再試行させる。"""
+    if await ask_learner(endpoint, payload) is None:
+        raise RuntimeError(f"学習係への書き込みに失敗しました: /{endpoint}")
+
+async def apply_turn_analysis(analysis_task: "asyncio.Task[Dict[str, Any]]"):
+    """ターン分析の結果を待ち、キャラクターの状態と心配事の書き込みを、それぞれ再試行可能な仕事として積む。"""
+    analysis = await analysis_task
+    if not analysis["valid"]:
+        return
+    character_state = {key: analysis[key] for key in ("mirai_mood", "heko_mood", "last_interaction_summary")}
+    await background_queue.submit("learner.character_state", lambda: write_to_learner("character_state", character_state), timeout=0)
+    if "なし" not in analysis["concern"]:
+        concern = {"concern_text": analysis["concern"]}
+        await background_queue.submit("learner.concern", lambda: write_to_learner("concern", concern), timeout=0)
+
+
+
+# ---------------------------------
+# 6.7. ストリーミング応答 (Streamed Replies)
+# ---------------------------------
+# メインの応答はGeminiからストリーミングで受け取り、`dialogue` 配列の要素（1人分のセリフ）が
+# 揃うたびにDiscordへ投稿する。2人目以降のセリフは同じメッセージへの編集で追記し、
+# 編集は STREAM_EDIT_INTERVAL_SECONDS に1回までに抑える。STREAM_REPLIES=0 で従来の一括投稿に戻せる。
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", "1.2"))
+DISCORD_MESSAGE_LIMIT = 2000
+
+def format_dialogue_line(part: Dict[str, Any]) -> str:
+    """dialogue の1要素を投稿用の1行にする。セリフが空なら空文字列。"""
+    if not isinstance(part, dict) or not (line := str(part.get("line", "")).strip()):
+        return ""
+    return f"**{part.get('character')}**「{line}」"
+
+def parse_dialogue_response(raw_text: str) -> Optional[List[Dict[str, Any]]]:
+    """応答全体から ```json ブロックを取り出し、dialogue 配列を返す。見つからなければ None。"""
+    json_match = re.search(r'```json\n({.*?})\n```', raw_text, re.DOTALL)
+    if not json_match:
+        return None
+    return json.loads(json_match.group(1)).get("dialogue", [])
+
+class DialogueStreamParser:
+    """
+    ストリーミングで届くテキストから、`"dialogue": [...]` の要素を完成した順に取り出す逐次パーサー。
+    各要素は json.JSONDecoder.raw_decode で読み、まだ閉じていない要素は次のチャンクを待つ。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._position: Optional[int] = None  # dialogue 配列の中で、次に読む位置
+        self._decoder = json.JSONDecoder()
+        self.finished = False
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self._buffer += text
+        entries: List[Dict[str, Any]] = []
+        if self._position is None:
+            match = re.search(r'"dialogue"\s*:\s*\[', self._buffer)
+            if not match:
+                return entries
+            self._position = match.end()
+        while not self.finished:
+            position = self._position
+            while position < len(self._buffer) and self._buffer[position] in " \t\r\n,":
+                position += 1
+            if position >= len(self._buffer):
+                break
+            if self._buffer[position] == "]":
+                self.finished = True
+                break
+            try:
+                entry, end = self._decoder.raw_decode(self._buffer, position)
+            except json.JSONDecodeError:
+                break
+            self._position = end
+            entries.append(entry)
+        return entries
+
+class StreamedReply:
+    """セリフを1つのメッセージに追記していく。2000文字を超える場合は次のメッセージに続ける。"""
+
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+        self.posted = False
+        self._current: Optional[discord.Message] = None
+        self._text = ""
+        self._shown = ""
+        self._last_edit = 0.0
+        self._pending_flush: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def append(self, line: str):
+        if self._current is not None and len(self._text) + len(line) + 1 > DISCORD_MESSAGE_LIMIT:
+            await self.close()
+            self._current, self._text = None, ""
+        self._text = f"{self._text}\n{line}" if self._text else line
+        if self._current is None:
+            self._current = await self.channel.send(self._text)
+            self._shown, self._last_edit, self.posted = self._text, time.monotonic(), True
+            return
+        wait = STREAM_EDIT_INTERVAL_SECONDS - (time.monotonic() - self._last_edit)
+        if wait <= 0:
+            await self._flush()
+        elif self._pending_flush is None:
+            self._pending_flush = asyncio.create_task(self._flush_later(wait))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._pending_flush = None
+        await self._flush()
+
+    async def _flush(self):
+        async with self._lock:
+            if self._current is not None and self._text != self._shown:
+                text = self._text
+                await self._current.edit(content=text)
+                self._shown, self._last_edit = text, time.monotonic()
+
+    async def close(self):
+        """予約中の編集を取り消し、最後の内容を反映する。"""
+        if self._pending_flush is not None:
+            self._pending_flush.cancel()
+            self._pending_flush = None
+        await self._flush()
+
+async def stream_dialogue_reply(channel: discord.abc.Messageable, model_name: str, model: genai.GenerativeModel, contents: List[Any], started: float) -> Tuple[str, bool, Any, float]:
+    """
+    応答をストリーミングで受け取り、dialogue のセリフが1人分揃うたびに投稿する。
+    スケジューラーの実行枠は、ストリームを開いて最初のチャンクを受け取るまでだけ使う（429の再試行もそこまで）。
+    投稿を始めた後に429で途切れた場合は、同じセリフを二重に投稿しないよう、再試行せずにそこまでの応答を返す。
+    戻り値は (応答の全文, 1行以上投稿できたか, usage_metadata, 生成の所要時間)。生成の所要時間にはDiscordへの投稿・編集の時間を含めない。
+    """
+    parser = DialogueStreamParser()
+    reply = StreamedReply(channel)
+    raw_parts: List[str] = []
+    discord_seconds = 0.0
+    response, open_seconds = await gemini_scheduler.call(model_name, lambda: timed_generation(model.generate_content_async(contents, stream=True)))
+    generation_started = time.perf_counter()
+    try:
+        try:
+            async for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    continue  # 安全フィルタなどでテキストを持たないチャンク
+                raw_parts.append(text)
+                for part in parser.feed(text):
+                    if line := format_dialogue_line(part):
+                        if not reply.posted:
+                            STAGE_SECONDS.observe(time.perf_counter() - started, stage="on_message.first_line", outcome="ok")
+                        posting_started = time.perf_counter()
+                        await reply.append(line)
+                        discord_seconds += time.perf_counter() - posting_started
+        except Exception as e:
+            if not (reply.posted and is_quota_error(e)):
+                raise
+            delay = gemini_scheduler.report_quota_error(model_name)
+            logging.warning(f"{model_name}が応答の途中でクォータ超過(429)を返しました。投稿済みのセリフまでで打ち切ります({delay:.1f}秒止めます)。")
+        model_seconds = open_seconds + time.perf_counter() - generation_started - discord_seconds
+    finally:
+        await reply.close()
+    return "".join(raw_parts), reply.posted, getattr(response, "usage_metadata", None), model_seconds
+
+def is_valid_dialogue(raw_text: str) -> bool:
+    """応答が ```json ブロックの dialogue 形式として解析できるか。"""
+    try:
+        return parse_dialogue_response(raw_text) is not None
+    except (ValueError, AttributeError):
+        return False
+
+async def generate_dialogue(ability: str, model_name: str, contents: List[Any],
+                            channel: Optional[discord.abc.Messageable] = None, started: Optional[float] = None) -> Tuple[str, bool]:
+    """
+    ULTIMATE_PROMPT をシステム指示として dialogue 形式の応答を生成する。channel を渡し、STREAM_REPLIES が有効なら
+    生成しながら投稿する。1行も投稿できず、応答も dialogue 形式でなかった場合は、Proで一度だけ作り直す。
+    戻り値は (応答の全文, 1行以上投稿できたか)。
+    """
+    while True:
+        model = await ultimate_prompt_model(model_name)
+        call_started = time.perf_counter()
+        outcome = "error"
+        usage = None
+        model_seconds = None
+        try:
+            if channel is not None and STREAM_REPLIES:
+                raw_text, posted, usage, model_seconds = await stream_dialogue_reply(channel, model_name, model, contents, started or call_started)
+            else:
+                response, model_seconds = await gemini_scheduler.call(model_name, lambda: timed_generation(model.generate_content_async(contents)))
+                raw_text, posted, usage = response.text, False, getattr(response, "usage_metadata", None)
+            outcome = "ok"
+        finally:
+            model_router.record(ability, model_name, time.perf_counter() - call_started if model_seconds is None else model_seconds, usage, outcome)
+        if posted or is_valid_dialogue(raw_text) or not (escalated := model_router.escalate(ability, model_name)):
+            return raw_text, posted
+        model_name = escalated
+
 # MIRAI-HEKO-Bot main.py (ver.Ω++, The Final Truth, Rev.4)
 # Part 4/5: Proactive and Scheduled Functions
 
@@ -531,49 +2666,32 @@ async def run_proactive_dialogue(channel: discord.TextChannel, prompt: str):
     """
     プロアクティブな対話を生成し、投稿するための共通関数。
     """
+    new_request_id("proactive")
     async with channel.typing():
         try:
-            # 1. 応答生成のための全てのコンテキストを準備
-            emotion = "ニュートラル"
-            character_states = await get_character_states()
-            relevant_context = await ask_learner_to_remember("最近のimazineの関心事や会話のトピック")
-            magi_soul_record = await get_latest_magi_soul()
-            gals_vocabulary = await get_gals_words()
-            dialogue_example = await get_gals_vocabulary_examples()
-            weather_info = await get_weather("Takizawa")
-
-
-            # 2. ULTIMATE_PROMPTを組み立てる
-            system_prompt = (
-                f"# 追加指示\n{prompt}\n\n"
-                f"{ULTIMATE_PROMPT}"
-                .replace("{{CHARACTER_STATES}}", f"みらいの気分:{character_states['mirai_mood']}, へー子の気分:{character_states['heko_mood']}, 直前のやり取り:{character_states['last_interaction_summary']}")
-                .replace("{{EMOTION_CONTEXT}}", f"imazineの感情:{emotion}")
-                .replace("{{RELEVANT_MEMORY}}", relevant_context)
-                .replace("{{MAGI_SOUL_RECORD}}", magi_soul_record)
-                .replace("{{VOCABULARY_HINT}}", f"参照語彙:{gals_vocabulary}")
-                .replace("{{DIALOGUE_EXAMPLE}}", f"会話例:{dialogue_example}")
-            )
+            # 1. 応答生成のための全てのコンテキストを同時に準備
+            sources = conversation_context_sources("最近のimazineの関心事や会話のトピック")
+            sources["weather_info"] = (get_weather("Takizawa"), "（天気情報は取得できませんでした）")
+            context = await gather_context(sources)
+            context["emotion"] = "ニュートラル"
+
+            # 2. 不変のULTIMATE_PROMPTはキャッシュ済みのシステム指示とし、追加指示・天気・コンテキストを発言として渡す
+            prompt_context = f"# 追加指示\n{prompt}\n\n# 現在の天気\n{context['weather_info']}\n\n{render_prompt_context(context)}"
             
-            # 3. Gemini APIを呼び出し
-            model = genai.GenerativeModel(MODEL_PRO)
-            # system_instructionではなく、コンテンツの先頭にシステムプロンプトを配置
-            all_content = [{'role': 'system', 'parts': [system_prompt]}]
-            response = await model.generate_content_async(all_content)
-            raw_response_text = response.text
+            # 3. Gemini APIを呼び出し（追加指示の長さからモデルを選ぶ）
+            model_name = model_router.route("proactive", estimate_tokens(prompt))
+            all_content = [{'role': 'user', 'parts': [prompt_context]}]
+            with stage_timer("proactive.main_generation"):
+                raw_response_text, _ = await generate_dialogue("proactive", model_name, all_content)
             logging.info(f"プロアクティブAIからの生応答: {raw_response_text[:300]}...")
 
             # 4. 応答を解析し、投稿
-            json_match = re.search(r'```json\n({.*?})\n```', raw_response_text, re.DOTALL)
-            if json_match:
-                parsed_json = json.loads(json_match.group(1))
-                dialogue = parsed_json.get("dialogue", [])
-                formatted_response = ""
-                for part in dialogue:
-                    if line := part.get("line", "").strip():
-                        formatted_response += f"**{part.get('character')}**「{line}」\n"
+            dialogue = parse_dialogue_response(raw_response_text)
+            if dialogue is not None:
+                formatted_response = "\n".join(line for part in dialogue if (line := format_dialogue_line(part)))
                 if formatted_response:
-                    await channel.send(formatted_response.strip())
+                    with stage_timer("proactive.send"):
+                        await channel.send(formatted_response)
                 logging.info(f"プロアクティブ対話を送信しました。")
             else:
                 logging.warning("プロアクティブ応答がJSON形式ではありませんでした。テキストとして送信します。")
@@ -625,19 +2743,24 @@ async def daily_reflection():
     logging.info("プロアクティブ機能: 一日の振り返りを開始します。")
     
     today_start = datetime.now(pytz.timezone(TIMEZONE)) - timedelta(days=1)
-    messages = [f"{msg.author.name}: {msg.content}" async for msg in channel.history(after=today_start, limit=200)]
+    entries = get_channel_history(channel.id).since(today_start)
+    if entries is not None:
+        messages = [f"{entry['author_name']}: {entry['content']}" for entry in entries][-200:]
+    else:
+        # バッファが24時間前まで遡れない場合や、まだバックフィルしていない場合だけ、REST APIで取得する
+        messages = [f"{msg.author.name}: {msg.content}" async for msg in channel.history(after=today_start, limit=200, oldest_first=True)]
     
     if len(messages) < 3:
         logging.info("本日は会話が少なかったため、振り返りをスキップします。")
         return
 
-    full_conversation = "\n".join(reversed(messages))
+    full_conversation = "\n".join(messages)
     prompt = OBSIDIAN_MEMO_PROMPT.replace("{{conversation_history}}", full_conversation)
 
     async with channel.typing():
         try:
             await channel.send("（今日の活動の振り返りを作成しています...✍️）")
-            response_text = await analyze_with_gemini(prompt, model_name=MODEL_PRO)
+            response_text = await generate_routed(prompt, "daily_reflection", input_text=full_conversation)
             
             today_str = datetime.now(pytz.timezone(TIMEZONE)).strftime('%Y年%m月%d日')
             summary_markdown = f"## 今日の振り返り - {today_str}\n\n{response_text}"
@@ -712,7 +2835,8 @@ async def mirai_inspiration_sketch():
             recent_conversations = "\n".join([f"{h['role']}: {h['parts'][0]}" for h in history])
             gen_idea_prompt = MIRAI_SKETCH_PROMPT.replace("{recent_conversations}", recent_conversations)
             
-            idea_response_text = await analyze_with_gemini(gen_idea_prompt, model_name=MODEL_PRO)
+            idea_response_text = await generate_routed(gen_idea_prompt, "sketch_idea", input_text=recent_conversations,
+                                                       validate=lambda text: bool(re.search(r'```json\n({.*?})\n```', text, re.DOTALL)))
             json_match = re.search(r'```json\n({.*?})\n```', idea_response_text, re.DOTALL)
             if json_match:
                 gen_data = json.loads(json_match.group(1))
@@ -732,9 +2856,13 @@ async def suggest_bgm():
     current_mood = f"みらいは{character_states['mirai_mood']}で、へー子は{character_states['heko_mood']}です。"
     
     prompt = BGM_SUGGESTION_PROMPT.replace("{mood}", current_mood)
-    response_text = await analyze_with_gemini(prompt, model_name=MODEL_PRO)
+    response_text = await generate_routed(prompt, "bgm_suggestion", input_text=current_mood)
     await channel.send(f"**MAGI**「imazineさん、今の雰囲気に、こんな音楽はいかがでしょう？\n> {response_text}」")
 
+async def report_cache_stats():
+    """Learnerキャッシュのヒット/ミス数を定期的にログへ出力する"""
+    logging.info(f"Learnerキャッシュの統計: {json.dumps(learner_cache_stats(), ensure_ascii=False)}")
+
     # MIRAI-HEKO-Bot main.py (ver.Ω++, The Final Truth, Rev.3)
 # Part 5/5: Event Handlers and Main Execution Block
 
@@ -747,8 +2875,11 @@ async def on_ready():
     """
     client.http_session = aiohttp.ClientSession()
     logging.info("aiohttp.ClientSessionを初期化しました。")
+    await start_metrics_server()
+    loop_watchdog.start()
+    background_queue.start()
 
-    if not init_vertex_ai():
+    if not await run_blocking(init_vertex_ai):
         logging.critical("Vertex AIの初期化に失敗したため、Botをシャットダウンします。")
         await client.close()
         return
@@ -756,21 +2887,34 @@ async def on_ready():
     logging.info(f'Logged in as {client.user} (ID: {client.user.id})')
     logging.info('------')
 
+    # 再接続中に見逃したメッセージがあり得るため、既存のバッファは次回の利用時に補完し直す
+    for history in client.channel_histories.values():
+        history.backfilled = False
+    target_channel = client.get_channel(TARGET_CHANNEL_ID)
+    if target_channel:
+        for channel in [target_channel, *getattr(target_channel, "threads", [])]:
+            if is_tracked_channel(channel):
+                task = asyncio.create_task(fill_history(channel, HISTORY_BACKFILL_LIMIT))
+                client.background_tasks.add(task)
+                task.add_done_callback(client.background_tasks.discard)
+
     scheduler = AsyncIOScheduler(timezone=TIMEZONE)
     # --- 挨拶・声かけ ---
-    scheduler.add_job(morning_greeting, 'cron', hour=7, minute=0)
-    scheduler.add_job(morning_break_nudge, 'cron', hour=10, minute=0)
-    scheduler.add_job(lunch_break_nudge, 'cron', hour=12, minute=0)
-    scheduler.add_job(afternoon_break_nudge, 'cron', hour=15, minute=0)
-    scheduler.add_job(evening_greeting, 'cron', hour=18, minute=0)
+    scheduler.add_job(with_gemini_priority("proactive", morning_greeting), 'cron', hour=7, minute=0)
+    scheduler.add_job(with_gemini_priority("proactive", morning_break_nudge), 'cron', hour=10, minute=0)
+    scheduler.add_job(with_gemini_priority("proactive", lunch_break_nudge), 'cron', hour=12, minute=0)
+    scheduler.add_job(with_gemini_priority("proactive", afternoon_break_nudge), 'cron', hour=15, minute=0)
+    scheduler.add_job(with_gemini_priority("proactive", evening_greeting), 'cron', hour=18, minute=0)
     # --- 振り返り・情報収集・BGM提案 ---
-    scheduler.add_job(daily_reflection, 'cron', hour=22, minute=0)
-    scheduler.add_job(check_interesting_news, 'cron', hour=8, minute=30)
-    scheduler.add_job(check_interesting_news, 'cron', hour=20, minute=30)
-    scheduler.add_job(suggest_bgm, 'cron', hour='9-21/4') # 9時から21時の間で4時間ごと
+    scheduler.add_job(with_gemini_priority("proactive", daily_reflection), 'cron', hour=22, minute=0)
+    scheduler.add_job(with_gemini_priority("proactive", check_interesting_news), 'cron', hour=8, minute=30)
+    scheduler.add_job(with_gemini_priority("proactive", check_interesting_news), 'cron', hour=20, minute=30)
+    scheduler.add_job(with_gemini_priority("proactive", suggest_bgm), 'cron', hour='9-21/4') # 9時から21時の間で4時間ごと
     # --- 気遣い・インスピレーション ---
-    scheduler.add_job(heko_care_check, 'cron', day_of_week='sun', hour=19, minute=30)
-    scheduler.add_job(mirai_inspiration_sketch, 'cron', hour='*/6') # 6時間ごと
+    scheduler.add_job(with_gemini_priority("proactive", heko_care_check), 'cron', day_of_week='sun', hour=19, minute=30)
+    scheduler.add_job(with_gemini_priority("proactive", mirai_inspiration_sketch), 'cron', hour='*/6') # 6時間ごと
+    # --- 内部統計 ---
+    scheduler.add_job(report_cache_stats, 'interval', hours=1)
 
     scheduler.start()
     logging.info("全てのプロアクティブ機能のスケジューラを開始しました。")
@@ -781,8 +2925,10 @@ async def on_message(message: discord.Message):
     """
     メッセージが送信された時に実行される、Botのメインループ。
     """
+    record_message(message)
     if message.author == client.user or not isinstance(message.channel, discord.Thread) or "4人の談話室" not in message.channel.name:
         return
+    gemini_priority_var.set("interactive")
 
     # --- 画像生成の確認フローへの応答処理 ---
     request_id_match = re.search(r'ID:\s*`([a-zA-Z0-9.-]+)`', message.content)
@@ -814,122 +2960,133 @@ async def on_message(message: discord.Message):
                 await ask_learner("magi_soul", {"learned_from_filename": attachment.filename, "soul_record": file_content})
                 await message.channel.send("（MAGIの魂を同期しました。）")
             else:
-                await ask_learner("learn", {"text_content": file_content, "metadata": metadata})
-                await message.channel.send("（学習が完了しました。）")
+                response = await ask_learner("learn", {"text_content": file_content, "metadata": metadata})
+                if response and response.get("job_id"):
+                    await message.channel.send("（学習を受け付けました。完了したらお知らせします。）")
+                    task = asyncio.create_task(watch_learn_job(message.channel, response["job_id"], attachment.filename))
+                    client.background_tasks.add(task)
+                    task.add_done_callback(client.background_tasks.discard)
+                else:
+                    await message.channel.send("（学習の受付に失敗しました。）")
         except Exception as e:
             await message.channel.send(f"学習処理中にエラーが発生しました: {e}")
         return
 
     # --- メインの会話処理 ---
+    request_id_var.set(f"msg-{message.id}")
+    started = time.perf_counter()
+    outcome = "ok"
     async with message.channel.typing():
         try:
-            # 1. 入力情報の解析とコンテキスト化
             user_query = message.content
+
+            # 応答生成のためのコンテキストは入力の解析と並行して先に取得を始める。
+            # ターン分析は締め切りに間に合わなくても止めず、結果は応答後の状態更新で使う。
+            analysis_task = asyncio.create_task(analyze_turn(message.channel, user_query))
+            context_task = asyncio.create_task(gather_context({
+                **conversation_context_sources(user_query),
+                "turn_analysis": (asyncio.shield(analysis_task), dict(DEFAULT_TURN_ANALYSIS)),
+                "history": (build_history(message.channel, limit=15), []),
+            }))
+
+            # 1. 入力情報の解析とコンテキスト化（添付ファイル(PDF/TXT)、URL(YouTube/Web)の要約）
             final_user_content_parts = []
-            extracted_summary = ""
-            summary_context = "一般的な要約"
-
-            # 添付ファイル(PDF/TXT)
-            if message.attachments:
-                attachment = message.attachments[0]
-                if attachment.content_type == 'application/pdf':
-                    summary_context = f"PDF「{attachment.filename}」の内容について"
-                    extracted_summary = await analyze_with_gemini(SUMMARY_PROMPT.replace("{{summary_context}}", summary_context).replace("{{text_to_summarize}}", await get_text_from_pdf(attachment)))
-                elif 'text' in attachment.content_type:
-                    summary_context = f"テキストファイル「{attachment.filename}」の内容について"
-                    text_data = (await attachment.read()).decode('utf-8', errors='ignore')
-                    extracted_summary = await analyze_with_gemini(SUMMARY_PROMPT.replace("{{summary_context}}", summary_context).replace("{{text_to_summarize}}", text_data))
-
-            # URL(YouTube/Web)
-            if not extracted_summary and (url_match := re.search(r'https?://\S+', user_query)):
-                url = url_match.group(0)
-                video_id_match = re.search(r'(?:v=|\/|embed\/|youtu\.be\/|shorts\/)([a-zA-Z0-9_-]{11})', url)
-                if video_id_match:
-                    summary_context = f"YouTube動画「{url}」の内容について"
-                    transcript = get_youtube_transcript(video_id_match.group(1))
-                    extracted_summary = await analyze_with_gemini(SUMMARY_PROMPT.replace("{{summary_context}}", summary_context).replace("{{text_to_summarize}}", transcript))
-                else:
-                    summary_context = f"ウェブページ「{url}」の内容について"
-                    page_text = await get_text_from_url(url)
-                    extracted_summary = await analyze_with_gemini(SUMMARY_PROMPT.replace("{{summary_context}}", summary_context).replace("{{text_to_summarize}}", page_text))
+            with stage_timer("on_message.attachment_extraction") as span:
+                try:
+                    extracted_summary = await get_reference_summary(message, user_query)
+                except ReferenceUnavailable as e:
+                    # 読めなかった理由を要約の代わりに渡し、キャラクターから伝えてもらう
+                    span.outcome = "error"
+                    extracted_summary = str(e)
 
-            # メッセージ構築
+            # メッセージ構築（google.generativeai のモデルに渡すため、文字列と {mime_type, data} の辞書で組み立てる）
             full_user_text = f"{user_query}\n\n--- 参照資料の要約 ---\n{extracted_summary}" if extracted_summary else user_query
-            final_user_content_parts.append(Part.from_text(full_user_text))
+            final_user_content_parts.append(full_user_text)
 
             if message.attachments and any(att.content_type.startswith("image/") for att in message.attachments):
                 image_attachment = next((att for att in message.attachments if att.content_type.startswith("image/")), None)
                 if image_attachment:
                     image_bytes = await image_attachment.read()
-                    image_part = Part.from_data(data=image_bytes, mime_type=image_attachment.content_type)
-                    final_user_content_parts.append(image_part)
-
-            # 2. 応答生成のためのコンテキストを準備
-            emotion = await analyze_with_gemini(EMOTION_ANALYSIS_PROMPT.replace("{{user_message}}", user_query))
-            character_states = await get_character_states()
-            relevant_context = await ask_learner_to_remember(user_query)
-            magi_soul_record = await get_latest_magi_soul()
-            gals_vocabulary = await get_gals_words()
-            dialogue_example = await get_gals_vocabulary_examples()
-
-            system_prompt = ULTIMATE_PROMPT.replace("{{CHARACTER_STATES}}", f"みらいの気分:{character_states['mirai_mood']}, へー子の気分:{character_states['heko_mood']}, 直前のやり取り:{character_states['last_interaction_summary']}")\
-                                           .replace("{{EMOTION_CONTEXT}}", f"imazineの感情:{emotion}")\
-                                           .replace("{{RELEVANT_MEMORY}}", relevant_context)\
-                                           .replace("{{MAGI_SOUL_RECORD}}", magi_soul_record)\
-                                           .replace("{{VOCABULARY_HINT}}", f"参照語彙:{gals_vocabulary}")\
-                                           .replace("{{DIALOGUE_EXAMPLE}}", f"会話例:{dialogue_example}")
-
-            # 3. Gemini APIを呼び出し
-            history = await build_history(message.channel, limit=15)
-            model = genai.GenerativeModel(MODEL_PRO, system_instruction=system_prompt)
-            response = await model.generate_content_async(history + [{'role': 'user', 'parts': final_user_content_parts}])
-            raw_response_text = response.text
+                    final_user_content_parts.append({'mime_type': image_attachment.content_type, 'data': image_bytes})
+
+            # 2. 応答生成のためのコンテキストを受け取る（締め切りを過ぎたものは既定値）
+            with stage_timer("on_message.context_wait"):
+                context = await context_task
+            context["emotion"] = context["turn_analysis"]["emotion"]
+            # 不変のULTIMATE_PROMPTはキャッシュ済みのシステム指示とし、毎回変わるコンテキストは今回の発言の先頭に添える
+            prompt_context = render_prompt_context(context)
+
+            # 3. Gemini APIを呼び出し、4. 応答を解析して投稿
+            # ストリーミング時はセリフが1人分揃うたびに投稿し、1行も投稿できなかった場合は全文から従来どおり解析する
+            # モデルは発言と参照資料の要約の長さ、画像・資料の有無から選ぶ
+            history = context["history"]
+            attachments = (len(final_user_content_parts) - 1) + (1 if extracted_summary else 0)
+            model_name = model_router.route("reply", estimate_tokens(full_user_text), attachments)
+            contents = history + [{'role': 'user', 'parts': [prompt_context] + final_user_content_parts}]
+            with stage_timer("on_message.main_generation"):
+                raw_response_text, posted = await generate_dialogue("reply", model_name, contents, message.channel, started)
             logging.info(f"AIからの生応答: {raw_response_text[:300]}...")
 
-            # 4. 応答を解析し、投稿
-            json_match = re.search(r'```json\n({.*?})\n```', raw_response_text, re.DOTALL)
-            if json_match:
-                parsed_json = json.loads(json_match.group(1))
-                dialogue = parsed_json.get("dialogue", [])
-                formatted_response = ""
-                for part in dialogue:
-                    if line := part.get("line", "").strip():
-                        formatted_response += f"**{part.get('character')}**「{line}」\n"
-                if formatted_response:
-                    await message.channel.send(formatted_response.strip())
-            else:
-                logging.error("AIからの応答が期待したJSON形式ではありませんでした。")
-
-            # 5. 事後処理
-            history_text = "\n".join([f"{h['role']}: {h['parts'][0]}" for h in history[-5:]] + [f"user: {user_query}"])
-            
-            meta_analysis_text = await analyze_with_gemini(META_ANALYSIS_PROMPT.replace("{{conversation_history}}", history_text))
-            if meta_analysis_text:
-                try:
-                    meta_json = json.loads(meta_analysis_text)
-                    await ask_learner("character_state", meta_json)
-                except json.JSONDecodeError:
-                    logging.warning("META_ANALYSISの応答がJSON形式ではありませんでした。")
+            if not posted:
+                dialogue = parse_dialogue_response(raw_response_text)
+                if dialogue is not None:
+                    formatted_response = "\n".join(line for part in dialogue if (line := format_dialogue_line(part)))
+                    if formatted_response:
+                        with stage_timer("on_message.send"):
+                            await message.channel.send(formatted_response)
+                else:
+                    logging.error("AIからの応答が期待したJSON形式ではありませんでした。")
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="on_message.reply", outcome="ok")
 
-            concern_text = await analyze_with_gemini(CONCERN_DETECTION_PROMPT.replace("{{user_message}}", user_query))
-            if "なし" not in concern_text:
-                await ask_learner("concern", {"concern_text": concern_text})
+            # 5. 事後処理（ターン分析の結果の反映）は事後処理キューに任せ、応答の投稿をもって会話処理を終える
+            with stage_timer("on_message.enqueue_post_reply"):
+                await background_queue.submit("turn_analysis", lambda: apply_turn_analysis(analysis_task))
 
         except Exception as e:
+            outcome = "error"
             logging.error(f"会話処理のメインループで予期せぬエラー: {e}", exc_info=True)
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="on_message.total", outcome=outcome)
+
+
+@client.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    """編集されたメッセージの内容を、履歴バッファに反映する。"""
+    history = get_channel_history(payload.channel_id, create=False)
+    if history is not None and "content" in payload.data:
+        history.edit(payload.message_id, payload.data["content"])
+
+
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    """削除されたメッセージを、履歴バッファから取り除く。"""
+    history = get_channel_history(payload.channel_id, create=False)
+    if history is not None:
+        history.remove(payload.message_id)
+
+
+@client.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    history = get_channel_history(payload.channel_id, create=False)
+    if history is not None:
+        for message_id in payload.message_ids:
+            history.remove(message_id)
 
 
 @client.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     if payload.user_id == client.user.id: return
+    request_id_var.set(f"reaction-{payload.message_id}-{uuid.uuid4().hex[:6]}")
+    gemini_priority_var.set("reaction")
     
     try:
-        channel = await client.fetch_channel(payload.channel_id)
-        if not isinstance(channel, discord.Thread) or "4人の談話室" not in channel.name: return
-        message = await channel.fetch_message(payload.message_id)
+        with stage_timer("reaction.fetch_message"):
+            channel = await client.fetch_channel(payload.channel_id)
+            if not isinstance(channel, discord.Thread) or "4人の談話室" not in channel.name: return
+            message = await channel.fetch_message(payload.message_id)
     except discord.NotFound: return
 
-    emoji_map = { '🐦': ('Xポスト案生成', X_POST_PROMPT), '✏️': ('Obsidianメモ生成', OBSIDIAN_MEMO_PROMPT), '📝': ('PREP記事作成', PREP_ARTICLE_PROMPT), '💎': ('対話の振り返り', COMBO_SUMMARY_SELF_PROMPT), '🧠': ('Deep Diveノート作成', DEEP_DIVE_PROMPT) }
+    emoji_map = { '🐦': ('Xポスト案生成', X_POST_PROMPT, 'x_post'), '✏️': ('Obsidianメモ生成', OBSIDIAN_MEMO_PROMPT, 'obsidian_memo'), '📝': ('PREP記事作成', PREP_ARTICLE_PROMPT, 'prep_article'), '💎': ('対話の振り返り', COMBO_SUMMARY_SELF_PROMPT, 'combo_summary'), '🧠': ('Deep Diveノート作成', DEEP_DIVE_PROMPT, 'deep_dive') }
 
     if payload.emoji.name == '🎨':
         image_url = None
@@ -938,23 +3095,35 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
         if image_url:
              await channel.send(f"（`🎨`を検知。この画像のスタイルを学習します...）", delete_after=10.0)
              source_prompt = message.embeds[0].footer.text if message.embeds and message.embeds[0].footer else ""
-             await ask_learner("styles", {'image_url': image_url, 'source_prompt': source_prompt})
+             with stage_timer("reaction.style_learning"):
+                 await ask_learner("styles", {'image_url': image_url, 'source_prompt': source_prompt})
         return
 
     if payload.emoji.name in emoji_map:
-        ability_name, system_prompt_template = emoji_map[payload.emoji.name]
+        ability_name, system_prompt_template, ability = emoji_map[payload.emoji.name]
         logging.info(f"{payload.emoji.name}リアクションを検知。『{ability_name}』を発動します。")
         await channel.send(f"（『{ability_name}』を開始します...{payload.emoji.name}）", delete_after=10.0)
         prompt = system_prompt_template.replace("{{conversation_history}}", message.content)
         async with channel.typing():
-            response_text = await analyze_with_gemini(prompt, model_name=MODEL_PRO)
-            await channel.send(response_text)
+            with stage_timer("reaction.ability_generation"):
+                response_text = await generate_routed(prompt, ability, input_text=message.content)
+            with stage_timer("reaction.send"):
+                await channel.send(response_text)
 
 
 # --- 9. Botの起動 (Main Execution Block) ---
-if __name__ == "__main__":
+def main():
+    """
+    Botを起動する。APIクライアントの設定など、起動時にだけ必要な副作用はここで行う。
+    テキスト抽出のワーカープロセスは __main__ モジュールを読み込み直すため、通常は run_bot.py から呼び出す。
+    """
     logging.info("Botの起動シーケンスを開始します...")
+    genai.configure(api_key=GEMINI_API_KEY)
     if init_vertex_ai():
         client.run(DISCORD_BOT_TOKEN)
     else:
         logging.critical("Vertex AIの初期化に失敗したため、起動を中止します。")
+
+if __name__ == "__main__":
+    logging.warning("bot_main.py を直接実行すると、テキスト抽出のワーカープロセスがこのモジュール全体を読み込み直します。run_bot.py から起動してください。")
+    main()
@@ -0,0 +1,208 @@
+# extraction.py
+# PDFからのテキスト抽出を、Discordのイベントループとは別のプロセスで行うためのモジュール。
+# ProcessPoolExecutor のワーカープロセスから呼び出されるため、ここの関数は bot_main に依存せず、
+# 引数と戻り値は全てpickle可能な値にしている。
+# HTMLはダウンロードしながら親プロセスの逐次パーサー(MainTextParser)で読むため、プロセスプールは使わない。
+
+import asyncio
+import codecs
+import logging
+import multiprocessing
+import re
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import resource  # POSIXのみ。無い環境ではCPU時間の上限は掛けられない
+except ImportError:
+    resource = None
+
+# ワーカープロセスの起動方式
+EXTRACTION_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class ExtractionLimitExceeded(Exception):
+    """抽出ジョブがCPU時間などの上限を超えた。"""
+
+
+# --- ワーカープロセス側 ---
+
+def _on_cpu_limit(signum, frame):
+    raise ExtractionLimitExceeded("テキスト抽出がCPU時間の上限を超えました。")
+
+def init_worker():
+    """ワーカープロセスの初期化。Ctrl+C は親プロセスだけが受け取り、CPU時間超過は例外として扱う。"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+
+@contextmanager
+def cpu_time_limit(seconds: float):
+    """
+    このプロセスがこれから使えるCPU時間を seconds 秒に制限する。
+    RLIMIT_CPU はプロセスの累計に対する上限のため、現在の使用量に上乗せした値を設定し、終了後に元へ戻す。
+    """
+    if resource is None or seconds <= 0:
+        yield
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    limit = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+def extract_pdf_text(data: bytes, max_pages: int, char_budget: int, cpu_seconds: float = 0) -> Dict[str, Any]:
+    """
+    PDFの先頭から最大 max_pages ページのテキストを抽出する。char_budget 文字に達した時点で読み進めるのをやめる。
+    戻り値: {"text", "pages_read", "page_count", "truncated"}
+    """
+    import fitz
+
+    with cpu_time_limit(cpu_seconds), fitz.open(stream=data, filetype="pdf") as doc:
+        parts = []
+        total = 0
+        for page in doc:
+            if len(parts) >= max_pages or total >= char_budget:
+                break
+            text = page.get_text()
+            parts.append(text)
+            total += len(text)
+        return {
+            "text": "".join(parts)[:char_budget],
+            "pages_read": len(parts),
+            "page_count": doc.page_count,
+            "truncated": len(parts) < doc.page_count or total > char_budget,
+        }
+
+
+# --- ストリーミング用の逐次パーサー（親プロセスのイベントループ上で使う） ---
+
+# 本文として読まない要素（ナビゲーションなどの本文以外の要素と、テキストを持たない要素）
+STREAM_SKIPPED_TAGS = {"script", "style", "nav", "footer", "header", "aside", "noscript", "template", "svg", "iframe"}
+_META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([A-Za-z0-9_-]+)', re.IGNORECASE)
+
+def sniff_charset(head: bytes) -> Optional[str]:
+    """HTMLの先頭部分の <meta charset> から文字コードを推定する。"""
+    match = _META_CHARSET.search(head[:4096])
+    if not match:
+        return None
+    charset = match.group(1).decode("ascii")
+    try:
+        codecs.lookup(charset)
+        return charset
+    except LookupError:
+        return None
+
+class MainTextParser(HTMLParser):
+    """
+    チャンクごとに feed() できる、本文テキスト抽出用のHTMLトークナイザー。
+    script/style/nav などの中身は読みながら捨て、集めた文字数が char_budget に達したら done になる。
+    保持するのは抽出済みのテキストと、未完了のタグ1つ分のバッファだけなので、ページ全体の木は作らない。
+    """
+
+    def __init__(self, char_budget: int):
+        super().__init__(convert_charrefs=True)
+        self.char_budget = char_budget
+        self.char_count = 0
+        self._parts: List[str] = []
+        self._skip_depth: Dict[str, int] = {}
+
+    @property
+    def done(self) -> bool:
+        return self.char_count >= self.char_budget
+
+    def handle_starttag(self, tag, attrs):
+        if tag in STREAM_SKIPPED_TAGS:
+            self._skip_depth[tag] = self._skip_depth.get(tag, 0) + 1
+
+    def handle_endtag(self, tag):
+        if self._skip_depth.get(tag):
+            self._skip_depth[tag] -= 1
+
+    def handle_data(self, data):
+        if self.done or any(self._skip_depth.values()):
+            return
+        text = " ".join(data.split())
+        if text:
+            self._parts.append(text)
+            self.char_count += len(text) + 1
+
+    def text(self) -> str:
+        return " ".join(self._parts)[:self.char_budget]
+
+
+# --- 親プロセス側 ---
+
+class ExtractionService:
+    """
+    抽出処理をプロセスプールで実行する。workers=0 の場合はイベントループ上で直接実行する（比較計測用）。
+    ワーカーが異常終了してプールが壊れた場合は、次の呼び出しで作り直す。
+    """
+
+    def __init__(self, workers: int, cpu_seconds: float, timeout: float):
+        self.workers = workers
+        self.cpu_seconds = cpu_seconds
+        self.timeout = timeout
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # fork はイベントループやスレッドのロック状態まで複製してしまうため使わない。
+            # forkserver のサーバーにはこのモジュールだけを読み込ませ、ワーカーはそこから fork する（使えない環境では spawn）。
+            # どちらの方式でもワーカーは __main__ を読み込み直すので、Botは bot_main を import しない run_bot.py から起動する。
+            context = multiprocessing.get_context(EXTRACTION_START_METHOD)
+            if EXTRACTION_START_METHOD == "forkserver":
+                context.set_forkserver_preload([__name__])
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=init_worker)
+        return self._pool
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self.workers <= 0:
+            return func(*args)
+        pool = self._get_pool()
+        try:
+            return await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(pool, func, *args), timeout=self.timeout)
+        except BrokenProcessPool:
+            logging.error("テキスト抽出のワーカープロセスが異常終了したため、プールを作り直します。")
+            self._discard_pool(pool)
+            raise
+        except asyncio.TimeoutError:
+            # wait_for が取り消すのは待っている側だけで、ワーカーはジョブを続けて実行枠を占有し続ける。
+            # PyMuPDF のC関数の中ではSIGXCPUのハンドラも動かないため、ワーカーごと止めて次の呼び出しで作り直す。
+            logging.error(f"テキスト抽出が{self.timeout}秒以内に終わらなかったため、ワーカープロセスを停止してプールを作り直します。")
+            self._discard_pool(pool, terminate=True)
+            raise
+
+    def _discard_pool(self, pool: ProcessPoolExecutor, terminate: bool = False):
+        """プールを捨てる。terminate=True なら実行中のワーカープロセスも止める（同じプールで実行中の他のジョブも失敗する）。"""
+        if self._pool is pool:
+            self._pool = None
+        if terminate:
+            if hasattr(pool, "terminate_workers"):  # Python 3.14以降
+                pool.terminate_workers()
+                return
+            for process in list((pool._processes or {}).values()):
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def _job_cpu_seconds(self) -> float:
+        # CPU時間の上限はワーカープロセスでのみ掛ける（Bot本体のプロセスに掛けると、超過時にBotごと止まる）
+        return self.cpu_seconds if self.workers > 0 else 0
+
+    async def extract_pdf(self, data: bytes, max_pages: int, char_budget: int) -> Dict[str, Any]:
+        return await self.run(extract_pdf_text, data, max_pages, char_budget, self._job_cpu_seconds)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
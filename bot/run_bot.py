@@ -0,0 +1,10 @@
+# run_bot.py
+# Botの起動用エントリーポイント（`python run_bot.py`）。
+# テキスト抽出のワーカープロセスは起動時に __main__ モジュールを読み込み直すため、このファイルの
+# トップレベルでは何も import せず、bot_main の読み込みと起動は __main__ として実行されたときだけ行う。
+# こうしておくと、ワーカーが discord や vertexai の import、Discordクライアントの生成などを繰り返さずに済む。
+
+if __name__ == "__main__":
+    import bot_main
+
+    bot_main.main()
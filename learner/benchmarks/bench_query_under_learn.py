@@ -0,0 +1,82 @@
+# bench_query_under_learn.py
+# 大きな /learn が同時に走っている間の /query のレイテンシ(p50/p95/p99)を計測するベンチマーク。
+#
+# 使い方（起動中のLearnerに対して実行する）:
+#   # 変更前の挙動: ブロッキングI/Oをイベントループ上で直接実行
+#   LEARNER_BLOCKING_POOL_SIZE=0 uvicorn learner_main:app --port 8000
+#   python benchmarks/bench_query_under_learn.py --base-url http://localhost:8000
+#
+#   # 変更後の挙動: 上限付きワーカープールで実行
+#   LEARNER_BLOCKING_POOL_SIZE=8 uvicorn learner_main:app --port 8000
+#   python benchmarks/bench_query_under_learn.py --base-url http://localhost:8000
+#
+# 注意: /learn は実際に documents テーブルへ書き込むため、検証用のSupabaseプロジェクトで実行すること。
+
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import requests
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """最近傍法によるパーセンタイル。"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def learn_loop(base_url: str, text: str, stop: threading.Event, counter: List[int]):
+    while not stop.is_set():
+        metadata = {"source": "benchmark", "filename": "bench_query_under_learn.txt", "user_id": "benchmark", "username": "benchmark"}
+        job_id = requests.post(f"{base_url}/learn", json={"text_content": text, "metadata": metadata}, timeout=600).json().get("job_id")
+        # /learn はジョブIDをすぐに返すため、ジョブの完了を待ってから次を投げる
+        while job_id and not stop.is_set():
+            if requests.get(f"{base_url}/learn/{job_id}", timeout=30).json().get("status") in ("succeeded", "failed", "partial"):
+                break
+            time.sleep(0.5)
+        counter[0] += 1
+
+
+def query_once(base_url: str, query_text: str) -> float:
+    started = time.perf_counter()
+    response = requests.post(f"{base_url}/query", json={"query_text": query_text}, timeout=120)
+    response.raise_for_status()
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同時 /learn 負荷下での /query のレイテンシを計測する")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--learn-workers", type=int, default=2, help="同時に /learn を送り続けるクライアント数")
+    parser.add_argument("--learn-chars", type=int, default=50_000, help="1回の /learn で送るテキストの文字数")
+    parser.add_argument("--query-workers", type=int, default=8, help="同時に /query を送るクライアント数")
+    parser.add_argument("--queries", type=int, default=200, help="計測する /query の総数")
+    args = parser.parse_args()
+
+    text = ("木工とコーヒーとAIについての長いメモ。" * (args.learn_chars // 20 + 1))[:args.learn_chars]
+    stop = threading.Event()
+    learned = [0]
+    learners = [threading.Thread(target=learn_loop, args=(args.base_url, text, stop, learned), daemon=True) for _ in range(args.learn_workers)]
+    for thread in learners:
+        thread.start()
+    time.sleep(1.0)  # /learn が走り始めるのを待つ
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.query_workers) as pool:
+        latencies = list(pool.map(lambda i: query_once(args.base_url, f"最近の関心事 {i % 10}"), range(args.queries)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+
+    print(f"/query x{args.queries} (並列{args.query_workers}) / 同時 /learn クライアント{args.learn_workers} (完了{learned[0]}件)")
+    print(f"  throughput: {args.queries / elapsed:.1f} req/s")
+    print(f"  mean: {statistics.mean(latencies):.1f} ms")
+    for pct in (50, 95, 99):
+        print(f"  p{pct}: {percentile(latencies, pct):.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# fakes.py
+# ベンチマーク用の、SupabaseとGoogleの埋め込みAPIのローカルな代替実装。
+# install() を learner_main の import より前に呼ぶと、supabase と langchain_google_genai が
+# この実装に差し替えられ、ネットワークに一切出ずにFastAPIアプリを動かせるようになる。
+
+import hashlib
+import itertools
+import sys
+import threading
+import time
+import types
+import uuid
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+EMBEDDING_DIM = 768
+
+
+class FakeResponse:
+    def __init__(self, data: List[Dict[str, Any]], count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+
+class FakeParams(dict):
+    """postgrestのQueryParamsと同じく set() で値を追加できる辞書。"""
+
+    def set(self, key: str, value: Any) -> "FakeParams":
+        updated = FakeParams(self)
+        updated[key] = value
+        return updated
+
+
+class FakeQuery:
+    """supabase-pyのクエリビルダーのうち、learner_main とSupabaseVectorStoreが使う部分だけを実装したもの。"""
+
+    def __init__(self, db: "FakeSupabaseClient", table: str):
+        self._db = db
+        self._table = table
+        self._action = "select"
+        self._payload: Any = None
+        self._filters = []
+        self._order: Optional[tuple] = None
+        self._limit: Optional[int] = None
+        self._range: Optional[tuple] = None
+        self._count = None
+
+    def select(self, columns: str = "*", count: Optional[str] = None) -> "FakeQuery":
+        self._count = count
+        return self
+
+    def insert(self, payload) -> "FakeQuery":
+        self._action, self._payload = "insert", payload
+        return self
+
+    def upsert(self, payload) -> "FakeQuery":
+        self._action, self._payload = "upsert", payload
+        return self
+
+    def update(self, payload) -> "FakeQuery":
+        self._action, self._payload = "update", payload
+        return self
+
+    def delete(self) -> "FakeQuery":
+        self._action = "delete"
+        return self
+
+    def eq(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def neq(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) != value)
+        return self
+
+    def in_(self, column: str, values: List[Any]) -> "FakeQuery":
+        wanted = set(values)
+        self._filters.append(lambda row: row.get(column) in wanted)
+        return self
+
+    def is_(self, column: str, value: Any) -> "FakeQuery":
+        expected = None if value in (None, "null") else value
+        self._filters.append(lambda row: row.get(column) is expected)
+        return self
+
+    def order(self, column: str, desc: bool = False) -> "FakeQuery":
+        self._order = (column, desc)
+        return self
+
+    def limit(self, size: int) -> "FakeQuery":
+        self._limit = size
+        return self
+
+    def range(self, start: int, end: int) -> "FakeQuery":
+        self._range = (start, end)
+        return self
+
+    def _matches(self, row: Dict[str, Any]) -> bool:
+        return all(check(row) for check in self._filters)
+
+    def execute(self) -> FakeResponse:
+        self._db.simulate_latency()
+        with self._db.lock:
+            rows = self._db.tables.setdefault(self._table, [])
+            if self._action in ("insert", "upsert"):
+                payload = self._payload if isinstance(self._payload, list) else [self._payload]
+                inserted = [self._db.new_row(self._table, item) for item in payload]
+                rows.extend(inserted)
+                return FakeResponse([dict(row) for row in inserted])
+            if self._action == "update":
+                updated = [row for row in rows if self._matches(row)]
+                for row in updated:
+                    row.update(self._payload)
+                return FakeResponse([dict(row) for row in updated])
+            if self._action == "delete":
+                removed = [row for row in rows if self._matches(row)]
+                self._db.tables[self._table] = [row for row in rows if not self._matches(row)]
+                return FakeResponse(removed)
+
+            selected = [row for row in rows if self._matches(row)]
+            if self._order:
+                column, desc = self._order
+                selected.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+            total = len(selected)
+            if self._range:
+                selected = selected[self._range[0]:self._range[1] + 1]
+            if self._limit is not None:
+                selected = selected[:self._limit]
+            return FakeResponse([dict(row) for row in selected], count=total if self._count else None)
+
+
+class FakeRpc:
+    """`match_documents` RPC の代替。コサイン類似度で documents を並べ替えて返す。"""
+
+    def __init__(self, db: "FakeSupabaseClient", name: str, params: Dict[str, Any]):
+        if name != "match_documents":
+            raise ValueError(f"未対応のRPCです: {name}")
+        self._db = db
+        self.params = FakeParams(params)
+
+    def execute(self) -> FakeResponse:
+        self._db.simulate_latency()
+        query = np.asarray(self.params["query_embedding"], dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        wanted_metadata = self.params.get("filter") or {}
+        limit = int(self.params.get("limit", 5))
+        with self._db.lock:
+            rows = [row for row in self._db.tables.get("documents", [])
+                    if all((row.get("metadata") or {}).get(key) == value for key, value in wanted_metadata.items())]
+            if not rows:
+                return FakeResponse([])
+            matrix = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+        similarities = (matrix @ query) / np.maximum(np.linalg.norm(matrix, axis=1), 1e-12)
+        order = np.argsort(-similarities)[:limit]
+        return FakeResponse([{**{k: rows[i][k] for k in ("id", "content", "metadata")}, "similarity": float(similarities[i])} for i in order])
+
+
+class FakeSupabaseClient:
+    """テーブルをメモリ上のリストとして保持する、supabase.Client の代替。"""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.lock = threading.Lock()
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self._ids = itertools.count(1)
+
+    def simulate_latency(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def new_row(self, table: str, item: Dict[str, Any]) -> Dict[str, Any]:
+        row = dict(item)
+        if "id" not in row:
+            row["id"] = str(uuid.uuid4()) if table == "documents" else next(self._ids)
+        row.setdefault("created_at", time.time())
+        return row
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    from_ = table
+
+    def rpc(self, name: str, params: Dict[str, Any]) -> FakeRpc:
+        return FakeRpc(self, name, params)
+
+    def reset(self):
+        with self.lock:
+            self.tables.clear()
+
+
+def fake_vector(text: str) -> List[float]:
+    """テキストのハッシュから決まる、決定的な単位ベクトル。"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIM).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeEmbeddings:
+    """GoogleGenerativeAIEmbeddings の代替。1回の呼び出しごとに latency_ms だけ待つ。"""
+
+    latency_ms = 0.0
+
+    def __init__(self, model: str = "", google_api_key: str = "", **kwargs):
+        self.model = model
+        self.calls = 0
+
+    def embed_query(self, text: str, **kwargs) -> List[float]:
+        self.calls += 1
+        time.sleep(self.latency_ms / 1000)
+        return fake_vector(text)
+
+    def embed_documents(self, texts: List[str], **kwargs) -> List[List[float]]:
+        self.calls += 1
+        time.sleep(self.latency_ms / 1000)
+        return [fake_vector(text) for text in texts]
+
+
+fake_supabase = FakeSupabaseClient()
+
+
+def install(supabase_latency_ms: float = 0.0, embedding_latency_ms: float = 0.0):
+    """supabase と langchain_google_genai を代替実装に差し替え、必要な環境変数にダミー値を入れる。"""
+    import os
+
+    fake_supabase.latency_ms = supabase_latency_ms
+    FakeEmbeddings.latency_ms = embedding_latency_ms
+
+    supabase_module = types.ModuleType("supabase")
+    client_module = types.ModuleType("supabase.client")
+    client_module.Client = FakeSupabaseClient
+    client_module.create_client = lambda url, key: fake_supabase
+    supabase_module.client = client_module
+    supabase_module.Client = FakeSupabaseClient
+    supabase_module.create_client = client_module.create_client
+    sys.modules["supabase"] = supabase_module
+    sys.modules["supabase.client"] = client_module
+
+    genai_embeddings_module = types.ModuleType("langchain_google_genai")
+    genai_embeddings_module.GoogleGenerativeAIEmbeddings = FakeEmbeddings
+    sys.modules["langchain_google_genai"] = genai_embeddings_module
+
+    os.environ.setdefault("SUPABASE_URL", "http://fake-supabase.local")
+    os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "fake-service-role-key")
+    os.environ.setdefault("GOOGLE_API_KEY", "fake-google-api-key")
+
+
+def seed_corpus(size: int, chunk_chars: int = 800):
+    """documents テーブルに size 件の記憶を直接投入し、その他のテーブルにも読み取り用の行を入れる。"""
+    fake_supabase.reset()
+    words = ["木工", "コーヒー", "AI", "デザイン", "岩手", "森", "経営", "ガジェット", "伝統", "未来"]
+    with fake_supabase.lock:
+        documents = fake_supabase.tables.setdefault("documents", [])
+        for i in range(size):
+            content = (f"記憶{i}: " + " ".join(words[(i + j) % len(words)] for j in range(20)) + "。") * (chunk_chars // 80 + 1)
+            content = content[:chunk_chars]
+            documents.append(fake_supabase.new_row("documents", {
+                "content": content,
+                "metadata": {"source": "benchmark", "filename": f"seed-{i % 20}.txt", "user_id": "benchmark"},
+                "embedding": fake_vector(content),
+            }))
+        fake_supabase.tables["character_states"] = [fake_supabase.new_row("character_states", {
+            "mirai_mood": "上機嫌", "heko_mood": "共感", "last_interaction_summary": "ベンチマーク用の状態。"})]
+        fake_supabase.tables["styles"] = [fake_supabase.new_row("styles", {
+            "style_name": f"style-{i}", "style_analysis_json": {"style_name": f"style-{i}", "style_keywords": ["lo-fi", "90s anime"]}})
+            for i in range(10)]
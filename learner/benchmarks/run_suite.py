@@ -0,0 +1,139 @@
+# run_suite.py
+# Learnerのオフライン・ベンチマークスイート。
+# Supabaseと埋め込みAPIを fakes.py の代替実装に差し替えたうえで、FastAPIアプリをプロセス内で直接呼び出し、
+# コーパスサイズと同時実行数ごとに各エンドポイントのスループットと p50/p95/p99 レイテンシを表示する。
+#
+# 使い方（learner/requirements.txt に加えて httpx と numpy が必要）:
+#   cd learner
+#   python benchmarks/run_suite.py
+#   python benchmarks/run_suite.py --corpus-sizes 100 1000 --concurrency 1 16 --supabase-latency-ms 20 --embedding-latency-ms 80
+#   python benchmarks/run_suite.py --json results.json   # 結果をJSONでも保存（変更前後の比較用）
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakes  # noqa: E402
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """最近傍法によるパーセンタイル。"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def wait_for_learn_job(http, job_id: str):
+    while True:
+        job = (await http.get(f"/learn/{job_id}")).json()
+        if job["status"] in ("succeeded", "failed", "partial"):
+            return job
+        await asyncio.sleep(0.005)
+
+
+def scenarios(learn_chars: int) -> Dict[str, Callable[[Any, int], Any]]:
+    """エンドポイント名 → 1リクエストを送るコルーチン関数。/learn はジョブの完了までを計測する。"""
+    learn_text = ("imazineとの会話の記録。木工とコーヒーとAIについて。" * (learn_chars // 25 + 1))[:learn_chars]
+
+    async def learn(http, i):
+        response = await http.post("/learn", json={"text_content": f"{i}: {learn_text}", "metadata": {"source": "benchmark", "filename": f"bench-{i}.txt", "user_id": "benchmark"}})
+        response.raise_for_status()
+        job = await wait_for_learn_job(http, response.json()["job_id"])
+        if job["status"] != "succeeded":
+            raise RuntimeError(job["error"])
+
+    async def query(http, i):
+        (await http.post("/query", json={"query_text": f"最近のimazineの関心事 {i}"})).raise_for_status()
+
+    async def character_state(http, i):
+        (await http.get("/character_state")).raise_for_status()
+
+    async def styles(http, i):
+        (await http.get("/styles")).raise_for_status()
+
+    return {"/learn": learn, "/query": query, "/character_state": character_state, "/styles": styles}
+
+
+async def measure(http, send, requests: int, concurrency: int) -> Dict[str, float]:
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            await send(http, i)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "throughput_rps": requests / elapsed,
+        "mean_ms": statistics.mean(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+async def run(args) -> List[Dict[str, Any]]:
+    import httpx
+    import learner_main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.local_index:
+        learner_main.LOCAL_VECTOR_INDEX = True
+
+    results = []
+    transport = httpx.ASGITransport(app=learner_main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://learner.bench") as http:
+        for corpus_size in args.corpus_sizes:
+            for concurrency in args.concurrency:
+                for endpoint, send in scenarios(args.learn_chars).items():
+                    if args.endpoints and endpoint not in args.endpoints:
+                        continue
+                    fakes.seed_corpus(corpus_size)
+                    if args.local_index:
+                        learner_main.local_index.load()
+                    requests = args.learn_requests if endpoint == "/learn" else args.requests
+                    result = {"endpoint": endpoint, "corpus_size": corpus_size, "concurrency": concurrency}
+                    result.update(await measure(http, send, requests, concurrency))
+                    results.append(result)
+                    print(f"{endpoint:<17} corpus={corpus_size:<6} conc={concurrency:<3} "
+                          f"{result['throughput_rps']:8.1f} req/s  p50={result['p50_ms']:8.1f}ms  "
+                          f"p95={result['p95_ms']:8.1f}ms  p99={result['p99_ms']:8.1f}ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Learnerのオフライン・ベンチマークスイート")
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--endpoints", nargs="+", default=None, help="計測するエンドポイント（既定は全て）")
+    parser.add_argument("--requests", type=int, default=200, help="/learn 以外のエンドポイントごとのリクエスト数")
+    parser.add_argument("--learn-requests", type=int, default=20, help="/learn のリクエスト数")
+    parser.add_argument("--learn-chars", type=int, default=20_000, help="1回の /learn で送るテキストの文字数")
+    parser.add_argument("--supabase-latency-ms", type=float, default=0.0, help="Supabaseの1呼び出しごとに加える擬似的な遅延")
+    parser.add_argument("--embedding-latency-ms", type=float, default=0.0, help="埋め込みAPIの1呼び出しごとに加える擬似的な遅延")
+    parser.add_argument("--local-index", action="store_true", help="ローカルベクトルインデックスを有効にして計測する")
+    parser.add_argument("--json", help="結果を保存するJSONファイルのパス")
+    args = parser.parse_args()
+
+    fakes.install(args.supabase_latency_ms, args.embedding_latency_ms)
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,22 @@
 
 import os
 import logging
+import asyncio
+import functools
+import contextvars
+from contextlib import contextmanager
 import datetime as dt
-from fastapi import FastAPI, HTTPException
+import uuid
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Callable
 
 import google.generativeai as genai
 from langchain_community.vectorstores.supabase import SupabaseVectorStore
@@ -18,15 +30,129 @@ import requests
 import re
 import json
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
 # --- 1. 初期設定 ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - [%(levelname)s] - %(message)s')
+# Botから X-Request-ID ヘッダーで渡されるリクエストID。Botと同じIDでログを追跡できる。
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    """ログレコードに現在のリクエストIDを付与する。"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - [%(levelname)s] - [%(request_id)s] %(message)s')
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(RequestIdFilter())
 app = FastAPI(
     title="Learner API - The Soul of MIRAI-HEKO-Bot",
     description="This API manages the long-term memory, style palette, character states, and soul records, based on imazine's final design.",
     version="4.2.0" # Reflecting the latest fixes
 )
 
+# --- 1.1. 計測とメトリクス ---
+# エンドポイントごと、Supabaseなどの外部呼び出しごとの所要時間をヒストグラムに記録し、/metrics でPrometheus形式で公開する。
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+class Histogram:
+    """ラベルごとに観測値の分布を保持する、Prometheus形式のヒストグラム。"""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series: Dict[Tuple[Tuple[str, Any], ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        with self._lock:
+            series = self._series.setdefault(tuple(labels.items()), [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._series.items():
+                labels = dict(key)
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+def render_gauge(name: str, help_text: str, samples: List[Tuple[Dict[str, Any], float]]) -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"] + [f"{name}{_format_labels(labels)} {value}" for labels, value in samples]
+
+REQUEST_SECONDS = Histogram("learner_request_seconds", "Duration of Learner API requests per endpoint.")
+IO_SECONDS = Histogram("learner_io_seconds", "Duration of Supabase, embedding and other external calls.")
+# /metrics で出力する読み出し時計算のゲージ。 名前 → (説明, サンプルを返す関数)
+METRIC_GAUGES: Dict[str, Tuple[str, Callable[[], List[Tuple[Dict[str, Any], float]]]]] = {}
+
+@contextmanager
+def track_io(op: str):
+    """with ブロック内の外部呼び出しの所要時間を、操作名をラベルにして記録する。"""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        IO_SECONDS.observe(time.perf_counter() - started, op=op, outcome=outcome)
+
+def timed(op: str, func: Callable) -> Callable:
+    """func を呼び出すたびに track_io(op) で計測する関数を返す。"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with track_io(op):
+            return func(*args, **kwargs)
+    return wrapper
+
+def supabase_execute(op: str, query):
+    """Supabaseのクエリを実行し、その所要時間を`supabase.<op>`として記録する。"""
+    with track_io(f"supabase.{op}"):
+        return query.execute()
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """リクエストIDを引き継ぎ、エンドポイントごとの所要時間を記録する。"""
+    request_id = request.headers.get("X-Request-ID") or f"learner-{uuid.uuid4().hex[:12]}"
+    token = request_id_var.set(request_id)
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method, endpoint=getattr(route, "path", "unmatched"), status=status)
+        request_id_var.reset(token)
+
 # --- 2. クライアント初期化 ---
+EMBEDDING_MODEL = "models/embedding-001"
+
 try:
     supabase_url = os.environ.get("SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
@@ -40,7 +166,7 @@ try:
         raise ValueError("GOOGLE_API_KEYが設定されていません。")
     genai.configure(api_key=google_api_key)
     
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=google_api_key)
+    embeddings = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL, google_api_key=google_api_key)
     logging.info("Google Generative AI Embeddings initialized successfully.")
 
     text_splitter = RecursiveCharacterTextSplitter(
@@ -62,6 +188,374 @@ except Exception as e:
     logging.critical(f"FATAL: クライアント初期化中にエラー: {e}")
     raise e
 
+# --- 2.1. ブロッキングI/O用のワーカープール ---
+# supabase-pyの.execute()、ベクトルストア、requestsは同期APIのため、イベントループを止めないよう
+# 上限付きのスレッドプールで実行する。同時に実行されるブロッキング呼び出しの数はプールの大きさで制限される。
+# LEARNER_BLOCKING_POOL_SIZE=0 にすると、比較計測用に従来どおりイベントループ上で直接実行する。
+LEARNER_BLOCKING_POOL_SIZE = int(os.environ.get("LEARNER_BLOCKING_POOL_SIZE", "8"))
+blocking_executor = ThreadPoolExecutor(max_workers=max(LEARNER_BLOCKING_POOL_SIZE, 1), thread_name_prefix="learner-io")
+
+async def run_blocking(func, *args, **kwargs):
+    """同期関数をワーカープール上で実行し、その結果を待つ。"""
+    if LEARNER_BLOCKING_POOL_SIZE <= 0:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    # リクエストIDなどのコンテキスト変数をワーカースレッドに引き継ぐ
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(blocking_executor, context.run, functools.partial(func, *args, **kwargs))
+
+
+# --- 2.2. 問い合わせベクトルのキャッシュ ---
+# 同じ問い合わせテキストは同じベクトルになるため、内容のハッシュをキーにしてキャッシュし、
+# ヒットした場合は埋め込みAPIを呼ばずにベクトルで検索する。
+# メモリ上のLRU（EMBEDDING_CACHE_SIZE件）に加えて、EMBEDDING_CACHE_PATH を指定すると
+# 再起動後も残るSQLiteのディスク層を使う。ディスク層は最後に使われた時刻で管理し、
+# EMBEDDING_CACHE_DISK_MAX_AGE_SECONDS 以上使われていないものと、EMBEDDING_CACHE_DISK_MAX_ENTRIES 件を超えた古いものを消す。
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "1024"))
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH")
+EMBEDDING_CACHE_DISK_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_DISK_MAX_ENTRIES", "100000"))
+EMBEDDING_CACHE_DISK_MAX_AGE_SECONDS = float(os.environ.get("EMBEDDING_CACHE_DISK_MAX_AGE_SECONDS", str(30 * 24 * 3600)))
+EMBEDDING_CACHE_PRUNE_INTERVAL = int(os.environ.get("EMBEDDING_CACHE_PRUNE_INTERVAL", "100"))
+
+class QueryEmbeddingCache:
+    """問い合わせテキストの埋め込みベクトルを、メモリ(LRU)とディスク(SQLite)の2層でキャッシュする。"""
+
+    def __init__(self, maxsize: int, path: Optional[str] = None, disk_max_entries: int = 0, disk_max_age_seconds: float = 0.0, prune_interval: int = 100):
+        self.maxsize = maxsize
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_age_seconds = disk_max_age_seconds
+        self.prune_interval = max(1, prune_interval)
+        self._stores_since_prune = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, vector TEXT NOT NULL, created_at REAL NOT NULL)")
+            # 以前の版で作られたファイルには最終使用時刻の列が無いため、後から足す
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(query_embeddings)")}
+            if "accessed_at" not in columns:
+                self._db.execute("ALTER TABLE query_embeddings ADD COLUMN accessed_at REAL")
+                self._db.execute("UPDATE query_embeddings SET accessed_at = created_at")
+            self._db.execute("CREATE INDEX IF NOT EXISTS query_embeddings_accessed_at ON query_embeddings (accessed_at)")
+            self._prune_disk()
+            self._db.commit()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """キャッシュのキーにも埋め込みAPIにも、この正規化済みの文字列を使う。"""
+        return text.strip()
+
+    @staticmethod
+    def cache_key(text: str) -> str:
+        """normalize 済みのテキストからキーを作る。"""
+        return hashlib.sha256(f"{EMBEDDING_MODEL}\n{text}".encode("utf-8")).hexdigest()
+
+    def _prune_disk(self):
+        """ディスク層から、長く使われていないものと件数の上限を超えた古いものを消す。_lock を持った状態で呼ぶ。"""
+        if self.disk_max_age_seconds > 0:
+            self._db.execute("DELETE FROM query_embeddings WHERE accessed_at < ?", (time.time() - self.disk_max_age_seconds,))
+        if self.disk_max_entries > 0:
+            self._db.execute(
+                "DELETE FROM query_embeddings WHERE key IN (SELECT key FROM query_embeddings ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.disk_max_entries,),
+            )
+        self._stores_since_prune = 0
+
+    def _remember(self, key: str, vector: List[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def lookup(self, text: str) -> Optional[List[float]]:
+        """normalize 済みのテキストについて、キャッシュ済みのベクトルを返す。見つからなければ None。"""
+        key = self.cache_key(text)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT vector FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+                if row:
+                    self._db.execute("UPDATE query_embeddings SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    vector = json.loads(row[0])
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+        return None
+
+    def store(self, text: str, vector: List[float], elapsed: float = 0.0):
+        key = self.cache_key(text)
+        with self._lock:
+            self.misses += 1
+            self.miss_seconds += elapsed
+            self._remember(key, vector)
+            if self._db is not None:
+                now = time.time()
+                self._db.execute("INSERT OR REPLACE INTO query_embeddings (key, vector, created_at, accessed_at) VALUES (?, ?, ?, ?)", (key, json.dumps(vector), now, now))
+                self._stores_since_prune += 1
+                if self._stores_since_prune >= self.prune_interval:
+                    self._prune_disk()
+                self._db.commit()
+
+    def embed_query(self, text: str) -> List[float]:
+        """キャッシュにあればそれを、なければ埋め込みAPIを呼んで結果を保存してから返す。"""
+        text = self.normalize(text)
+        vector = self.lookup(text)
+        if vector is not None:
+            return vector
+        started = time.perf_counter()
+        with track_io("embeddings.embed_query"):
+            vector = embeddings.embed_query(text)
+        self.store(text, vector, time.perf_counter() - started)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """複数の問い合わせをまとめてベクトル化する。キャッシュに無いものだけを1回の埋め込みAPI呼び出しで処理する。"""
+        texts = [self.normalize(text) for text in texts]
+        vectors: Dict[str, List[float]] = {}
+        for text in texts:
+            if text not in vectors:
+                vector = self.lookup(text)
+                if vector is not None:
+                    vectors[text] = vector
+        misses = list(dict.fromkeys(text for text in texts if text not in vectors))
+        if misses:
+            started = time.perf_counter()
+            with track_io("embeddings.embed_queries"):
+                # embed_query と同じベクトルになるよう、文書用ではなく問い合わせ用のタスク種別で埋め込む
+                embedded = embeddings.embed_documents(misses, task_type="retrieval_query")
+            elapsed = (time.perf_counter() - started) / len(misses)
+            for text, vector in zip(misses, embedded):
+                self.store(text, vector, elapsed)
+                vectors[text] = vector
+        return [vectors[text] for text in texts]
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        average_miss = self.miss_seconds / self.misses if self.misses else 0.0
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "average_embedding_ms": round(average_miss * 1000, 1),
+            "estimated_saved_ms": round(hits * average_miss * 1000, 1),
+            "memory_size": len(self._memory),
+        }
+
+query_embedding_cache = QueryEmbeddingCache(
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_PATH,
+    disk_max_entries=EMBEDDING_CACHE_DISK_MAX_ENTRIES,
+    disk_max_age_seconds=EMBEDDING_CACHE_DISK_MAX_AGE_SECONDS,
+    prune_interval=EMBEDDING_CACHE_PRUNE_INTERVAL,
+)
+
+# --- 2.3. ローカルベクトルインデックス (In-process Vector Index Mirror) ---
+# `documents`テーブルの埋め込みを正規化したNumPy行列としてメモリ上に複製し、top-kをプロセス内で計算する。
+# Supabaseは永続ストアのまま残し、起動時に全件を読み込み、/learn で追加分を反映し、
+# LOCAL_INDEX_DRIFT_CHECK_SECONDS ごとに件数を比較して食い違い(drift)があれば再読み込みする。
+# 件数が LOCAL_INDEX_HNSW_THRESHOLD を超え、hnswlib がインストールされていれば近似最近傍探索(HNSW)を使う。
+LOCAL_VECTOR_INDEX = os.environ.get("LOCAL_VECTOR_INDEX", "0") == "1"
+LOCAL_INDEX_PAGE_SIZE = int(os.environ.get("LOCAL_INDEX_PAGE_SIZE", "1000"))
+LOCAL_INDEX_DRIFT_CHECK_SECONDS = float(os.environ.get("LOCAL_INDEX_DRIFT_CHECK_SECONDS", "600"))
+LOCAL_INDEX_HNSW_THRESHOLD = int(os.environ.get("LOCAL_INDEX_HNSW_THRESHOLD", "50000"))
+
+def _parse_embedding(value: Any) -> List[float]:
+    """pgvectorの列は '[0.1,0.2,...]' という文字列で返ってくることがあるため、リストに揃える。"""
+    return json.loads(value) if isinstance(value, str) else list(value)
+
+def metadata_matches(metadata: Dict[str, Any], metadata_filter: Optional[Dict[str, Any]]) -> bool:
+    """メタデータが metadata_filter の全てのキーと値に完全一致するか。"""
+    return not metadata_filter or all(metadata.get(key) == value for key, value in metadata_filter.items())
+
+class MemoryCandidate:
+    """検索でヒットした記憶の断片1件。vector は再ランキング(MMR)のために、分かっている場合だけ持つ。"""
+
+    def __init__(self, content: str, metadata: Dict[str, Any], score: float, vector=None):
+        self.content = content
+        self.metadata = metadata
+        self.score = score
+        self.vector = vector
+        self.rerank_score: Optional[float] = None
+
+class LocalVectorIndex:
+    """`documents`テーブルのメモリ上の複製。コサイン類似度でtop-kを返す。"""
+
+    def __init__(self):
+        self.ready = False
+        self.loaded_at: Optional[str] = None
+        self.last_drift_check: Optional[dict] = None
+        self._lock = threading.Lock()
+        self._ids: List[str] = []
+        self._contents: List[str] = []
+        self._metadatas: List[Dict[str, Any]] = []
+        self._matrix = None
+        self._hnsw = None
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @staticmethod
+    def _normalize(vectors):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def _rebuild_hnsw(self):
+        self._hnsw = None
+        if hnswlib is None or len(self._ids) < LOCAL_INDEX_HNSW_THRESHOLD:
+            return
+        index = hnswlib.Index(space="ip", dim=self._matrix.shape[1])
+        index.init_index(max_elements=len(self._ids) * 2, ef_construction=200, M=16)
+        index.add_items(self._matrix, np.arange(len(self._ids)))
+        index.set_ef(64)
+        self._hnsw = index
+
+    def load(self):
+        """`documents`テーブルを全件読み込み、インデックスを作り直す。"""
+        ids, contents, metadatas, vectors = [], [], [], []
+        start = 0
+        while True:
+            res = supabase_execute("documents.select", supabase.table('documents').select("id, content, metadata, embedding").order('id').range(start, start + LOCAL_INDEX_PAGE_SIZE - 1))
+            for row in res.data:
+                ids.append(str(row['id']))
+                contents.append(row['content'])
+                metadatas.append(row.get('metadata') or {})
+                vectors.append(_parse_embedding(row['embedding']))
+            if len(res.data) < LOCAL_INDEX_PAGE_SIZE:
+                break
+            start += LOCAL_INDEX_PAGE_SIZE
+        matrix = self._normalize(vectors) if vectors else None
+        with self._lock:
+            self._ids, self._contents, self._metadatas, self._matrix = ids, contents, metadatas, matrix
+            if matrix is not None:
+                self._rebuild_hnsw()
+            self.ready = True
+            self.loaded_at = dt.datetime.now(dt.timezone.utc).isoformat()
+        logging.info(f"ローカルベクトルインデックスに{len(ids)}件の記憶を読み込みました。(HNSW: {'有効' if self._hnsw else '無効'})")
+
+    def add(self, ids: List[str], contents: List[str], metadatas: List[Dict[str, Any]], vectors: List[List[float]]):
+        """/learn で保存されたチャンクをインデックスに追加する。"""
+        if not self.ready or not ids:
+            return
+        rows = self._normalize(vectors)
+        with self._lock:
+            start = len(self._ids)
+            self._ids.extend(ids)
+            self._contents.extend(contents)
+            self._metadatas.extend(metadatas)
+            self._matrix = rows if self._matrix is None else np.vstack([self._matrix, rows])
+            if self._hnsw is not None:
+                if len(self._ids) > self._hnsw.get_max_elements():
+                    self._hnsw.resize_index(len(self._ids) * 2)
+                self._hnsw.add_items(rows, np.arange(start, len(self._ids)))
+            elif hnswlib is not None and len(self._ids) >= LOCAL_INDEX_HNSW_THRESHOLD:
+                self._rebuild_hnsw()
+
+    def remove(self, ids: List[str]):
+        """削除された記憶(失敗した学習ジョブが保存していたチャンクなど)をインデックスから取り除く。"""
+        if not self.ready or not ids:
+            return
+        removed = set(ids)
+        with self._lock:
+            keep = [i for i, doc_id in enumerate(self._ids) if doc_id not in removed]
+            if len(keep) == len(self._ids):
+                return
+            self._ids = [self._ids[i] for i in keep]
+            self._contents = [self._contents[i] for i in keep]
+            self._metadatas = [self._metadatas[i] for i in keep]
+            self._matrix = self._matrix[keep] if keep else None
+            if self._matrix is not None:
+                self._rebuild_hnsw()
+            else:
+                self._hnsw = None
+
+    def search(self, vector: List[float], k: int = 5, metadata_filter: Optional[Dict[str, Any]] = None) -> List[MemoryCandidate]:
+        """
+        コサイン類似度の高い順に最大k件を返す。各候補は正規化済みのベクトルも持つ。
+        metadata_filter を指定した場合は、条件に一致する行だけを総当たりで比較する(HNSWは使わない)。
+        """
+        with self._lock:
+            if self._matrix is None:
+                return []
+            query = self._normalize([vector])[0]
+            if metadata_filter:
+                rows = np.fromiter((i for i, metadata in enumerate(self._metadatas) if metadata_matches(metadata, metadata_filter)), dtype=np.int64)
+            else:
+                rows = None
+            k = min(k, len(self._ids) if rows is None else len(rows))
+            if k <= 0:
+                return []
+            if self._hnsw is not None and rows is None:
+                labels, distances = self._hnsw.knn_query(query, k=k)
+                order, scores = labels[0], 1 - distances[0]
+            else:
+                matrix = self._matrix if rows is None else self._matrix[rows]
+                similarities = matrix @ query
+                order = np.argpartition(-similarities, k - 1)[:k]
+                order = order[np.argsort(-similarities[order])]
+                scores = similarities[order]
+                if rows is not None:
+                    order = rows[order]
+            return [MemoryCandidate(self._contents[i], self._metadatas[i], float(score), self._matrix[i]) for i, score in zip(order, scores)]
+
+    def check_drift(self) -> dict:
+        """Supabase側の件数と比較し、食い違っていれば再読み込みする。"""
+        res = supabase_execute("documents.count", supabase.table('documents').select("id", count="exact").limit(1))
+        remote, local = res.count or 0, len(self)
+        self.last_drift_check = {"checked_at": dt.datetime.now(dt.timezone.utc).isoformat(), "remote_count": remote, "local_count": local, "drift": remote - local}
+        if remote != local:
+            logging.warning(f"ローカルベクトルインデックスの件数がSupabaseと一致しません(remote={remote}, local={local})。再読み込みします。")
+            self.load()
+        return self.last_drift_check
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": LOCAL_VECTOR_INDEX, "ready": self.ready, "size": len(self), "hnsw": self._hnsw is not None, "loaded_at": self.loaded_at, "last_drift_check": self.last_drift_check}
+
+if LOCAL_VECTOR_INDEX and np is None:
+    logging.warning("LOCAL_VECTOR_INDEX=1 ですが numpy がインストールされていないため、ローカルベクトルインデックスは無効です。")
+    LOCAL_VECTOR_INDEX = False
+local_index = LocalVectorIndex()
+
+# --- 2.4. 起動・終了処理 ---
+background_tasks = set()
+
+async def maintain_local_index():
+    """ローカルベクトルインデックスを読み込み、以後は定期的にSupabaseとの食い違いを確認する。"""
+    try:
+        await run_blocking(local_index.load)
+    except Exception as e:
+        logging.error(f"ローカルベクトルインデックスの読み込みに失敗しました。Supabaseでの検索を続けます: {e}", exc_info=True)
+    while True:
+        await asyncio.sleep(LOCAL_INDEX_DRIFT_CHECK_SECONDS)
+        try:
+            await run_blocking(local_index.check_drift)
+        except Exception as e:
+            logging.error(f"ローカルベクトルインデックスの整合性確認中にエラー: {e}")
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if LOCAL_VECTOR_INDEX:
+        task = asyncio.create_task(maintain_local_index())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+@app.on_event("shutdown")
+def shutdown_blocking_executor():
+    for task in background_tasks:
+        task.cancel()
+    blocking_executor.shutdown(wait=False, cancel_futures=True)
+
 # --- 3. Pydanticモデル定義 (基本機能) ---
 class LearnRequest(BaseModel):
     text_content: str = Field(..., description="学習させたいテキスト本文。")
@@ -70,31 +564,117 @@ class LearnRequest(BaseModel):
 class LearnResponse(BaseModel):
     status: str = "success"
     message: str
+    job_id: Optional[str] = Field(None, description="バックグラウンドの学習ジョブID。進捗は GET /learn/{job_id} で確認できる。")
+
+# 学習ジョブの状態。failed のジョブが保存したチャンクは削除済みで、削除できなかった場合は partial になる
+LEARN_JOB_STATUSES = ("queued", "running", "succeeded", "failed", "partial")
+
+class LearnJobStatus(BaseModel):
+    job_id: str
+    status: str = Field("queued", description=f"{' / '.join(LEARN_JOB_STATUSES)} のいずれか。failed のジョブが保存したチャンクは削除済みで、削除できなかった場合は partial になる。")
+    filename: Optional[str] = None
+    total_chunks: int = 0
+    embedded_chunks: int = 0
+    stored_chunks: int = 0
+    error: Optional[str] = None
+    created_at: str
+    finished_at: Optional[str] = None
+
+# /query で指定できる k の上限と、再ランキングの前に k の何倍の候補を取得するか
+QUERY_MAX_K = int(os.environ.get("QUERY_MAX_K", "50"))
+QUERY_RERANK_FETCH_MULTIPLIER = int(os.environ.get("QUERY_RERANK_FETCH_MULTIPLIER", "4"))
+QUERY_RERANKERS = ("mmr", "recency")
 
 class QueryRequest(BaseModel):
-    query_text: str = Field(..., description="記憶を検索するための問い合わせテキスト。")
+    query_text: Optional[str] = Field(None, description="記憶を検索するための問い合わせテキスト。")
+    queries: List[str] = Field([], description="まとめて検索する複数の問い合わせ。query_text と併用した場合は query_text が先頭になる。")
+    k: int = Field(5, ge=1, le=QUERY_MAX_K, description="問い合わせごとに返す記憶の件数。")
+    score_threshold: Optional[float] = Field(None, description="これ未満のコサイン類似度の記憶は返さない。")
+    filter: Dict[str, Any] = Field({}, description="メタデータの完全一致条件。例: {\"user_id\": \"...\", \"filename\": \"...\", \"source\": \"...\"}")
+    rerank: Optional[str] = Field(None, description="再ランキングの方法。'mmr'(多様性) または 'recency'(新しさ)。")
+    mmr_lambda: float = Field(0.5, ge=0, le=1, description="MMRで関連度を重視する割合。1に近いほど多様性より関連度を優先する。")
+    recency_weight: float = Field(0.3, ge=0, le=1, description="rerank='recency' のとき、新しさをスコアに混ぜる割合。")
+    recency_half_life_days: float = Field(30.0, gt=0, description="rerank='recency' のとき、新しさの重みが半分になるまでの日数。")
+
+class MemoryMatch(BaseModel):
+    content: str
+    score: float = Field(..., description="問い合わせとのコサイン類似度。")
+    rerank_score: Optional[float] = Field(None, description="再ランキングに使ったスコア。再ランキングしない場合は null。")
+    metadata: Dict[str, Any] = {}
+
+class QueryResult(BaseModel):
+    query: str
+    matches: List[MemoryMatch]
 
 class QueryResponse(BaseModel):
     status: str = "success"
-    documents: List[str] = Field(..., description="検索クエリに最も関連性の高い記憶の断片リスト。")
+    documents: List[str] = Field(..., description="検索クエリに最も関連性の高い記憶の断片リスト。複数の問い合わせの場合は重複を除いて順に並べたもの。")
+    results: List[QueryResult] = Field([], description="問い合わせごとの、スコアとメタデータ付きの検索結果。")
 
 
 # --- 4. APIエンドポイント (基本機能) ---
 
-@app.post("/learn", response_model=LearnResponse, tags=["Memory"])
-async def learn_document(request: LearnRequest):
+# --- 4.1. 学習ジョブ (Background Ingestion Jobs) ---
+# 大きなテキストの学習はHTTPリクエストの中では行わず、ジョブとしてバックグラウンドで実行する。
+# チャンクは LEARN_EMBED_BATCH_SIZE 件ずつまとめてベクトル化し、同時に処理するバッチ数は
+# LEARN_EMBED_CONCURRENCY で制限する。ジョブの状態は直近 LEARN_JOB_RETENTION 件までメモリに保持する。
+LEARN_EMBED_BATCH_SIZE = int(os.environ.get("LEARN_EMBED_BATCH_SIZE", "32"))
+LEARN_EMBED_CONCURRENCY = int(os.environ.get("LEARN_EMBED_CONCURRENCY", "2"))
+LEARN_JOB_RETENTION = int(os.environ.get("LEARN_JOB_RETENTION", "100"))
+
+learn_jobs: "OrderedDict[str, LearnJobStatus]" = OrderedDict()
+learn_job_tasks = set()
+
+def _now_iso() -> str:
+    return dt.datetime.now(dt.timezone.utc).isoformat()
+
+async def discard_stored_chunks(job: LearnJobStatus, stored_batches: List[List[str]]) -> str:
     """
-    新しい知識を学習し、`documents`テーブルにベクトルとして保管する。
-    また、学習履歴を`learning_history`テーブルに保存する。
+    失敗したジョブが保存済みのチャンクを削除し、ジョブの最終状態を返す。
+    削除しておけば、同じ資料をもう一度学習させても記憶が重複しない。削除できなかった場合は "partial" を返す。
     """
-    if not request.text_content.strip():
-        raise HTTPException(status_code=400, detail="学習するテキスト内容が空です。")
+    if not stored_batches:
+        return "failed"
     try:
-        logging.info(f"新しい知識の学習を開始します。ソース: {request.metadata.get('filename', 'Unknown')}")
-        
-        docs = text_splitter.create_documents([request.text_content], metadatas=[request.metadata])
-        vector_store.add_documents(docs)
-        logging.info(f"{len(docs)}個のチャンクをベクトルストアに正常に追加しました。")
+        for ids in stored_batches:
+            await run_blocking(supabase_execute, "documents.delete", supabase.table('documents').delete().in_('id', ids))
+            await run_blocking(local_index.remove, ids)
+            job.stored_chunks -= len(ids)
+    except Exception as e:
+        logging.error(f"[job {job.job_id}] 保存済みのチャンクを削除できませんでした。{job.stored_chunks}個が残っています: {e}", exc_info=True)
+        return "partial"
+    logging.info(f"[job {job.job_id}] 失敗したジョブが保存していたチャンクを削除しました。")
+    return "failed"
+
+async def run_learn_job(job: LearnJobStatus, request: LearnRequest):
+    """
+    テキストを分割し、バッチ単位でベクトル化して`documents`テーブルへ一括で保存する。
+    途中で失敗した場合は、それまでに保存したチャンクを削除してからジョブを failed にする。
+    """
+    job.status = "running"
+    stored_batches: List[List[str]] = []
+    try:
+        # learned_at は /query の新しさによる再ランキング(rerank="recency")で使う
+        metadata = {"learned_at": job.created_at, **request.metadata}
+        docs = await run_blocking(text_splitter.create_documents, [request.text_content], metadatas=[metadata])
+        job.total_chunks = len(docs)
+        semaphore = asyncio.Semaphore(max(LEARN_EMBED_CONCURRENCY, 1))
+
+        async def embed_and_store(batch):
+            async with semaphore:
+                vectors = await run_blocking(timed("embeddings.embed_documents", embeddings.embed_documents), [doc.page_content for doc in batch])
+                job.embedded_chunks += len(batch)
+                ids = await run_blocking(timed("supabase.documents.upsert", vector_store.add_vectors), vectors, batch, [str(uuid.uuid4()) for _ in batch])
+                stored_batches.append(ids)
+                job.stored_chunks += len(batch)
+                await run_blocking(local_index.add, ids, [doc.page_content for doc in batch], [doc.metadata for doc in batch], vectors)
+
+        batches = [docs[i:i + LEARN_EMBED_BATCH_SIZE] for i in range(0, len(docs), LEARN_EMBED_BATCH_SIZE)]
+        results = await asyncio.gather(*(embed_and_store(batch) for batch in batches), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+        logging.info(f"[job {job.job_id}] {len(docs)}個のチャンクをベクトルストアに正常に追加しました。")
 
         # あなたのDB設計に完全に準拠 (user_id)
         history_record = {
@@ -103,38 +683,182 @@ async def learn_document(request: LearnRequest):
             "filename": request.metadata.get("filename"),
             "file_size": request.metadata.get("file_size")
         }
-        supabase.table('learning_history').insert(history_record).execute()
-        logging.info("Supabaseの`learning_history`への記録に成功しました。")
-
-        return LearnResponse(message="Knowledge successfully acquired and history logged.")
+        await run_blocking(supabase_execute, "learning_history.insert", supabase.table('learning_history').insert(history_record))
+        logging.info(f"[job {job.job_id}] Supabaseの`learning_history`への記録に成功しました。")
+        job.status = "succeeded"
     except Exception as e:
-        logging.error(f"学習処理(/learn)中にエラーが発生しました: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+        logging.error(f"[job {job.job_id}] 学習ジョブの実行中にエラーが発生しました: {e}", exc_info=True)
+        job.error = str(e)
+        job.status = await discard_stored_chunks(job, stored_batches)
+    finally:
+        job.finished_at = _now_iso()
+
+@app.post("/learn", response_model=LearnResponse, status_code=202, tags=["Memory"])
+async def learn_document(request: LearnRequest):
+    """
+    新しい知識の学習ジョブを登録し、すぐにジョブIDを返す。
+    ジョブはテキストを`documents`テーブルにベクトルとして保管し、学習履歴を`learning_history`テーブルに保存する。
+    """
+    if not request.text_content.strip():
+        raise HTTPException(status_code=400, detail="学習するテキスト内容が空です。")
+    job = LearnJobStatus(job_id=uuid.uuid4().hex, filename=request.metadata.get("filename"), created_at=_now_iso())
+    learn_jobs[job.job_id] = job
+    while len(learn_jobs) > LEARN_JOB_RETENTION:
+        learn_jobs.popitem(last=False)
+    logging.info(f"新しい知識の学習ジョブを登録しました。ジョブID: {job.job_id}, ソース: {job.filename or 'Unknown'}")
+
+    task = asyncio.create_task(run_learn_job(job, request))
+    learn_job_tasks.add(task)
+    task.add_done_callback(learn_job_tasks.discard)
+    return LearnResponse(status="accepted", message="Learning job accepted.", job_id=job.job_id)
+
+@app.get("/learn/{job_id}", response_model=LearnJobStatus, tags=["Memory"])
+async def get_learn_job(job_id: str):
+    """学習ジョブの進捗状況を返す。"""
+    job = learn_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"学習ジョブ'{job_id}'が見つかりません。")
+    return job
+
+# --- 4.2. 記憶の検索 (Multi-query Retrieval) ---
+# 複数の問い合わせを1回の埋め込みAPI呼び出しでベクトル化し、問い合わせごとに候補を並行して取得する。
+# メタデータの条件はSupabaseの`match_documents`(またはローカルインデックス)に渡して検索時に絞り込み、
+# 再ランキングする場合は k * QUERY_RERANK_FETCH_MULTIPLIER 件の候補から k 件を選び直す。
+def fetch_candidates(vector: List[float], k: int, metadata_filter: Optional[Dict[str, Any]] = None) -> List[MemoryCandidate]:
+    """ベクトルに近い記憶を、類似度の高い順に最大k件取得する。"""
+    if local_index.ready:
+        with track_io("local_index.search"):
+            return local_index.search(vector, k=k, metadata_filter=metadata_filter)
+    with track_io("supabase.match_documents"):
+        docs = vector_store.similarity_search_by_vector_with_relevance_scores(vector, k=k, filter=metadata_filter or None)
+    return [MemoryCandidate(doc.page_content, doc.metadata, float(score)) for doc, score in docs]
+
+def search_memory(query_text: str, k: int = 5) -> List[str]:
+    """`documents`テーブルから、問い合わせに最も関連性の高い記憶の断片を検索する。"""
+    return [candidate.content for candidate in fetch_candidates(query_embedding_cache.embed_query(query_text), k)]
+
+def fill_candidate_vectors(candidates: List[MemoryCandidate]):
+    """
+    ベクトルを持たない候補(Supabaseの`match_documents`は埋め込みを返さない)の本文を、まとめて1回でベクトル化する。
+    """
+    missing = list(dict.fromkeys(candidate.content for candidate in candidates if candidate.vector is None))
+    if not missing:
+        return
+    with track_io("embeddings.embed_documents"):
+        vectors = dict(zip(missing, embeddings.embed_documents(missing)))
+    for candidate in candidates:
+        if candidate.vector is None:
+            candidate.vector = vectors[candidate.content]
+
+def rerank_mmr(query_vector: List[float], candidates: List[MemoryCandidate], k: int, lambda_mult: float) -> List[MemoryCandidate]:
+    """最大周辺関連性(MMR)で、問い合わせに近く、かつ互いに似ていない候補をk件選ぶ。"""
+    if not candidates:
+        return []
+    vectors = LocalVectorIndex._normalize([candidate.vector for candidate in candidates])
+    relevance = vectors @ LocalVectorIndex._normalize([query_vector])[0]
+    remaining = list(range(len(candidates)))
+    selected: List[int] = []
+    while remaining and len(selected) < k:
+        redundancy = (vectors[remaining] @ vectors[selected].T).max(axis=1) if selected else np.zeros(len(remaining))
+        scores = lambda_mult * relevance[remaining] - (1 - lambda_mult) * redundancy
+        best = int(np.argmax(scores))
+        candidates[remaining[best]].rerank_score = float(scores[best])
+        selected.append(remaining.pop(best))
+    return [candidates[i] for i in selected]
+
+def learned_age_days(metadata: Dict[str, Any], now: dt.datetime) -> Optional[float]:
+    """メタデータの learned_at から、学習されてからの経過日数を返す。分からなければ None。"""
+    try:
+        learned_at = dt.datetime.fromisoformat(str(metadata["learned_at"]))
+    except (KeyError, ValueError):
+        return None
+    if learned_at.tzinfo is None:
+        learned_at = learned_at.replace(tzinfo=dt.timezone.utc)
+    return max((now - learned_at).total_seconds() / 86400, 0.0)
+
+def rerank_recency(candidates: List[MemoryCandidate], k: int, weight: float, half_life_days: float) -> List[MemoryCandidate]:
+    """
+    類似度と新しさ(半減期 half_life_days 日で減衰)を weight の割合で混ぜたスコアで並べ直し、k件を返す。
+    learned_at を持たない(このリビジョンより前に学習された)記憶は、新しさを0として扱う。
+    """
+    now = dt.datetime.now(dt.timezone.utc)
+    for candidate in candidates:
+        age = learned_age_days(candidate.metadata, now)
+        freshness = 0.0 if age is None else 0.5 ** (age / half_life_days)
+        candidate.rerank_score = (1 - weight) * candidate.score + weight * freshness
+    return sorted(candidates, key=lambda candidate: candidate.rerank_score, reverse=True)[:k]
+
+async def search_memories(queries: List[str], request: QueryRequest) -> List[List[MemoryCandidate]]:
+    """問い合わせごとに、フィルタ・しきい値・再ランキングを適用した記憶の候補リストを返す。"""
+    vectors = await run_blocking(query_embedding_cache.embed_queries, queries)
+    fetch_k = request.k * max(QUERY_RERANK_FETCH_MULTIPLIER, 1) if request.rerank else request.k
+    results = await asyncio.gather(*(run_blocking(fetch_candidates, vector, fetch_k, request.filter) for vector in vectors))
+    if request.score_threshold is not None:
+        results = [[candidate for candidate in candidates if candidate.score >= request.score_threshold] for candidates in results]
+    if request.rerank == "mmr":
+        await run_blocking(fill_candidate_vectors, [candidate for candidates in results for candidate in candidates])
+        return [rerank_mmr(vector, candidates, request.k, request.mmr_lambda) for vector, candidates in zip(vectors, results)]
+    if request.rerank == "recency":
+        return [rerank_recency(candidates, request.k, request.recency_weight, request.recency_half_life_days) for candidates in results]
+    return results
 
 @app.post("/query", response_model=QueryResponse, tags=["Memory"])
 async def query_memory(request: QueryRequest):
     """
     問い合わせ内容に基づいて、`documents`テーブルから最も関連性の高い記憶を検索して返す。
+    query_text か queries で1つ以上の問い合わせを受け取り、問い合わせごとの結果をスコアとメタデータ付きで results に返す。
     """
-    if not request.query_text.strip():
+    queries = list(dict.fromkeys(text.strip() for text in [request.query_text or "", *request.queries] if text.strip()))
+    if not queries:
         raise HTTPException(status_code=400, detail="検索クエリが空です。")
+    if request.rerank is not None and request.rerank not in QUERY_RERANKERS:
+        raise HTTPException(status_code=400, detail=f"未知の再ランキング方法が指定されました: {request.rerank} (指定できるのは {list(QUERY_RERANKERS)})")
+    if request.rerank == "mmr" and np is None:
+        raise HTTPException(status_code=400, detail="MMRによる再ランキングには numpy が必要です。")
     try:
-        logging.info(f"記憶の検索を実行します。クエリ: 「{request.query_text}」")
-        
-        docs = vector_store.similarity_search(query=request.query_text, k=5)
-        response_docs = [doc.page_content for doc in docs]
-        
-        logging.info(f"問い合わせに対して{len(response_docs)}件の関連する記憶を返却します。")
-        return QueryResponse(status="success", documents=response_docs)
+        logging.info(f"記憶の検索を実行します。クエリ: {queries}, k={request.k}, フィルタ: {request.filter}, 再ランキング: {request.rerank}")
+
+        results = await search_memories(queries, request)
+
+        documents = list(dict.fromkeys(candidate.content for candidates in results for candidate in candidates))
+        logging.info(f"{len(queries)}件の問い合わせに対して{len(documents)}件の関連する記憶を返却します。")
+        return QueryResponse(status="success", documents=documents, results=[
+            QueryResult(query=query, matches=[MemoryMatch(content=c.content, score=c.score, rerank_score=c.rerank_score, metadata=c.metadata) for c in candidates])
+            for query, candidates in zip(queries, results)
+        ])
     except Exception as e:
         logging.error(f"記憶の検索(/query)中にエラーが発生しました: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
+# --- 4.3. システム情報 ---
 @app.get("/", tags=["System"])
 async def root():
     """APIサーバーの生存確認用エンドポイント。"""
     return {"message": "Learner is awake. The soul of imazine's world is waiting for a command."}
 
+@app.get("/stats", tags=["System"])
+async def get_stats():
+    """キャッシュなど、Learner内部の統計情報を返す。"""
+    return {"query_embedding_cache": query_embedding_cache.stats(), "local_vector_index": local_index.stats()}
+
+METRIC_GAUGES["learner_query_embedding_cache_events"] = ("Query embedding cache lookups by result.", lambda: [
+    ({"result": "memory_hit"}, query_embedding_cache.memory_hits),
+    ({"result": "disk_hit"}, query_embedding_cache.disk_hits),
+    ({"result": "miss"}, query_embedding_cache.misses),
+])
+METRIC_GAUGES["learner_local_index_size"] = ("Number of documents in the in-process vector index.", lambda: [({}, len(local_index))])
+METRIC_GAUGES["learner_learn_jobs"] = ("Learn jobs currently retained, by status.", lambda: [
+    ({"status": status}, sum(1 for job in list(learn_jobs.values()) if job.status == status)) for status in LEARN_JOB_STATUSES
+])
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["System"])
+async def get_metrics():
+    """エンドポイントと外部呼び出しの所要時間のヒストグラムなどを、Prometheus形式のテキストで返す。"""
+    lines = REQUEST_SECONDS.render() + IO_SECONDS.render()
+    for name, (help_text, read) in METRIC_GAUGES.items():
+        lines += render_gauge(name, help_text, read())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 # learner_main.py (ver.Ω++, The Final Truth, Rev.3)
 # Part 2/2: Advanced Functions for Style, Emotion, Soul, and Growth
 
@@ -182,7 +906,7 @@ async def analyze_and_learn_style(request: StyleLearnRequest):
         
         model = genai.GenerativeModel('gemini-2.5-pro-preview-03-25')
         
-        image_response = requests.get(request.image_url)
+        image_response = await run_blocking(timed("http.image_download", requests.get), request.image_url, timeout=30)
         image_response.raise_for_status()
         image_content = image_response.content
 
@@ -204,19 +928,22 @@ async def analyze_and_learn_style(request: StyleLearnRequest):
             "style_analysis_json": style_analysis_json,
             "style_name": style_analysis_json.get("style_name", "Untitled Style")
         }
-        res = supabase.table('styles').insert(insert_data).execute()
+        res = await run_blocking(supabase_execute, "styles.insert", supabase.table('styles').insert(insert_data))
         
         return StyleLearnResponse(status="success", message="Style analyzed and learned.", style_id=res.data[0]['id'])
     except Exception as e:
         logging.error(f"スタイル学習(/styles)中にエラーが発生しました: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
+def read_styles() -> Dict[str, Any]:
+    res = supabase_execute("styles.select", supabase.table('styles').select("style_analysis_json").order('created_at', desc=True).limit(5))
+    return {"styles": [item['style_analysis_json'] for item in res.data]}
+
 @app.get("/styles", tags=["Style Palette"])
 async def get_styles():
     """現在学習済みの画風（スタイル）の分析結果リストを取得する"""
     try:
-        res = supabase.table('styles').select("style_analysis_json").order('created_at', desc=True).limit(5).execute()
-        return {"styles": [item['style_analysis_json'] for item in res.data]}
+        return await run_blocking(read_styles)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -225,21 +952,23 @@ async def update_character_state(request: CharacterState):
     """キャラクターの最新の感情状態でDBを更新する"""
     try:
         # 常に最新の1行だけを保持する設計
-        supabase.table('character_states').delete().neq('id', 0).execute()
-        supabase.table('character_states').insert(request.model_dump()).execute()
+        await run_blocking(supabase_execute, "character_states.delete", supabase.table('character_states').delete().neq('id', 0))
+        await run_blocking(supabase_execute, "character_states.insert", supabase.table('character_states').insert(request.model_dump()))
         return {"status": "success", "message": "Character state updated."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def read_character_state() -> Dict[str, Any]:
+    res = supabase_execute("character_states.select", supabase.table('character_states').select("*").order('id', desc=True).limit(1))
+    if res.data:
+        return {"state": res.data[0]}
+    return {"state": {"mirai_mood": "ニュートラル", "heko_mood": "ニュートラル", "last_interaction_summary": "まだ会話が始まっていません。"}}
+
 @app.get("/character_state", tags=["Character Emotion"])
 async def get_character_state():
     """キャラクターの現在の感情状態をDBから取得する"""
     try:
-        res = supabase.table('character_states').select("*").order('id', desc=True).limit(1).execute()
-        if res.data:
-            return {"state": res.data[0]}
-        else:
-            return {"state": {"mirai_mood": "ニュートラル", "heko_mood": "ニュートラル", "last_interaction_summary": "まだ会話が始まっていません。"}}
+        return await run_blocking(read_character_state)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -247,7 +976,7 @@ async def get_character_state():
 async def log_concern(request: Concern):
     try:
         # あなたのDB設計に完全に準拠 (user_id)
-        res = supabase.table('concerns').insert({"user_id": request.user_id, "concern_text": request.concern_text}).execute()
+        res = await run_blocking(supabase_execute, "concerns.insert", supabase.table('concerns').insert({"user_id": request.user_id, "concern_text": request.concern_text}))
         return {"status": "success", "concern_id": res.data[0]['id']}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -256,7 +985,7 @@ async def log_concern(request: Concern):
 async def get_unresolved_concerns(user_id: str = "imazine"):
     try:
         # あなたのDB設計に完全に準拠 (notified_at)
-        res = supabase.table('concerns').select("*").eq('user_id', user_id).is_('notified_at', 'null').order('created_at').limit(5).execute()
+        res = await run_blocking(supabase_execute, "concerns.select", supabase.table('concerns').select("*").eq('user_id', user_id).is_('notified_at', 'null').order('created_at').limit(5))
         return {"concerns": res.data}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -265,31 +994,37 @@ async def get_unresolved_concerns(user_id: str = "imazine"):
 async def mark_concern_notified(request: ResolveConcernRequest):
     try:
         # あなたのDB設計に完全に準拠 (notified_at)
-        supabase.table('concerns').update({"notified_at": dt.datetime.now(dt.timezone.utc).isoformat()}).eq('id', request.concern_id).execute()
+        await run_blocking(supabase_execute, "concerns.update", supabase.table('concerns').update({"notified_at": dt.datetime.now(dt.timezone.utc).isoformat()}).eq('id', request.concern_id))
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def read_gals_words() -> Dict[str, Any]:
+    # あなたのDB設計に完全に準拠 (gals_words)
+    res = supabase_execute("gals_words.select", supabase.table('gals_words').select("word, character_type").limit(30))
+    return {"vocabulary": res.data}
+
 @app.get("/gals_words", tags=["Vocabulary"])
 async def get_gals_words():
     """gals_wordsテーブルから、単語リストを取得する"""
     try:
-        # あなたのDB設計に完全に準拠 (gals_words)
-        res = supabase.table('gals_words').select("word, character_type").limit(30).execute()
-        return {"vocabulary": res.data}
+        return await run_blocking(read_gals_words)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def read_gals_vocabulary() -> Dict[str, Any]:
+    # あなたのDB設計に完全に準拠 (gals_vocabulary)
+    res = supabase_execute("gals_vocabulary.select", supabase.table('gals_vocabulary').select("example").order('created_at', desc=True).limit(3))
+    if res.data:
+        examples_text = "\n".join([json.dumps(item['example'], ensure_ascii=False) for item in res.data])
+        return {"examples": examples_text}
+    return {"examples": "（利用可能な会話例はありません）"}
+
 @app.get("/gals_vocabulary", tags=["Dialogue"])
 async def get_gals_vocabulary_examples():
     """gals_vocabularyテーブルから、会話のお手本（語録）を取得する"""
     try:
-        # あなたのDB設計に完全に準拠 (gals_vocabulary)
-        res = supabase.table('gals_vocabulary').select("example").order('created_at', desc=True).limit(3).execute()
-        if res.data:
-            examples_text = "\n".join([json.dumps(item['example'], ensure_ascii=False) for item in res.data])
-            return {"examples": examples_text}
-        return {"examples": "（利用可能な会話例はありません）"}
+        return await run_blocking(read_gals_vocabulary)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -297,20 +1032,67 @@ async def get_gals_vocabulary_examples():
 async def sync_magi_soul(request: MagiSoulSyncRequest):
     """Geminiとの対話の記録を、MAGIの魂として蓄積する"""
     try:
-        res = supabase.table('magi_soul').insert({
+        res = await run_blocking(supabase_execute, "magi_soul.insert", supabase.table('magi_soul').insert({
             "learned_from_filename": request.learned_from_filename,
             "soul_record": request.soul_record
-        }).execute()
+        }))
         return {"status": "success", "record_id": res.data[0]['id']}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def read_magi_soul() -> Dict[str, Any]:
+    res = supabase_execute("magi_soul.select", supabase.table('magi_soul').select("soul_record").order('created_at', desc=True).limit(5))
+    records = [item['soul_record'] for item in res.data]
+    return {"soul_record": "\n---\n".join(records)}
+
 @app.get("/magi_soul", tags=["Magi's Soul"])
 async def get_latest_magi_soul():
     """MAGIの人格に反映させるため、最新の魂の記録を取得する"""
     try:
-        res = supabase.table('magi_soul').select("soul_record").order('created_at', desc=True).limit(5).execute()
-        records = [item['soul_record'] for item in res.data]
-        return {"soul_record": "\n---\n".join(records)}
+        return await run_blocking(read_magi_soul)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+# --- 7. コンテキスト一括取得 (Context Bundle) ---
+
+class ContextRequest(BaseModel):
+    query_text: str = Field("", description="記憶(memory)セクションの検索に使う問い合わせテキスト。")
+    sections: List[str] = Field(default_factory=lambda: list(CONTEXT_SECTION_READERS), description="取得したいセクション名のリスト。")
+
+class ContextResponse(BaseModel):
+    status: str = "success"
+    sections: Dict[str, Any] = Field(..., description="セクション名ごとの、個別エンドポイントと同じ形式の結果。")
+    errors: Dict[str, str] = Field({}, description="取得に失敗したセクションとそのエラー内容。")
+
+CONTEXT_SECTION_READERS = {
+    "character_state": lambda query_text: read_character_state(),
+    "memory": lambda query_text: {"documents": search_memory(query_text) if query_text.strip() else []},
+    "magi_soul": lambda query_text: read_magi_soul(),
+    "gals_words": lambda query_text: read_gals_words(),
+    "gals_vocabulary": lambda query_text: read_gals_vocabulary(),
+    "styles": lambda query_text: read_styles(),
+}
+
+@app.post("/context", response_model=ContextResponse, tags=["Context"])
+async def get_context_bundle(request: ContextRequest):
+    """
+    応答生成に必要な複数のセクションを、一度のリクエストでまとめて返す。
+    Supabaseの読み取りとベクトル検索はサーバー側で同時に実行され、失敗したセクションは`errors`に記録される。
+    """
+    unknown = [name for name in request.sections if name not in CONTEXT_SECTION_READERS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"未知のセクションが指定されました: {unknown}")
+    sections = list(dict.fromkeys(request.sections))
+    results = await asyncio.gather(
+        *(run_blocking(CONTEXT_SECTION_READERS[name], request.query_text) for name in sections),
+        return_exceptions=True
+    )
+    response = ContextResponse(sections={})
+    for name, result in zip(sections, results):
+        if isinstance(result, Exception):
+            logging.error(f"コンテキストのセクション'{name}'の取得中にエラー: {result}")
+            response.errors[name] = str(result)
+        else:
+            response.sections[name] = result
+    return response